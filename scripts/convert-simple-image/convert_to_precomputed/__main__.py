@@ -5,16 +5,38 @@ from pathlib import Path
 from loguru import logger
 from typer import Argument, Option, Typer
 
+from convert_to_precomputed.benchmark import run_encoding_benchmark
 from convert_to_precomputed.convert import LOG_FORMAT, build_ng_base_json, convert_single_scale, image_2_precomputed
+from convert_to_precomputed.intensity import calc_output_dtype, load_spec_intensity_windows
 from convert_to_precomputed.io_utils import check_output_directory, dump_json, list_dir
-from convert_to_precomputed.tensorstore_utils import build_multiscale_metadata_v2, build_scales_dyadic_pyramid
-from convert_to_precomputed.types import ConvertSpec, DimensionRange, ImageResolution, ResolutionPM, ScaleMetadata
+from convert_to_precomputed.scheduler import run_work_units
+from convert_to_precomputed.tensorstore_utils import (
+    build_multiscale_metadata_v2,
+    build_scales_dyadic_pyramid,
+    check_encoding,
+)
+from convert_to_precomputed.types import (
+    ChunkEncoding,
+    ConvertSpec,
+    DimensionRange,
+    DownsampleMethod,
+    EncodingOptions,
+    ImageResolution,
+    ImageSize,
+    OutputDataType,
+    ResolutionPM,
+    ScaleMetadata,
+    ShardEncoding,
+    ShardingOptions,
+    TensorstoreContextOptions,
+)
 from convert_to_precomputed.zimg_utils import (
     get_image_dtype,
     get_image_resolution,
     get_image_resolution_v2,
     get_image_size,
     get_image_size_v2,
+    open_image_source,
     read_image_info,
     read_image_info_v2,
 )
@@ -34,17 +56,122 @@ def convert(
     resolution: tuple[float, float, float] = Argument(help="resolution of x, y, z", min=0.0, default=(0.0, 0.0, 0.0)),
     z_range: tuple[int, int] = Option(help="Z range, -1 means end", default=(0, -1)),
     write_block_size: int = Option(help="Block size when writing precomputed", default=512),
-    resume: bool = Option(help="Resume from output_directory/work_progress.json", default=True),
+    resume: bool = Option(help="Resume from output_directory/work_status.json", default=True),
     base_url: str = Option(help="Base url in base.json", default="http://10.11.40.170:2000"),
     base_path: Path = Option(help="Base path, must be parent of output directory", default=Path("/zjbs-data/share")),
+    cascade: bool = Option(help="Build each scale from the previous scale instead of re-reading image", default=False),
+    downsample_method: DownsampleMethod = Option(
+        help="Downsample method when cascading or streaming, mean for image data, mode for labels",
+        default=DownsampleMethod.MEAN,
+    ),
+    stream: bool = Option(help="Write all scales in one sweep, reading every z slab of image only once", default=False),
+    tile_size: int = Option(help="Read and write XY tiles of this size instead of whole planes, 0 disables", default=0),
+    shard_aligned: bool = Option(
+        help="Read and write whole shards so each shard file is written once, memory holds one shard", default=False
+    ),
+    max_inflight_writes: int = Option(help="Maximum number of block writes running at the same time", min=1, default=4),
+    pipelined: bool = Option(help="Read and normalize next tiles on worker threads while writing", default=False),
+    memory_budget: int = Option(
+        help="Memory budget in MiB for tiles queued in pipelined mode and slabs read for intensity statistics",
+        min=1,
+        default=4096,
+    ),
+    intensity_percentiles: tuple[float, float] = Option(
+        help="Percentiles of image intensity mapped to the output range, computed over the whole image",
+        default=(0.0, 100.0),
+    ),
+    output_data_type: OutputDataType = Option(
+        help="Data type written, auto keeps integer images and normalizes float images to float32",
+        default=OutputDataType.AUTO,
+    ),
+    read_workers: int = Option(help="Threads decoding the files of an image directory concurrently", min=1, default=1),
+    encoding: ChunkEncoding = Option(
+        help="Chunk encoding, jpeg for uint8 images of 1 or 3 channels", default=ChunkEncoding.RAW
+    ),
+    jpeg_quality: int = Option(help="Quality of jpeg encoding", min=1, max=100, default=75),
+    png_level: int = Option(help="Compression level of png encoding", min=0, max=9, default=6),
+    data_encoding: ShardEncoding = Option(help="Compression of chunks in shard files", default=ShardEncoding.GZIP),
+    minishard_index_encoding: ShardEncoding = Option(
+        help="Compression of minishard indexes in shard files", default=ShardEncoding.GZIP
+    ),
+    target_shard_size: int = Option(help="Target uncompressed shard size in MiB", min=1, default=2048),
+    target_minishard_index_size: int = Option(help="Target minishard index size in KiB", min=1, default=12),
+    verify_resume: bool = Option(
+        help="On resume, re-read blocks of the completion log and write them again if their hash differs", default=True
+    ),
+    checkpoint_blocks: int = Option(help="Save work_status.json at most every this many blocks", min=1, default=16),
+    checkpoint_interval: float = Option(
+        help="Save work_status.json at least every this many seconds while writing", min=0.0, default=30.0
+    ),
+    cache_pool_size: int = Option(help="Tensorstore chunk cache size in MiB shared by all stores", min=0, default=256),
+    data_copy_concurrency: int = Option(
+        help="Tensorstore threads encoding and copying chunks, 0 means the number of CPUs", min=0, default=0
+    ),
+    file_io_concurrency: int = Option(
+        help="Tensorstore concurrent file operations, 0 means its default", min=0, default=0
+    ),
+    transaction_memory_cap: int = Option(
+        help="Commit the writes of each z slab in one transaction, committing early above this many MiB, 0 disables",
+        min=0,
+        default=0,
+    ),
+    progress_interval: float = Option(
+        help="Print a machine readable progress event to stdout every this many seconds, 0 disables",
+        min=0.0,
+        default=0.0,
+    ),
 ) -> None:
     logger.info(
         f"Converting image to precomputed: "
         f"image_path={str(image_path)},output_directory={str(output_directory)},{resolution=},{z_range=},"
-        f"{write_block_size=},{resume=}"
+        f"{write_block_size=},{resume=},{cascade=},{downsample_method=},{stream=},{tile_size=},{shard_aligned=},"
+        f"{max_inflight_writes=},{pipelined=},{memory_budget=},{intensity_percentiles=},{output_data_type=},"
+        f"{read_workers=},{encoding=},{jpeg_quality=},{png_level=},{data_encoding=},{minishard_index_encoding=},"
+        f"{target_shard_size=},{target_minishard_index_size=},{verify_resume=},{checkpoint_blocks=},"
+        f"{checkpoint_interval=},{cache_pool_size=},{data_copy_concurrency=},{file_io_concurrency=},"
+        f"{transaction_memory_cap=},{progress_interval=}"
+    )
+    encoding_options = EncodingOptions(
+        encoding=encoding,
+        jpeg_quality=jpeg_quality,
+        png_level=png_level,
+        data_encoding=data_encoding,
+        minishard_index_encoding=minishard_index_encoding,
     )
     image_2_precomputed(
-        image_path, output_directory, resolution, z_range, write_block_size, resume, base_url, base_path
+        image_path,
+        output_directory,
+        resolution,
+        z_range,
+        write_block_size,
+        resume,
+        base_url,
+        base_path,
+        cascade=cascade,
+        downsample_method=downsample_method,
+        stream=stream,
+        tile_size=tile_size,
+        shard_aligned=shard_aligned,
+        max_inflight_writes=max_inflight_writes,
+        pipelined=pipelined,
+        memory_budget=memory_budget << 20,
+        intensity_percentiles=intensity_percentiles,
+        output_data_type=output_data_type,
+        read_workers=read_workers,
+        encoding_options=encoding_options,
+        sharding_options=ShardingOptions(
+            target_shard_bytes=target_shard_size << 20, target_minishard_index_bytes=target_minishard_index_size << 10
+        ),
+        verify_resume=verify_resume,
+        checkpoint_blocks=checkpoint_blocks,
+        checkpoint_seconds=checkpoint_interval,
+        context_options=TensorstoreContextOptions(
+            cache_pool_bytes=cache_pool_size << 20,
+            data_copy_concurrency=data_copy_concurrency,
+            file_io_concurrency=file_io_concurrency,
+        ),
+        transaction_memory_cap=transaction_memory_cap << 20,
+        progress_interval=progress_interval,
     )
 
 
@@ -67,8 +194,12 @@ def gen_base_json(
     resolution: str = Argument(help="resolution of x, y, z", default="0.0,0.0,0.0"),
     base_path: Path = Option(help="Base path, must be parent of output directory", default=Path("/zjbs-data/share")),
     base_url: str = Option(help="Base url in base.json", default="http://10.11.40.170:2000"),
+    output_data_type: OutputDataType = Option(
+        help="Data type written, auto keeps integer images and normalizes float images to float32",
+        default=OutputDataType.AUTO,
+    ),
 ) -> None:
-    image_info = read_image_info_v2(image_path)
+    image_info = read_image_info_v2(image_path, output_directory)
     logger.info(f"{image_info=}")
 
     resolution = [float(r) for r in resolution.split(",")]
@@ -79,7 +210,7 @@ def gen_base_json(
     logger.info(f"{resolution=}")
 
     size = get_image_size(image_info)
-    data_type = get_image_dtype(image_info)
+    data_type = calc_output_dtype(get_image_dtype(image_info), output_data_type)
     url_path = check_output_directory(output_directory, base_path)
 
     base_dict = build_ng_base_json(image_info.channelColors, resolution, size, data_type, url_path, base_url)
@@ -95,19 +226,62 @@ def gen_spec(
     output_directory: Path = Argument(help="Output directory", show_default=False),
     resolution: str = Argument(help="resolution of x, y, z", default="0.0,0.0,0.0"),
     write_block_size: int = Option(help="Block size when writing precomputed", default=512),
+    cascade: bool = Option(help="Build each scale from the previous scale instead of re-reading image", default=False),
+    downsample_method: DownsampleMethod = Option(
+        help="Downsample method when cascading, mean for image data, mode for labels", default=DownsampleMethod.MEAN
+    ),
+    tile_size: int = Option(help="Read and write XY tiles of this size instead of whole planes, 0 disables", default=0),
+    intensity_percentiles: tuple[float, float] = Option(
+        help="Percentiles of image intensity mapped to the output range, computed over the whole image",
+        default=(0.0, 100.0),
+    ),
+    output_data_type: OutputDataType = Option(
+        help="Data type written, auto keeps integer images and normalizes float images to float32",
+        default=OutputDataType.AUTO,
+    ),
+    read_workers: int = Option(help="Threads decoding the files of an image directory concurrently", min=1, default=1),
+    encoding: ChunkEncoding = Option(
+        help="Chunk encoding, jpeg for uint8 images of 1 or 3 channels", default=ChunkEncoding.RAW
+    ),
+    jpeg_quality: int = Option(help="Quality of jpeg encoding", min=1, max=100, default=75),
+    png_level: int = Option(help="Compression level of png encoding", min=0, max=9, default=6),
+    data_encoding: ShardEncoding = Option(help="Compression of chunks in shard files", default=ShardEncoding.GZIP),
+    minishard_index_encoding: ShardEncoding = Option(
+        help="Compression of minishard indexes in shard files", default=ShardEncoding.GZIP
+    ),
+    target_shard_size: int = Option(help="Target uncompressed shard size in MiB", min=1, default=2048),
+    target_minishard_index_size: int = Option(help="Target minishard index size in KiB", min=1, default=12),
 ) -> None:
-    image_info = read_image_info_v2(image_path)
+    image_info = read_image_info_v2(image_path, output_directory)
     resolution = [float(r) for r in resolution.split(",")]
     if resolution == [0.0, 0.0, 0.0]:
         resolution = get_image_resolution_v2(image_info)
     else:
         resolution = ResolutionPM(x=resolution[0], y=resolution[1], z=resolution[2])
 
+    output_dtype = calc_output_dtype(image_info.dataTypeString(), output_data_type)
+    encoding_options = EncodingOptions(
+        encoding=encoding,
+        jpeg_quality=jpeg_quality,
+        png_level=png_level,
+        data_encoding=data_encoding,
+        minishard_index_encoding=minishard_index_encoding,
+    )
+    check_encoding(encoding, output_dtype, image_info.numChannels)
+    sharding_options = ShardingOptions(
+        target_shard_bytes=target_shard_size << 20, target_minishard_index_bytes=target_minishard_index_size << 10
+    )
     scales = [
         ScaleMetadata.model_validate(scale)
-        for scale in build_scales_dyadic_pyramid(resolution, get_image_size(image_info))
+        for scale in build_scales_dyadic_pyramid(
+            resolution,
+            get_image_size(image_info),
+            encoding_options,
+            output_dtype.itemsize * image_info.numChannels,
+            sharding_options,
+        )
     ]
-    multiscale_metadata = build_multiscale_metadata_v2(image_info.dataTypeString(), image_info.numChannels)
+    multiscale_metadata = build_multiscale_metadata_v2(output_dtype, image_info.numChannels)
     spec = ConvertSpec(
         image_path=str(image_path),
         output_directory=str(output_directory),
@@ -116,6 +290,14 @@ def gen_spec(
         write_block_size=write_block_size,
         multiscale=multiscale_metadata,
         scales=scales,
+        cascade=cascade,
+        downsample_method=downsample_method,
+        tile_size=tile_size,
+        intensity_percentiles=intensity_percentiles,
+        output_data_type=output_data_type,
+        read_workers=read_workers,
+        encoding_options=encoding_options,
+        sharding_options=sharding_options,
     )
     logger.info(f"{spec=}")
     spec_json = spec.model_dump_json(indent=2, by_alias=True)
@@ -130,6 +312,12 @@ def convert_scale(
     scale_index: int = Argument(help="The scale to be converted in spec file", show_default=False),
 ) -> None:
     spec = ConvertSpec.model_validate_json(spec_path.read_text())
+    if Path(spec.image_path).is_dir():
+        open_image_source(Path(spec.image_path), Path(spec.output_directory))
+    if spec.cascade and scale_index > 0:
+        source_scale = spec.scales[scale_index - 1].model_dump(by_alias=True)
+    else:
+        source_scale = None
     convert_single_scale(
         image_path=Path(spec.image_path),
         output_directory=Path(spec.output_directory),
@@ -139,10 +327,50 @@ def convert_scale(
         scale=spec.scales[scale_index].model_dump(by_alias=True),
         multi_scale_metadata=spec.multiscale.model_dump(),
         scale_progress=None,
-        write_status_json=False,
+        checkpointer=None,
+        source_scale=source_scale,
+        downsample_method=spec.downsample_method,
+        tile_size=spec.tile_size,
+        intensity_windows=load_spec_intensity_windows(spec),
+        read_workers=spec.read_workers,
     )
 
 
+@app.command(help="Convert all scales of specification on local worker processes")
+def schedule(
+    spec_path: Path = Argument(
+        help="Specification for converting image", exists=True, file_okay=True, dir_okay=False, show_default=False
+    ),
+    workers: int = Option(help="Number of worker processes", min=1, default=os.cpu_count()),
+    max_retries: int = Option(help="Retry times of a failed work unit", min=0, default=2),
+    resume: bool = Option(help="Skip work units recorded in output_directory/schedule_status.json", default=True),
+    verify_resume: bool = Option(
+        help="On resume, re-read blocks of the completion log and write them again if their hash differs", default=True
+    ),
+    cache_pool_size: int = Option(help="Tensorstore chunk cache size in MiB shared by all stores", min=0, default=256),
+    data_copy_concurrency: int = Option(
+        help="Tensorstore threads encoding and copying chunks, 0 means the number of CPUs", min=0, default=0
+    ),
+    file_io_concurrency: int = Option(
+        help="Tensorstore concurrent file operations, 0 means its default", min=0, default=0
+    ),
+) -> None:
+    context_options = TensorstoreContextOptions(
+        cache_pool_bytes=cache_pool_size << 20,
+        data_copy_concurrency=data_copy_concurrency,
+        file_io_concurrency=file_io_concurrency,
+    )
+    run_work_units(spec_path, workers, max_retries, resume, verify_resume, context_options)
+
+
+@app.command(help="Benchmark chunk encodings on a synthetic volume, reporting MB/s and output size")
+def benchmark(
+    output_directory: Path = Argument(help="Directory of benchmark outputs, replaced", show_default=False),
+    size: tuple[int, int, int] = Option(help="Size of synthetic volume in x, y, z", min=1, default=(512, 512, 128)),
+) -> None:
+    run_encoding_benchmark(output_directory, ImageSize(*size))
+
+
 @logger.catch
 def main():
     logger.remove()
@@ -0,0 +1,42 @@
+from typing import Callable
+
+import tensorstore as ts
+from loguru import logger
+
+
+class BatchedTransaction:
+    """Stage block writes in one ts.Transaction, so each touched shard file is written once when it commits.
+
+    The transaction is committed by commit, or as soon as the staged blocks exceed memory_cap bytes, then a new one is
+    started. Callbacks of staged blocks run after their data is committed.
+    """
+
+    def __init__(self, memory_cap: int):
+        self.memory_cap: int = memory_cap
+        self.transaction: ts.Transaction = ts.Transaction()
+        self.staged_bytes: int = 0
+        self.staged_writes: list[ts.WriteFutures] = []
+        self.on_commits: list[Callable[[], None]] = []
+
+    def stage(self, write_future: ts.WriteFutures, nbytes: int, on_commit: Callable[[], None] | None = None) -> None:
+        """Add a write of nbytes issued in self.transaction, committing if the memory cap is reached."""
+        self.staged_writes.append(write_future)
+        self.staged_bytes += nbytes
+        if on_commit is not None:
+            self.on_commits.append(on_commit)
+        if self.staged_bytes >= self.memory_cap:
+            self.commit()
+
+    def commit(self) -> None:
+        if not self.staged_writes:
+            return
+        logger.info(f"commit transaction of {len(self.staged_writes)} blocks, {self.staged_bytes / 2**20:.1f} MiB")
+        for write_future in self.staged_writes:
+            write_future.copy.result()
+        self.transaction.commit_async().result()
+        for on_commit in self.on_commits:
+            on_commit()
+        self.transaction = ts.Transaction()
+        self.staged_bytes = 0
+        self.staged_writes = []
+        self.on_commits = []
@@ -0,0 +1,92 @@
+import shutil
+import time
+from pathlib import Path
+
+import numpy as np
+from loguru import logger
+from numpy import ndarray
+
+from convert_to_precomputed.tensorstore_utils import (
+    build_multiscale_metadata_v2,
+    build_scales_dyadic_pyramid,
+    configure_tensorstore_context,
+    open_tensorstore_to_write,
+    select_channel_zyx,
+)
+from convert_to_precomputed.types import (
+    ChunkEncoding,
+    EncodingBenchmark,
+    EncodingOptions,
+    ImageResolution,
+    ImageSize,
+    ShardEncoding,
+    TensorstoreContextOptions,
+)
+
+BENCHMARK_ENCODINGS: dict[str, EncodingOptions] = {
+    "raw+gzip": EncodingOptions(),
+    "raw": EncodingOptions(data_encoding=ShardEncoding.RAW, minishard_index_encoding=ShardEncoding.RAW),
+    "jpeg_q75": EncodingOptions(encoding=ChunkEncoding.JPEG, jpeg_quality=75, data_encoding=ShardEncoding.RAW),
+    "jpeg_q95": EncodingOptions(encoding=ChunkEncoding.JPEG, jpeg_quality=95, data_encoding=ShardEncoding.RAW),
+    "png_l6": EncodingOptions(encoding=ChunkEncoding.PNG, png_level=6, data_encoding=ShardEncoding.RAW),
+    "labels_raw+gzip": EncodingOptions(),
+    "labels_compressed_segmentation": EncodingOptions(encoding=ChunkEncoding.COMPRESSED_SEGMENTATION),
+}
+
+
+def run_encoding_benchmark(output_directory: Path, size: ImageSize) -> list[EncodingBenchmark]:
+    """Write and read back a synthetic volume of size with every encoding of BENCHMARK_ENCODINGS.
+
+    Image encodings use a smooth uint8 volume with noise like microscopy data, labels_ encodings a uint32 volume of
+    label blocks. Every encoding is written to its own subdirectory of output_directory, which is replaced. Stores are
+    opened without cache, so reads are measured from disk.
+    """
+    configure_tensorstore_context(TensorstoreContextOptions(cache_pool_bytes=0))
+    image = make_synthetic_image(size)
+    labels = make_synthetic_labels(size)
+    results = []
+    for name, encoding_options in BENCHMARK_ENCODINGS.items():
+        data = labels if name.startswith("labels_") else image
+        benchmark_directory = output_directory / name
+        shutil.rmtree(benchmark_directory, ignore_errors=True)
+        scale = build_scales_dyadic_pyramid(ImageResolution(1.0, 1.0, 1.0), size, encoding_options, data.itemsize)[0]
+        multi_scale_metadata = build_multiscale_metadata_v2(data.dtype, 1).model_dump()
+        ts_store = open_tensorstore_to_write("channel_0", benchmark_directory, scale, multi_scale_metadata)
+        ts_store = select_channel_zyx(ts_store, 0)
+
+        start_time = time.perf_counter()
+        ts_store.write(data).result()
+        write_seconds = time.perf_counter() - start_time
+        start_time = time.perf_counter()
+        ts_store.read().result()
+        read_seconds = time.perf_counter() - start_time
+
+        output_bytes = sum(path.stat().st_size for path in benchmark_directory.rglob("*") if path.is_file())
+        result = EncodingBenchmark(name, data.nbytes, output_bytes, write_seconds, read_seconds)
+        logger.info(
+            f"{name}: write {data.nbytes / write_seconds / 2**20:.1f} MB/s, "
+            f"read {data.nbytes / read_seconds / 2**20:.1f} MB/s, "
+            f"size {output_bytes / 2**20:.1f} MiB ({output_bytes / data.nbytes:.1%} of input)"
+        )
+        results.append(result)
+    return results
+
+
+def make_synthetic_image(size: ImageSize) -> ndarray:
+    """(z, y, x) uint8 volume of smooth structures and noise, generated plane by plane."""
+    rng = np.random.default_rng(0)
+    y, x = np.ogrid[: size.y, : size.x]
+    pattern = np.sin(x / 23.0) * np.cos(y / 31.0)
+    image = np.empty((size.z, size.y, size.x), dtype=np.uint8)
+    for z in range(size.z):
+        plane = 96.0 + 64.0 * pattern * np.cos(z / 17.0) + rng.normal(0.0, 8.0, pattern.shape)
+        np.clip(plane, 0, 255, out=plane)
+        image[z] = plane
+    return image
+
+
+def make_synthetic_labels(size: ImageSize) -> ndarray:
+    """(z, y, x) uint32 volume of 16 x 24 x 24 label blocks."""
+    z, y, x = np.ogrid[: size.z, : size.y, : size.x]
+    blocks_y, blocks_x = -(-size.y // 24), -(-size.x // 24)
+    return ((z // 16) * blocks_y * blocks_x + (y // 24) * blocks_x + x // 24 + 1).astype(np.uint32)
@@ -0,0 +1,45 @@
+import threading
+
+import numpy as np
+from numpy import ndarray
+
+
+class BufferPool:
+    """Reusable output buffers keyed by shape and dtype, so converting same sized slabs does not allocate each time.
+
+    At most max_free_bytes of released buffers are kept for reuse, a buffer released beyond it leaves the pool and is
+    freed like any array. A buffer must be released only after every consumer of it is done, e.g. all writes reading
+    from it completed. Acquire and release may be called from different threads.
+    """
+
+    def __init__(self, max_free_bytes: int):
+        self.max_free_bytes: int = max_free_bytes
+        self.free: dict[tuple[tuple[int, ...], np.dtype], list[ndarray]] = {}
+        self.free_bytes: int = 0
+        # keeps the buffers of the pool alive, so their ids are never reused by other arrays while they are in it
+        self.owned: dict[int, ndarray] = {}
+        self.lock: threading.Lock = threading.Lock()
+
+    def acquire(self, shape: tuple[int, ...], dtype: np.dtype) -> ndarray:
+        key = (tuple(shape), np.dtype(dtype))
+        with self.lock:
+            if free_buffers := self.free.get(key):
+                buffer = free_buffers.pop()
+                self.free_bytes -= buffer.nbytes
+                return buffer
+        buffer = np.empty(shape, dtype=dtype)
+        with self.lock:
+            self.owned[id(buffer)] = buffer
+        return buffer
+
+    def release(self, buffer: ndarray) -> None:
+        """Return buffer to the pool, or drop it if the free buffers would exceed max_free_bytes. Arrays not acquired
+        from this pool are ignored."""
+        with self.lock:
+            if id(buffer) not in self.owned:
+                return
+            if self.free_bytes + buffer.nbytes > self.max_free_bytes:
+                del self.owned[id(buffer)]
+                return
+            self.free.setdefault((buffer.shape, buffer.dtype), []).append(buffer)
+            self.free_bytes += buffer.nbytes
@@ -2,7 +2,7 @@ import json
 from reprlib import recursive_repr
 from typing import Callable, Iterator, Optional, Sequence, TypeVar
 
-from convert_to_precomputed.io_utils import dump_json
+from convert_to_precomputed.io_utils import dump_json_atomic
 from convert_to_precomputed.types import JsonObject, OsPath
 
 T = TypeVar("T")
@@ -15,6 +15,7 @@ class ChainedProgress:
         self.children: list[ChainedProgress] = []
         self.index: int = 0
         self.count: int = 1
+        self.pending: int = 0
         self.description: str = ""
 
     def get_or_add(self, name: str) -> "ChainedProgress":
@@ -41,10 +42,17 @@ class ChainedProgress:
         )
 
     def save(self, path: OsPath, backtrack_to_root: bool = True, step_back: bool = True) -> None:
+        """Save the progress tree, items that are started but still pending are saved as not done."""
+        dump_json_atomic(self.to_dict(backtrack_to_root, step_back), path)
+
+    def to_dict(self, backtrack_to_root: bool = True, step_back: bool = True) -> JsonObject:
+        """Snapshot of the progress tree as saved by save."""
+
         def serial_to_dict(progress: ChainedProgress):
+            index = progress.index - progress.pending
             return {
                 "name": progress.name,
-                "index": progress.index - 1 if step_back else progress.index,
+                "index": index - 1 if step_back else index,
                 "count": progress.count,
                 "description": progress.description,
                 "children": [serial_to_dict(child) for child in progress.children],
@@ -53,8 +61,7 @@ class ChainedProgress:
         root = self
         while backtrack_to_root and root.parent:
             root = root.parent
-        json_dict = serial_to_dict(root)
-        dump_json(json_dict, path)
+        return serial_to_dict(root)
 
     @staticmethod
     def load(path: OsPath) -> "ChainedProgress":
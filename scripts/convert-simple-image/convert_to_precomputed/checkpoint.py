@@ -0,0 +1,65 @@
+import threading
+import time
+from pathlib import Path
+
+from loguru import logger
+
+from convert_to_precomputed.chained_progress import ChainedProgress
+from convert_to_precomputed.io_utils import dump_json_atomic
+from convert_to_precomputed.types import JsonObject
+
+
+class ProgressCheckpointer:
+    """Save progress to path every every_blocks blocks or every_seconds seconds, whichever comes first.
+
+    The caller only snapshots the progress tree in memory, a background thread writes the latest snapshot with an
+    atomic rename, so slow metadata storage never blocks block writes. Snapshots not written yet are replaced by newer
+    ones.
+    """
+
+    def __init__(self, path: Path, every_blocks: int, every_seconds: float):
+        self.path: Path = path
+        self.every_blocks: int = every_blocks
+        self.every_seconds: float = every_seconds
+        self.blocks: int = 0
+        self.last_time: float = time.monotonic()
+        self.snapshot: JsonObject | None = None
+        self.closed: bool = False
+        self.condition: threading.Condition = threading.Condition()
+        self.writer: threading.Thread = threading.Thread(target=self._write_snapshots, name="checkpoint", daemon=True)
+        self.writer.start()
+
+    def maybe_save(self, progress: ChainedProgress) -> None:
+        """Called before every block write, snapshots progress when a checkpoint is due."""
+        self.blocks += 1
+        if self.blocks < self.every_blocks and time.monotonic() - self.last_time < self.every_seconds:
+            return
+        self.save(progress)
+
+    def save(self, progress: ChainedProgress) -> None:
+        """Snapshot progress now, items started but still pending are saved as not done like ChainedProgress.save."""
+        snapshot = progress.to_dict()
+        self.blocks, self.last_time = 0, time.monotonic()
+        with self.condition:
+            self.snapshot = snapshot
+            self.condition.notify()
+
+    def close(self) -> None:
+        """Write the last snapshot and stop the background thread."""
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        self.writer.join()
+
+    def _write_snapshots(self) -> None:
+        while True:
+            with self.condition:
+                while self.snapshot is None and not self.closed:
+                    self.condition.wait()
+                snapshot, self.snapshot = self.snapshot, None
+                if snapshot is None:
+                    return
+            try:
+                dump_json_atomic(snapshot, self.path)
+            except OSError as e:
+                logger.warning(f"failed to save checkpoint to {str(self.path)}: {e!r}")
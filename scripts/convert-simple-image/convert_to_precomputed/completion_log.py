@@ -0,0 +1,117 @@
+import hashlib
+import json
+import os
+import shutil
+import socket
+import threading
+from pathlib import Path
+from typing import Callable, TextIO
+
+import numpy as np
+from loguru import logger
+from numpy import ndarray
+
+from convert_to_precomputed.types import DimensionRange, TsScaleMetadata
+
+COMPLETION_LOG_DIRECTORY = "completion_log"
+
+
+class CompletionLog:
+    """Append-only log of written blocks with their size and hash, one file per process so parallel writers never
+    share a file.
+
+    Blocks are the write blocks of the conversion, whole chunks aligned to shards, so one entry covers all of their
+    chunks and a crash redoes only the blocks being written. A block is appended only after its write completed, so
+    every entry describes data that landed on disk. With verify, a logged block only counts as done if the stored data
+    still has the logged size and hash. A long lived log picks up the blocks other processes appended since with
+    refresh.
+    """
+
+    def __init__(self, directory: Path, verify: bool):
+        self.directory: Path = directory
+        self.verify: bool = verify
+        self.entries: dict[str, tuple[int, str]] = {}
+        self.verified: set[str] = set()
+        self.log_file: TextIO | None = None
+        self.lock: threading.Lock = threading.Lock()
+        self.read_offsets: dict[Path, int] = {}
+        self.refresh()
+        logger.info(f"loaded {len(self.entries)} completed blocks from {str(directory)}")
+
+    def refresh(self) -> None:
+        """Load the complete lines appended to the log files since they were last read, own appends are known."""
+        own_path = None if self.log_file is None else Path(self.log_file.name)
+        for log_path in sorted(self.directory.glob("*.jsonl")):
+            if log_path == own_path:
+                continue
+            with open(log_path, "rb") as log_lines:
+                log_lines.seek(self.read_offsets.get(log_path, 0))
+                for line in log_lines:
+                    if not line.endswith(b"\n"):
+                        # a line still being appended, or the last line of a crashed process, is read again later
+                        break
+                    self.read_offsets[log_path] = log_lines.tell()
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    with self.lock:
+                        self.entries[entry["key"]] = (entry["bytes"], entry["hash"])
+
+    def is_done(self, key: str, read_block: Callable[[], ndarray]) -> bool:
+        """Whether block key was completed, read_block reads its stored data if it needs to be verified."""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return False
+            if not self.verify or key in self.verified:
+                return True
+        stored_data = read_block()
+        if (stored_data.nbytes, hash_block(stored_data)) != entry:
+            logger.warning(f"block {key} differs from completion log, write it again")
+            return False
+        with self.lock:
+            self.verified.add(key)
+        return True
+
+    def record(self, key: str, data: ndarray) -> None:
+        """Append block key with the size and hash of data, the block data as stored."""
+        self.record_hash(key, data.nbytes, hash_block(data))
+
+    def record_hash(self, key: str, nbytes: int, block_hash: str) -> None:
+        """Append block key with a size and hash computed before, e.g. while its data was still in memory."""
+        line = json.dumps({"key": key, "bytes": nbytes, "hash": block_hash})
+        with self.lock:
+            if self.log_file is None:
+                self.directory.mkdir(parents=True, exist_ok=True)
+                log_path = self.directory / f"{socket.gethostname()}-{os.getpid()}.jsonl"
+                self.log_file = open(log_path, "a")
+            self.log_file.write(line + "\n")
+            self.log_file.flush()
+            self.entries[key] = (nbytes, block_hash)
+            self.verified.add(key)
+
+    def close(self) -> None:
+        with self.lock:
+            if self.log_file is not None:
+                self.log_file.close()
+                self.log_file = None
+
+
+def open_completion_log(output_directory: Path, resume: bool, verify: bool) -> CompletionLog:
+    """Completion log of output_directory, a conversion that does not resume starts with an empty log."""
+    directory = output_directory / COMPLETION_LOG_DIRECTORY
+    if not resume:
+        shutil.rmtree(directory, ignore_errors=True)
+    return CompletionLog(directory, verify)
+
+
+def calc_block_key(channel_index: int, scale: TsScaleMetadata, block: tuple[DimensionRange, ...]) -> str:
+    """Key of a (x, y, z) block of a channel and scale, in the x0-x1_y0-y1_z0-z1 form of precomputed chunk keys."""
+    scale_key = "_".join(f"{resolution:g}" for resolution in scale["resolution"])
+    ranges = "_".join(f"{dimension_range.start}-{dimension_range.end}" for dimension_range in block)
+    return f"channel_{channel_index}/{scale_key}/{ranges}"
+
+
+def hash_block(data: ndarray) -> str:
+    return hashlib.blake2b(np.ascontiguousarray(data), digest_size=16).hexdigest()
@@ -1,10 +1,12 @@
+import functools
 import itertools
 import time
-from contextlib import contextmanager
+from collections import deque
+from contextlib import closing, contextmanager
 from dataclasses import astuple
 from datetime import timedelta
 from pathlib import Path
-from typing import Iterable
+from typing import Callable, Iterable
 
 import numpy as np
 import tensorstore as ts
@@ -12,20 +14,47 @@ from loguru import logger
 from numpy import ndarray
 from zimg import col4
 
+from convert_to_precomputed.batched_transaction import BatchedTransaction
+from convert_to_precomputed.buffer_pool import BufferPool
 from convert_to_precomputed.chained_progress import ChainedProgress
+from convert_to_precomputed.checkpoint import ProgressCheckpointer
+from convert_to_precomputed.completion_log import CompletionLog, calc_block_key, hash_block, open_completion_log
+from convert_to_precomputed.downsample import downsample
+from convert_to_precomputed.intensity import (
+    calc_output_dtype,
+    load_or_compute_intensity_stats,
+    needs_intensity_windows,
+    normalize_image_data,
+)
 from convert_to_precomputed.io_utils import check_output_directory, dump_json
+from convert_to_precomputed.pipeline import iter_pipelined
+from convert_to_precomputed.progress_events import ProgressReporter
+from convert_to_precomputed.pyramid_stream import build_accumulator_chain
+from convert_to_precomputed.sharding import calc_shard_block_ranges, calc_shard_layout, calc_shard_tiles
 from convert_to_precomputed.tensorstore_utils import (
     build_multiscale_metadata,
     build_scales_dyadic_pyramid,
+    check_encoding,
+    configure_tensorstore_context,
+    open_tensorstore_to_read,
     open_tensorstore_to_write,
     scale_resolution_ratio,
+    select_channel_zyx,
 )
 from convert_to_precomputed.types import (
     DimensionRange,
+    DownsampleMethod,
+    EncodingOptions,
+    ImageRegion,
     ImageResolution,
     ImageSize,
+    IntensityWindow,
     JsonObject,
+    OutputDataType,
     ResolutionPM,
+    ResolutionRatio,
+    ShardingOptions,
+    TensorstoreContextOptions,
     TsScaleMetadata,
 )
 from convert_to_precomputed.zimg_utils import (
@@ -53,16 +82,40 @@ def image_2_precomputed(
     resume: bool,
     base_url: str,
     base_path: Path,
+    cascade: bool = False,
+    downsample_method: DownsampleMethod = DownsampleMethod.MEAN,
+    stream: bool = False,
+    tile_size: int = 0,
+    shard_aligned: bool = False,
+    max_inflight_writes: int = 4,
+    pipelined: bool = False,
+    memory_budget: int = 4 << 30,
+    intensity_percentiles: tuple[float, float] = (0.0, 100.0),
+    output_data_type: OutputDataType = OutputDataType.AUTO,
+    read_workers: int = 1,
+    encoding_options: EncodingOptions | None = None,
+    sharding_options: ShardingOptions | None = None,
+    verify_resume: bool = True,
+    checkpoint_blocks: int = 16,
+    checkpoint_seconds: float = 30.0,
+    context_options: TensorstoreContextOptions | None = None,
+    transaction_memory_cap: int = 0,
+    progress_interval: float = 0.0,
 ) -> None:
+    if stream and (tile_size > 0 or shard_aligned):
+        raise ValueError("tile_size and shard_aligned are not supported when streaming, streaming needs whole planes")
+    if stream and transaction_memory_cap > 0:
+        raise ValueError("transactions are not supported when streaming, slabs of lower scales lag behind the sweep")
     output_directory.mkdir(parents=True, exist_ok=True)
     log_path = output_directory / "convert_to_precomputed.log"
     logger.add(log_path, format=LOG_FORMAT)
     scale_progress = load_work_progress(resume, output_directory)
+    configure_tensorstore_context(context_options or TensorstoreContextOptions())
 
     url_path = check_output_directory(output_directory, base_path)
     logger.info(f"{url_path=}")
 
-    image_info = read_image_info_v2(image_path)
+    image_info = read_image_info_v2(image_path, output_directory)
     logger.info(f"{image_info=}")
 
     if resolution == (0.0, 0.0, 0.0):
@@ -73,31 +126,85 @@ def image_2_precomputed(
 
     size = get_image_size(image_info)
     data_type = get_image_dtype(image_info)
+    output_dtype = calc_output_dtype(data_type, output_data_type)
+    logger.info(f"{data_type=}, {output_dtype=}")
     z_start, z_end = z_range
     if z_end < 0:
         z_end = size.z
     logger.info(f"{z_start=}, {z_end=}")
 
-    base_dict = build_ng_base_json(image_info.channelColors, resolution, size, data_type, url_path, base_url)
+    base_dict = build_ng_base_json(image_info.channelColors, resolution, size, output_dtype, url_path, base_url)
     dump_json(base_dict, output_directory / "base.json")
     logger.info(f"base_json_dict={base_dict}")
     logger.info(f"dump base.json to {str(output_directory / 'base.json')}")
 
-    scales = build_scales_dyadic_pyramid(resolution, size)
+    if encoding_options is None:
+        encoding_options = EncodingOptions()
+    check_encoding(encoding_options.encoding, output_dtype, image_info.numChannels)
+    voxel_bytes = output_dtype.itemsize * image_info.numChannels
+    scales = build_scales_dyadic_pyramid(resolution, size, encoding_options, voxel_bytes, sharding_options)
     logger.info(f"{scales=}")
-    multi_scale_metadata = build_multiscale_metadata(data_type, image_info.numChannels)
-    for scale in scale_progress.bind(scales):
-        convert_single_scale(
-            image_path,
-            output_directory,
-            resolution,
-            DimensionRange(z_start, z_end),
-            write_block_size,
-            scale,
-            multi_scale_metadata,
-            scale_progress,
-            True,
+    multi_scale_metadata = build_multiscale_metadata(output_dtype, image_info.numChannels)
+    intensity_windows = None
+    if needs_intensity_windows(data_type, output_data_type):
+        intensity_stats = load_or_compute_intensity_stats(
+            image_path, output_directory, size, intensity_percentiles, tile_size, read_workers, memory_budget
         )
+        intensity_windows = intensity_stats.channels
+        logger.info(f"{intensity_windows=}")
+    completion_log = open_completion_log(output_directory, resume, verify_resume)
+    checkpointer = ProgressCheckpointer(output_directory / "work_status.json", checkpoint_blocks, checkpoint_seconds)
+    progress_reporter = None
+    if progress_interval > 0:
+        # a sweep covers all scales at once, then only the z slabs of the sweep are weighted
+        scale_voxels = None if stream else [int(np.prod(scale["size"])) for scale in scales]
+        progress_reporter = ProgressReporter(progress_interval, scale_voxels)
+    with closing(completion_log), closing(checkpointer):
+        if stream:
+            convert_scales_streaming(
+                image_path,
+                output_directory,
+                resolution,
+                DimensionRange(z_start, z_end),
+                write_block_size,
+                scales,
+                multi_scale_metadata,
+                scale_progress,
+                checkpointer,
+                downsample_method,
+                max_inflight_writes=max_inflight_writes,
+                intensity_windows=intensity_windows,
+                read_workers=read_workers,
+                completion_log=completion_log,
+                progress_reporter=progress_reporter,
+            )
+        else:
+            for scale_index, scale in scale_progress.bind(list(enumerate(scales))):
+                convert_single_scale(
+                    image_path,
+                    output_directory,
+                    resolution,
+                    DimensionRange(z_start, z_end),
+                    write_block_size,
+                    scale,
+                    multi_scale_metadata,
+                    scale_progress,
+                    checkpointer,
+                    source_scale=scales[scale_index - 1] if cascade and scale_index > 0 else None,
+                    downsample_method=downsample_method,
+                    tile_size=tile_size,
+                    shard_aligned=shard_aligned,
+                    max_inflight_writes=max_inflight_writes,
+                    pipelined=pipelined,
+                    memory_budget=memory_budget,
+                    intensity_windows=intensity_windows,
+                    read_workers=read_workers,
+                    completion_log=completion_log,
+                    transaction_memory_cap=transaction_memory_cap,
+                    progress_reporter=progress_reporter,
+                )
+    if progress_reporter is not None:
+        progress_reporter.report(scale_progress, done=1.0)
     logger.info("DONE")
 
 
@@ -145,39 +252,252 @@ def convert_single_scale(
     scale: TsScaleMetadata,
     multi_scale_metadata: JsonObject,
     scale_progress: ChainedProgress | None,
-    write_status_json: bool,
+    checkpointer: ProgressCheckpointer | None,
+    source_scale: TsScaleMetadata | None = None,
+    downsample_method: DownsampleMethod = DownsampleMethod.MEAN,
+    tile_size: int = 0,
+    shard_aligned: bool = False,
+    max_inflight_writes: int = 4,
+    pipelined: bool = False,
+    memory_budget: int = 4 << 30,
+    channel_index: int | None = None,
+    intensity_windows: list[IntensityWindow] | None = None,
+    read_workers: int = 1,
+    completion_log: CompletionLog | None = None,
+    transaction_memory_cap: int = 0,
+    progress_reporter: ProgressReporter | None = None,
 ):
+    """Convert one scale, reading from the image, or from the already written source_scale if it is given.
+
+    Every z slab is read in XY tiles of about tile_size voxels of this scale, 0 means reading whole planes. With
+    shard_aligned, slabs and tiles are the shard boxes instead, so every shard is assembled in memory and written once.
+    When pipelined, following tiles are read and normalized on worker threads while a tile is written, and the tiles
+    waiting to be written take at most memory_budget bytes. If channel_index is given, only that channel is converted.
+    Data is converted to the data type of multi_scale_metadata with intensity_windows of all channels, or with the
+    range of each slab if it is None, see convert_image_data. With read_workers > 1, the files of an image directory
+    are decoded on that many threads. Tiles whose blocks are all done in completion_log are not read again.
+
+    With transaction_memory_cap > 0, the writes of each z slab are staged in a transaction committed once at the end of
+    the slab, or every time the staged blocks exceed transaction_memory_cap bytes, so shard files are written in few
+    large updates instead of once per block. Progress is then only checkpointed between slabs.
+
+    Finished block writes are counted by progress_reporter, which prints progress events, see ProgressReporter.
+    """
     ratio = scale_resolution_ratio(scale, resolution)
-    read_z_size = scale["chunk_sizes"][2]
+    shard_layout = calc_shard_layout(scale) if shard_aligned else None
+    if shard_aligned and shard_layout is None:
+        logger.warning(f"shards of scale {scale['resolution']} are not spatially contiguous, ignore shard_aligned")
+    if shard_layout is None:
+        read_z_size = scale["chunk_sizes"][2]
+        xy_tiles = calc_xy_tiles(scale, tile_size)
+    else:
+        read_z_size = shard_layout.shard_shape.z * ratio.z
+        xy_tiles = calc_shard_tiles(scale, shard_layout)
+        write_block_size = max(shard_layout.shard_shape.x, shard_layout.shard_shape.y)
+        logger.info(f"{shard_layout=}")
     assert z_range.start % read_z_size == 0
     read_z_ranges = calc_ranges(z_range.start, z_range.end, read_z_size)
     if scale_progress is None:
         z_range_progress = ChainedProgress("z_range", None)
     else:
         z_range_progress = scale_progress.get_or_add("z_range")
-    for read_z_range in z_range_progress.bind(read_z_ranges, lambda zr: f"{zr.start}-{zr.end}"):
-        read_z_start, read_z_end = astuple(read_z_range)
+    if channel_index is None:
+        channel_indices = list(range(multi_scale_metadata["num_channels"]))
+        read_channel_start, read_channel_end = 0, -1
+    else:
+        channel_indices = [channel_index]
+        read_channel_start, read_channel_end = channel_index, channel_index + 1
 
-        with log_time_usage(f"{z_range_progress} read image data"):
-            image_data = read_image_data_v2(
-                image_path, 0, -1, 0, -1, read_z_start, read_z_end, ratio.x, ratio.y, ratio.z
+    def read_tile(work: tuple[DimensionRange, tuple[DimensionRange, DimensionRange]]) -> ndarray | None:
+        read_z_range, (tile_x_range, tile_y_range) = work
+        description = (
+            f"z={read_z_range.start}-{read_z_range.end} "
+            f"xy=({tile_x_range.start},{tile_y_range.start})-({tile_x_range.end},{tile_y_range.end})"
+        )
+        if completion_log is not None and is_tile_done(
+            completion_log,
+            output_directory,
+            scale,
+            multi_scale_metadata,
+            channel_indices,
+            calc_write_range(read_z_range, ratio.z),
+            tile_x_range,
+            tile_y_range,
+            write_block_size,
+        ):
+            logger.info(f"{description} skipped, all blocks are in completion log")
+            return None
+        if source_scale is not None:
+            write_z_range = calc_write_range(read_z_range, ratio.z)
+            with log_time_usage(f"{description} downsample from scale {source_scale['resolution']}"):
+                return downsample_scale_data(
+                    output_directory,
+                    source_scale,
+                    scale,
+                    channel_indices,
+                    ImageRegion(tile_x_range, tile_y_range, write_z_range),
+                    downsample_method,
+                )
+        read_x_start, read_x_end = calc_read_range(tile_x_range, ratio.x, scale["size"][0])
+        read_y_start, read_y_end = calc_read_range(tile_y_range, ratio.y, scale["size"][1])
+        with log_time_usage(f"{description} read image data"):
+            return read_image_data_v2(
+                image_path,
+                read_x_start,
+                read_x_end,
+                read_y_start,
+                read_y_end,
+                read_z_range.start,
+                read_z_range.end,
+                ratio.x,
+                ratio.y,
+                ratio.z,
+                channel_start=read_channel_start,
+                channel_end=read_channel_end,
+                workers=read_workers,
             )
-        image_data = convert_image_data(image_data)
 
-        channel_progress = z_range_progress.get_or_add("channel")
-        for channel_index, channel_data in channel_progress.bind(list(enumerate(image_data))):
+    def convert_tile(image_data: ndarray | None) -> ndarray | None:
+        if image_data is None:
+            return None
+        if intensity_windows is None:
+            tile_windows = None
+        else:
+            tile_windows = [intensity_windows[index] for index in channel_indices]
+        return convert_image_data(image_data, tile_windows, multi_scale_metadata["data_type"], buffer_pool)
+
+    stages = [read_tile] if source_scale is not None else [read_tile, convert_tile]
+    tile_bytes = estimate_tile_bytes(
+        xy_tiles[0], read_z_size // ratio.z, len(channel_indices), multi_scale_metadata["data_type"]
+    )
+    max_queued = max(1, memory_budget // tile_bytes) if pipelined else 0
+    # converted buffers of the queued tiles and of the tile being written
+    buffer_pool = BufferPool((max_queued + 1) * tile_bytes)
+    if pipelined:
+        logger.info(f"pipelined with {max_queued=}, {tile_bytes=}")
+    remaining_work = calc_remaining_work(read_z_ranges, xy_tiles, z_range_progress)
+    transaction = BatchedTransaction(transaction_memory_cap) if transaction_memory_cap > 0 else None
+    with closing(iter_pipelined(remaining_work, stages, max_queued)) as tiles_data:
+        for read_z_range in z_range_progress.bind(read_z_ranges, lambda zr: f"{zr.start}-{zr.end}"):
+            if transaction is not None and checkpointer is not None:
+                # all slabs before are committed, blocks staged in the transaction must never be saved as done
+                checkpointer.maybe_save(z_range_progress)
+            write_z_range = calc_write_range(read_z_range, ratio.z)
+            tile_progress = z_range_progress.get_or_add("xy_tile")
+            for tile_x_range, tile_y_range in tile_progress.bind(
+                xy_tiles, lambda xyr: f"({xyr[0].start},{xyr[1].start})-({xyr[0].end},{xyr[1].end})"
+            ):
+                image_data = next(tiles_data)
+                if image_data is None:
+                    continue
+                channel_progress = tile_progress.get_or_add("channel")
+                for write_channel_index, channel_data in channel_progress.bind(list(zip(channel_indices, image_data))):
+                    write_tensorstore(
+                        write_channel_index,
+                        channel_data,
+                        write_z_range.start,
+                        write_z_range.end,
+                        write_block_size,
+                        output_directory,
+                        scale,
+                        multi_scale_metadata,
+                        channel_progress,
+                        checkpointer=checkpointer if transaction is None else None,
+                        x_offset=tile_x_range.start,
+                        y_offset=tile_y_range.start,
+                        max_inflight_writes=max_inflight_writes,
+                        completion_log=completion_log,
+                        transaction=transaction,
+                        progress_reporter=progress_reporter,
+                    )
+                # write_tensorstore waits for its writes, the converted buffer can be reused by the following tiles
+                buffer_pool.release(image_data)
+            if transaction is not None:
+                transaction.commit()
+
+
+def convert_scales_streaming(
+    image_path: Path,
+    output_directory: Path,
+    resolution: ImageResolution | ResolutionPM,
+    z_range: DimensionRange,
+    write_block_size: int,
+    scales: list[TsScaleMetadata],
+    multi_scale_metadata: JsonObject,
+    scale_progress: ChainedProgress,
+    checkpointer: ProgressCheckpointer | None,
+    downsample_method: DownsampleMethod,
+    max_inflight_writes: int = 4,
+    intensity_windows: list[IntensityWindow] | None = None,
+    read_workers: int = 1,
+    completion_log: CompletionLog | None = None,
+    progress_reporter: ProgressReporter | None = None,
+):
+    """Convert all scales in one sweep, each full resolution z slab is read once and streamed through every scale.
+
+    Progress is only saved at z boundaries where the slabs of all scales are complete, so resuming never needs the
+    buffered planes of a lost run.
+    """
+    ratios = [scale_resolution_ratio(scale, resolution) for scale in scales]
+    assert ratios[0] == ResolutionRatio(1, 1, 1)
+    read_z_size = scales[0]["chunk_sizes"][2]
+    sweep_z_size = max(scale["chunk_sizes"][2] * ratio.z for scale, ratio in zip(scales, ratios))
+    assert z_range.start % sweep_z_size == 0
+
+    z_range_progress = scale_progress.get_or_add("z_range")
+
+    def write_slab(scale: TsScaleMetadata, slab: ndarray, write_z_start: int, write_z_end: int) -> None:
+        scale_progress.description = f"streaming {scales.index(scale) + 1}/{len(scales)}"
+        # slabs of lower scales lag behind the sweep, so their progress is only logged, never saved
+        channel_progress = ChainedProgress("channel", z_range_progress)
+        for channel_index, channel_data in channel_progress.bind(list(enumerate(slab))):
             write_tensorstore(
                 channel_index,
                 channel_data,
-                (read_z_start + ratio.z - 1) // ratio.z,
-                (read_z_end + ratio.z - 1) // ratio.z,
+                write_z_start,
+                write_z_end,
                 write_block_size,
                 output_directory,
                 scale,
                 multi_scale_metadata,
                 channel_progress,
-                write_status_json=write_status_json,
+                checkpointer=None,
+                max_inflight_writes=max_inflight_writes,
+                completion_log=completion_log,
+                progress_reporter=progress_reporter,
+            )
+
+    size_x, size_y = scales[0]["size"][0], scales[0]["size"][1]
+    slab_bytes = estimate_tile_bytes(
+        (DimensionRange(0, size_x), DimensionRange(0, size_y)),
+        read_z_size,
+        multi_scale_metadata["num_channels"],
+        multi_scale_metadata["data_type"],
+    )
+    # one converted slab is pushed at a time
+    buffer_pool = BufferPool(slab_bytes)
+    accumulator = None
+    for sweep_z_range in z_range_progress.bind(
+        calc_ranges(z_range.start, z_range.end, sweep_z_size), lambda zr: f"{zr.start}-{zr.end}"
+    ):
+        if checkpointer is not None:
+            checkpointer.maybe_save(z_range_progress)
+        if accumulator is None:
+            accumulator = build_accumulator_chain(scales, ratios, sweep_z_range.start, write_slab, downsample_method)
+        for read_z_range in calc_ranges(sweep_z_range.start, sweep_z_range.end, read_z_size):
+            with log_time_usage(f"{z_range_progress} read image data {read_z_range.start}-{read_z_range.end}"):
+                image_data = read_image_data_v2(
+                    image_path, 0, -1, 0, -1, read_z_range.start, read_z_range.end, 1, 1, 1, workers=read_workers
+                )
+            image_data = convert_image_data(
+                image_data, intensity_windows, multi_scale_metadata["data_type"], buffer_pool
             )
+            # read slabs are chunk aligned, so the full resolution accumulator writes them right away and every
+            # accumulator only keeps copies or downsampled arrays, the slab is free after the push
+            accumulator.push(image_data)
+            buffer_pool.release(image_data)
+    if accumulator is not None:
+        accumulator.finish()
 
 
 def write_tensorstore(
@@ -190,29 +510,144 @@ def write_tensorstore(
     scale: TsScaleMetadata,
     multi_scale_metadata: JsonObject,
     channel_progress: ChainedProgress,
-    write_status_json: bool,
+    checkpointer: ProgressCheckpointer | None,
+    x_offset: int = 0,
+    y_offset: int = 0,
+    max_inflight_writes: int = 4,
+    completion_log: CompletionLog | None = None,
+    transaction: BatchedTransaction | None = None,
+    progress_reporter: ProgressReporter | None = None,
 ):
+    """Write channel_data (z, y, x) block by block, keeping at most max_inflight_writes block writes running.
+
+    Blocks are written through a z, y, x view of the store, so tensorstore copies them straight from channel_data.
+    Blocks done in completion_log are skipped, and every finished block write is appended to it. With a transaction,
+    blocks are only staged in it, a write is finished when its data is copied and appended when the transaction commits.
+    """
     channel_name = f"channel_{channel_index}"
-    channel_data = channel_data.transpose()
     ts_writer = open_tensorstore_to_write(channel_name, output_directory, scale, multi_scale_metadata)
+    ts_writer = select_channel_zyx(ts_writer, channel_index)
 
+    pending_writes: deque[tuple[ts.WriteFutures | ts.Future, str, int, Callable[[], None] | None]] = deque()
+    tile_x_range = DimensionRange(x_offset, x_offset + channel_data.shape[2])
+    tile_y_range = DimensionRange(y_offset, y_offset + channel_data.shape[1])
     xy_range_progress = channel_progress.get_or_add("xy_range")
     for x_range, y_range in xy_range_progress.bind(
-        list(
-            itertools.product(
-                calc_ranges(0, channel_data.shape[0], write_block_size),
-                calc_ranges(0, channel_data.shape[1], write_block_size),
-            )
-        ),
+        calc_shard_block_ranges(tile_x_range, tile_y_range, write_block_size, calc_shard_layout(scale)),
         lambda xyr: f"({xyr[0].start},{xyr[1].start})-({xyr[0].end},{xyr[1].end})",
     ):
-        write_range = ts.d["channel", "x", "y", "z"][
-            channel_index, x_range.start : x_range.end, y_range.start : y_range.end, write_z_start:write_z_end
+        write_range = ts.d["z", "y", "x"][
+            write_z_start:write_z_end, y_range.start : y_range.end, x_range.start : x_range.end
+        ]
+        block_writer = ts_writer[write_range]
+        block_key = calc_block_key(channel_index, scale, (x_range, y_range, DimensionRange(write_z_start, write_z_end)))
+        if completion_log is not None and completion_log.is_done(block_key, lambda: block_writer.read().result()):
+            logger.info(f"{xy_range_progress} skipped, block is in completion log")
+            continue
+        while len(pending_writes) >= max_inflight_writes:
+            wait_pending_write(pending_writes, xy_range_progress, progress_reporter)
+        if checkpointer is not None:
+            checkpointer.maybe_save(xy_range_progress)
+        block_data = channel_data[
+            :, y_range.start - y_offset : y_range.end - y_offset, x_range.start - x_offset : x_range.end - x_offset
         ]
-        if write_status_json:
-            xy_range_progress.save(output_directory / "work_status.json")
-        with log_time_usage(f"{xy_range_progress} write data"):
-            ts_writer[write_range] = channel_data[x_range.start : x_range.end, y_range.start : y_range.end]
+        record_block = None
+        if completion_log is not None:
+            record_block = build_block_record(
+                completion_log, block_key, block_writer, block_data, scale["encoding"] == "jpeg"
+            )
+        description = f"{xy_range_progress} write data"
+        if transaction is None:
+            write_future = block_writer.write(block_data)
+            pending_writes.append((write_future, description, time.perf_counter_ns(), record_block))
+        else:
+            write_future = block_writer.with_transaction(transaction.transaction).write(block_data)
+            transaction.stage(write_future, block_data.nbytes, record_block)
+            pending_writes.append((write_future.copy, description, time.perf_counter_ns(), None))
+        xy_range_progress.pending += 1
+        if progress_reporter is not None:
+            progress_reporter.add_block(block_data.size, block_data.nbytes)
+    while pending_writes:
+        wait_pending_write(pending_writes, xy_range_progress, progress_reporter)
+
+
+def wait_pending_write(
+    pending_writes: deque[tuple[ts.WriteFutures | ts.Future, str, int, Callable[[], None] | None]],
+    xy_range_progress: ChainedProgress,
+    progress_reporter: ProgressReporter | None = None,
+) -> None:
+    write_future, description, start_time, record_block = pending_writes.popleft()
+    write_future.result()
+    if record_block is not None:
+        record_block()
+    xy_range_progress.pending -= 1
+    if progress_reporter is not None:
+        progress_reporter.maybe_report(xy_range_progress)
+    log_used_time(description, start_time)
+
+
+def build_block_record(
+    completion_log: CompletionLog, block_key: str, block_store: ts.TensorStore, block_data: ndarray, lossy: bool
+) -> Callable[[], None]:
+    """Callback appending the block to completion_log once it is written, block_data is hashed right away."""
+    if lossy:
+        # lossy encodings store other values than written, the stored values are hashed so verifying can match them
+        return lambda: completion_log.record(block_key, block_store.read().result())
+    return functools.partial(completion_log.record_hash, block_key, block_data.nbytes, hash_block(block_data))
+
+
+def is_tile_done(
+    completion_log: CompletionLog,
+    output_directory: Path,
+    scale: TsScaleMetadata,
+    multi_scale_metadata: JsonObject,
+    channel_indices: list[int],
+    write_z_range: DimensionRange,
+    tile_x_range: DimensionRange,
+    tile_y_range: DimensionRange,
+    write_block_size: int,
+) -> bool:
+    """Whether all blocks of the tile are done in completion_log for every channel."""
+    block_ranges = calc_shard_block_ranges(tile_x_range, tile_y_range, write_block_size, calc_shard_layout(scale))
+    for channel_index in channel_indices:
+        ts_store = open_tensorstore_to_write(f"channel_{channel_index}", output_directory, scale, multi_scale_metadata)
+        ts_store = select_channel_zyx(ts_store, channel_index)
+        for x_range, y_range in block_ranges:
+            block_reader = ts_store[
+                ts.d["z", "y", "x"][
+                    write_z_range.start : write_z_range.end, y_range.start : y_range.end, x_range.start : x_range.end
+                ]
+            ]
+            block_key = calc_block_key(channel_index, scale, (x_range, y_range, write_z_range))
+            if not completion_log.is_done(block_key, lambda: block_reader.read().result()):
+                return False
+    return True
+
+
+def downsample_scale_data(
+    output_directory: Path,
+    source_scale: TsScaleMetadata,
+    scale: TsScaleMetadata,
+    channel_indices: list[int],
+    write_region: ImageRegion,
+    method: DownsampleMethod,
+) -> ndarray:
+    """Read the region covering write_region from source_scale and downsample it to (channel, z, y, x) of scale."""
+    factor = scale_resolution_ratio(scale, ImageResolution(*source_scale["resolution"]))
+    write_ranges = (write_region.z, write_region.y, write_region.x)
+    factors = (factor.z, factor.y, factor.x)
+    source_sizes = reversed(source_scale["size"])
+    read_slices = tuple(
+        slice(write_range.start * axis_factor, min(write_range.end * axis_factor, source_size))
+        for write_range, axis_factor, source_size in zip(write_ranges, factors, source_sizes)
+    )
+    channels_data = []
+    for channel_index in channel_indices:
+        ts_reader = open_tensorstore_to_read(f"channel_{channel_index}", output_directory, source_scale)
+        ts_reader = select_channel_zyx(ts_reader, channel_index)
+        channel_data = ts_reader[ts.d["z", "y", "x"][read_slices]].read().result()
+        channels_data.append(downsample(channel_data, factors, method))
+    return np.stack(channels_data)
 
 
 def load_work_progress(resume: bool, output_directory: Path) -> ChainedProgress:
@@ -225,12 +660,83 @@ def calc_ranges(start: int, end: int, step: int) -> list[DimensionRange]:
     return [DimensionRange(start, min(end, start + step)) for start in range(start, end, step)]
 
 
-def convert_image_data(data: ndarray) -> ndarray:
-    if data.dtype.kind != "f":
+def calc_xy_tiles(scale: TsScaleMetadata, tile_size: int) -> list[tuple[DimensionRange, DimensionRange]]:
+    size_x, size_y = scale["size"][0], scale["size"][1]
+    if tile_size <= 0:
+        return [(DimensionRange(0, size_x), DimensionRange(0, size_y))]
+    chunk_x, chunk_y = scale["chunk_sizes"][0], scale["chunk_sizes"][1]
+    tile_x, tile_y = max(chunk_x, tile_size // chunk_x * chunk_x), max(chunk_y, tile_size // chunk_y * chunk_y)
+    return list(itertools.product(calc_ranges(0, size_x, tile_x), calc_ranges(0, size_y, tile_y)))
+
+
+def calc_write_range(read_range: DimensionRange, ratio: int) -> DimensionRange:
+    return DimensionRange((read_range.start + ratio - 1) // ratio, (read_range.end + ratio - 1) // ratio)
+
+
+def calc_remaining_work(
+    read_z_ranges: list[DimensionRange],
+    xy_tiles: list[tuple[DimensionRange, DimensionRange]],
+    z_range_progress: ChainedProgress,
+) -> list[tuple[DimensionRange, tuple[DimensionRange, DimensionRange]]]:
+    """(z range, xy tile) pairs in the order that binding z_range_progress and its xy_tile child will visit them."""
+    z_index = z_range_progress.index
+    tile_index = next((child.index for child in z_range_progress.children if child.name == "xy_tile"), 0)
+    remaining_work = [
+        (read_z_range, xy_tile)
+        for read_z_range in read_z_ranges[z_index : z_index + 1]
+        for xy_tile in xy_tiles[tile_index:]
+    ]
+    remaining_work.extend(
+        (read_z_range, xy_tile) for read_z_range in read_z_ranges[z_index + 1 :] for xy_tile in xy_tiles
+    )
+    return remaining_work
+
+
+def estimate_tile_bytes(
+    xy_tile: tuple[DimensionRange, DimensionRange], depth: int, num_channels: int, data_type: str
+) -> int:
+    tile_x_range, tile_y_range = xy_tile
+    voxels = (tile_x_range.end - tile_x_range.start) * (tile_y_range.end - tile_y_range.start) * depth
+    dtype = np.dtype(data_type)
+    # float data is normalized into a float32 copy before the original buffer is released
+    voxel_bytes = dtype.itemsize + 4 if dtype.kind == "f" else dtype.itemsize
+    return max(1, voxels * num_channels * voxel_bytes)
+
+
+def calc_read_range(write_range: DimensionRange, ratio: int, write_size: int) -> tuple[int, int]:
+    read_end = -1 if write_range.end >= write_size else write_range.end * ratio
+    return write_range.start * ratio, read_end
+
+
+def convert_image_data(
+    data: ndarray,
+    intensity_windows: list[IntensityWindow] | None = None,
+    output_data_type: str | np.dtype | None = None,
+    buffer_pool: BufferPool | None = None,
+) -> ndarray:
+    """Convert (channel, z, y, x) data to output_data_type, float32 for float data if it is None.
+
+    Integer data already of output_data_type is returned as is unless intensity_windows are given, everything else is
+    normalized with intensity_windows, or with the range of data if it is None. float32 output of writeable float32
+    data is normalized in place, other output is written into a buffer of buffer_pool.
+    """
+    data_type = data.dtype
+    if output_data_type is None:
+        output_dtype = calc_output_dtype(data_type, OutputDataType.AUTO)
+    else:
+        output_dtype = np.dtype(output_data_type)
+    if data_type == output_dtype and data_type.kind != "f" and intensity_windows is None:
         return data
-    data_max, data_min = np.max(data), np.min(data)
-    normalized_data = (data - data_min) / (data_max - data_min)
-    return normalized_data.astype(np.float32)
+    if intensity_windows is None:
+        slab_window = IntensityWindow(min=float(np.nanmin(data)), max=float(np.nanmax(data)))
+        intensity_windows = [slab_window] * data.shape[0]
+    if data_type == output_dtype and data_type.kind == "f" and data.flags.writeable:
+        out = data
+    elif buffer_pool is not None:
+        out = buffer_pool.acquire(data.shape, output_dtype)
+    else:
+        out = np.empty(data.shape, dtype=output_dtype)
+    return normalize_image_data(data, intensity_windows, out)
 
 
 @contextmanager
@@ -239,6 +745,10 @@ def log_time_usage(description: str) -> Iterable[None]:
     try:
         yield
     finally:
-        time_diff_ns = time.perf_counter_ns() - start_time
-        used_time = timedelta(microseconds=time_diff_ns / 1000)
-        logger.info(f"[used {str(used_time)}] {description}")
+        log_used_time(description, start_time)
+
+
+def log_used_time(description: str, start_time: int) -> None:
+    time_diff_ns = time.perf_counter_ns() - start_time
+    used_time = timedelta(microseconds=time_diff_ns / 1000)
+    logger.info(f"[used {str(used_time)}] {description}")
@@ -0,0 +1,48 @@
+import numpy as np
+from numpy import ndarray
+
+from convert_to_precomputed.types import DownsampleMethod
+
+
+def downsample(data: ndarray, factors: tuple[int, ...], method: DownsampleMethod) -> ndarray:
+    """Downsample the trailing len(factors) axes of data, padding incomplete blocks with edge values."""
+    if all(factor == 1 for factor in factors):
+        return data
+    blocks = _split_blocks(data, factors)
+    match method:
+        case DownsampleMethod.MEAN:
+            return _block_mean(blocks, data.dtype)
+        case DownsampleMethod.MODE:
+            return _block_mode(blocks)
+        case _:
+            raise ValueError(f"unknown downsample method {method}")
+
+
+def _split_blocks(data: ndarray, factors: tuple[int, ...]) -> ndarray:
+    lead = data.ndim - len(factors)
+    pad_width = [(0, 0)] * lead + [(0, -size % factor) for size, factor in zip(data.shape[lead:], factors)]
+    if any(after for _, after in pad_width):
+        data = np.pad(data, pad_width, mode="edge")
+
+    shape = list(data.shape[:lead])
+    for size, factor in zip(data.shape[lead:], factors):
+        shape.extend((size // factor, factor))
+    blocks = data.reshape(shape)
+    factor_axes = [lead + 2 * i + 1 for i in range(len(factors))]
+    blocks = np.moveaxis(blocks, factor_axes, list(range(-len(factors), 0)))
+    return blocks.reshape(*blocks.shape[: -len(factors)], -1)
+
+
+def _block_mean(blocks: ndarray, dtype: np.dtype) -> ndarray:
+    if dtype.kind == "f":
+        return blocks.mean(axis=-1, dtype=dtype)
+    mean = blocks.mean(axis=-1, dtype=np.float64)
+    return np.rint(mean, out=mean).astype(dtype)
+
+
+def _block_mode(blocks: ndarray) -> ndarray:
+    counts = np.empty(blocks.shape, dtype=np.uint16)
+    for i in range(blocks.shape[-1]):
+        counts[..., i] = np.count_nonzero(blocks == blocks[..., i : i + 1], axis=-1)
+    winners = np.argmax(counts, axis=-1)
+    return np.take_along_axis(blocks, winners[..., np.newaxis], axis=-1)[..., 0]
@@ -0,0 +1,205 @@
+from dataclasses import astuple
+from pathlib import Path
+from typing import Iterator
+
+import numpy as np
+from loguru import logger
+from numpy import ndarray
+
+from convert_to_precomputed.io_utils import dump_json_atomic, list_dir
+from convert_to_precomputed.types import (
+    ConvertSpec,
+    DimensionRange,
+    ImageRegion,
+    ImageSize,
+    IntensityStats,
+    IntensityWindow,
+    OutputDataType,
+)
+from convert_to_precomputed.zimg_utils import get_image_dtype, read_image_data_v2, read_image_info_v2
+
+INTENSITY_STATS_FILE = "intensity_stats.json"
+STATS_Z_SIZE = 16
+HISTOGRAM_BINS = 1 << 16
+# temporaries of np.histogram per voxel of a channel, float64 offsets and intp bin indices
+HISTOGRAM_VOXEL_BYTES = 16
+
+
+def load_or_compute_intensity_stats(
+    image_path: Path,
+    output_directory: Path,
+    size: ImageSize,
+    percentiles: tuple[float, float],
+    tile_size: int,
+    read_workers: int = 1,
+    memory_budget: int = 4 << 30,
+) -> IntensityStats:
+    """Load intensity_stats.json of output_directory, computing and caching it if missing or made for other input.
+
+    The cache is only used if the image has the same size and its files the same sizes and modification times, so
+    images replaced or appended to in place are measured again.
+    """
+    stats_path = output_directory / INTENSITY_STATS_FILE
+    image_files = calc_image_files_signature(image_path)
+    if stats_path.exists():
+        try:
+            stats = IntensityStats.model_validate_json(stats_path.read_text())
+        except ValueError as e:
+            logger.warning(f"ignore invalid {str(stats_path)}: {e!r}")
+        else:
+            if (
+                stats.image_path == str(image_path)
+                and stats.percentiles == tuple(percentiles)
+                and stats.size == astuple(size)
+                and stats.image_files == image_files
+            ):
+                return stats
+            logger.info(f"{str(stats_path)} was computed for other input, compute it again")
+    image_info = read_image_info_v2(image_path, output_directory)
+    voxel_bytes = get_image_dtype(image_info).itemsize * image_info.numChannels
+    stats = compute_intensity_stats(image_path, size, percentiles, tile_size, voxel_bytes, read_workers, memory_budget)
+    stats = stats.model_copy(update={"size": astuple(size), "image_files": image_files})
+    dump_json_atomic(stats.model_dump(mode="json"), stats_path)
+    logger.info(f"dump {stats=} to {str(stats_path)}")
+    return stats
+
+
+def calc_image_files_signature(image_path: Path | list[Path]) -> list[tuple[str, int, int]]:
+    """Path, size and modification time in nanoseconds of every file of the image."""
+    paths = image_path if isinstance(image_path, list) else [image_path]
+    files = []
+    for path in paths:
+        files.extend(list_dir(path) if path.is_dir() else [path])
+    return [(str(file), (stat := file.stat()).st_size, stat.st_mtime_ns) for file in files]
+
+
+def load_spec_intensity_windows(spec: ConvertSpec) -> list[IntensityWindow] | None:
+    """Intensity windows of all channels if spec converts the image data type, None otherwise."""
+    if not needs_intensity_windows(spec.multiscale.data_type, spec.output_data_type):
+        return None
+    stats = load_or_compute_intensity_stats(
+        Path(spec.image_path),
+        Path(spec.output_directory),
+        ImageSize(x=spec.size.x, y=spec.size.y, z=spec.size.z),
+        spec.intensity_percentiles,
+        spec.tile_size,
+        spec.read_workers,
+    )
+    return stats.channels
+
+
+def calc_output_dtype(data_type: str | np.dtype, output_data_type: OutputDataType) -> np.dtype:
+    """Data type written to precomputed, auto keeps integer data and normalizes float data to float32."""
+    if output_data_type != OutputDataType.AUTO:
+        return np.dtype(output_data_type.value)
+    data_type = np.dtype(data_type)
+    return np.dtype(np.float32) if data_type.kind == "f" else data_type
+
+
+def needs_intensity_windows(data_type: str | np.dtype, output_data_type: OutputDataType) -> bool:
+    """Float data is always normalized, integer data only when an output data type is given explicitly."""
+    return np.dtype(data_type).kind == "f" or output_data_type != OutputDataType.AUTO
+
+
+def compute_intensity_stats(
+    image_path: Path,
+    size: ImageSize,
+    percentiles: tuple[float, float],
+    tile_size: int,
+    voxel_bytes: int,
+    read_workers: int = 1,
+    memory_budget: int = 4 << 30,
+) -> IntensityStats:
+    """Stream the image once for per channel min and max, and once more for a histogram if percentiles are not 0, 100.
+
+    Only STATS_Z_SIZE planes of a tile are held in memory at a time. Without tiles, the planes are read in slabs of as
+    many rows as fit in memory_budget with the histogram temporaries, voxel_bytes is the size of a voxel of all
+    channels. Percentiles are exact up to a histogram bin.
+    """
+    lower_percentile, upper_percentile = percentiles
+    regions = list(_iter_stats_regions(size, tile_size, voxel_bytes, memory_budget))
+    data_min, data_max = None, None
+    for data in _iter_image_data(image_path, regions, read_workers):
+        slab_min = np.nanmin(data.reshape(data.shape[0], -1), axis=1)
+        slab_max = np.nanmax(data.reshape(data.shape[0], -1), axis=1)
+        data_min = slab_min if data_min is None else np.fmin(data_min, slab_min)
+        data_max = slab_max if data_max is None else np.fmax(data_max, slab_max)
+    windows = [IntensityWindow(min=float(low), max=float(high)) for low, high in zip(data_min, data_max)]
+    if (lower_percentile, upper_percentile) == (0.0, 100.0):
+        return IntensityStats(image_path=str(image_path), percentiles=percentiles, channels=windows)
+
+    histograms = np.zeros((len(windows), HISTOGRAM_BINS), dtype=np.int64)
+    for data in _iter_image_data(image_path, regions, read_workers):
+        for channel_index, window in enumerate(windows):
+            counts, _ = np.histogram(data[channel_index], bins=HISTOGRAM_BINS, range=(window.min, window.max))
+            histograms[channel_index] += counts
+    windows = [
+        IntensityWindow(
+            min=_histogram_percentile(histogram, window, lower_percentile, upper_edge=False),
+            max=_histogram_percentile(histogram, window, upper_percentile, upper_edge=True),
+        )
+        for histogram, window in zip(histograms, windows)
+    ]
+    return IntensityStats(image_path=str(image_path), percentiles=percentiles, channels=windows)
+
+
+def normalize_image_data(data: ndarray, windows: list[IntensityWindow], out: ndarray | None = None) -> ndarray:
+    """Map every channel window of data to [0, 1] for float out, or to [0, max] of integer out, plane by plane.
+
+    Without out, float32 data is normalized in place and other data into one new float32 array. Values outside the
+    window (set by percentiles) are clipped, integer output is rounded and NaN becomes 0. Only one float32 plane is
+    allocated as scratch for integer output, no full size temporaries.
+    """
+    if out is None:
+        out = data if data.dtype == np.float32 else np.empty(data.shape, dtype=np.float32)
+    integer_output = out.dtype.kind in "iu"
+    out_max = float(np.iinfo(out.dtype).max) if integer_output else 1.0
+    scratch_plane = np.empty(data.shape[2:], dtype=np.float32) if integer_output else None
+    for channel_index, window in enumerate(windows):
+        window_size = window.max - window.min
+        factor = out_max / window_size if window_size > 0 else 0.0
+        for z in range(data.shape[1]):
+            plane = scratch_plane if integer_output else out[channel_index, z]
+            np.subtract(data[channel_index, z], window.min, out=plane, casting="unsafe")
+            np.multiply(plane, factor, out=plane)
+            np.clip(plane, 0.0, out_max, out=plane)
+            if integer_output:
+                np.nan_to_num(plane, copy=False, nan=0.0)
+                np.rint(plane, out=plane)
+                np.copyto(out[channel_index, z], plane, casting="unsafe")
+    return out
+
+
+def _iter_stats_regions(size: ImageSize, tile_size: int, voxel_bytes: int, memory_budget: int) -> Iterator[ImageRegion]:
+    if tile_size > 0:
+        tile_x, tile_y = tile_size, tile_size
+    else:
+        # whole rows, a slab with the histogram temporaries of one channel stays within memory_budget
+        row_bytes = (voxel_bytes + HISTOGRAM_VOXEL_BYTES) * size.x * STATS_Z_SIZE
+        tile_x, tile_y = size.x, min(size.y, max(1, memory_budget // row_bytes))
+    for z_start in range(0, size.z, STATS_Z_SIZE):
+        z_range = DimensionRange(z_start, min(z_start + STATS_Z_SIZE, size.z))
+        for x_start in range(0, size.x, tile_x):
+            x_range = DimensionRange(x_start, min(x_start + tile_x, size.x))
+            for y_start in range(0, size.y, tile_y):
+                yield ImageRegion(x=x_range, y=DimensionRange(y_start, min(y_start + tile_y, size.y)), z=z_range)
+
+
+def _iter_image_data(image_path: Path, regions: list[ImageRegion], read_workers: int) -> Iterator[ndarray]:
+    for region in regions:
+        x, y, z = region.x, region.y, region.z
+        logger.info(f"intensity statistics z={z.start}-{z.end} xy=({x.start},{y.start})-({x.end},{y.end})")
+        yield read_image_data_v2(
+            image_path, x.start, x.end, y.start, y.end, z.start, z.end, 1, 1, 1, workers=read_workers
+        )
+
+
+def _histogram_percentile(histogram: ndarray, window: IntensityWindow, percentile: float, upper_edge: bool) -> float:
+    if percentile <= 0.0:
+        return window.min
+    if percentile >= 100.0:
+        return window.max
+    cumulative = np.cumsum(histogram)
+    bin_index = int(np.searchsorted(cumulative, cumulative[-1] * percentile / 100.0))
+    bin_width = (window.max - window.min) / len(histogram)
+    return window.min + (bin_index + (1 if upper_edge else 0)) * bin_width
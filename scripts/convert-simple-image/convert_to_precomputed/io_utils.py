@@ -1,4 +1,5 @@
 import json
+import os
 from pathlib import Path
 
 from convert_to_precomputed.types import Json, OsPath
@@ -9,6 +10,16 @@ def dump_json(obj: Json, path: OsPath) -> None:
         json.dump(obj, json_file, indent=2)
 
 
+def dump_json_atomic(obj: Json, path: OsPath) -> None:
+    """Write obj to a temporary file next to path and rename it over path, readers never see a partial file."""
+    temp_path = f"{path}.{os.getpid()}.tmp"
+    with open(temp_path, "w") as json_file:
+        json.dump(obj, json_file)
+        json_file.flush()
+        os.fsync(json_file.fileno())
+    os.replace(temp_path, path)
+
+
 def list_dir(path: Path) -> list[Path]:
     files = [item for item in path.iterdir() if item.is_file()]
     files.sort(key=lambda p: p.name)
@@ -0,0 +1,145 @@
+import functools
+from pathlib import Path
+
+import numpy as np
+from loguru import logger
+from numpy import ndarray
+
+try:
+    import tifffile
+except ImportError:
+    tifffile = None
+
+NRRD_TYPES: dict[str, str] = {
+    "int8": "i1",
+    "signed char": "i1",
+    "uint8": "u1",
+    "uchar": "u1",
+    "unsigned char": "u1",
+    "int16": "i2",
+    "short": "i2",
+    "signed short": "i2",
+    "uint16": "u2",
+    "ushort": "u2",
+    "unsigned short": "u2",
+    "int32": "i4",
+    "int": "i4",
+    "signed int": "i4",
+    "uint32": "u4",
+    "uint": "u4",
+    "unsigned int": "u4",
+    "int64": "i8",
+    "longlong": "i8",
+    "uint64": "u8",
+    "ulonglong": "u8",
+    "float": "f4",
+    "double": "f8",
+}
+NRRD_SPATIAL_KINDS = ("domain", "space")
+
+
+@functools.lru_cache(maxsize=64)
+def open_mmap_image(image_path: Path) -> ndarray | None:
+    """Memory map an uncompressed image as a read-only (channel, z, y, x) view, None if it can not be mapped.
+
+    Raw NRRD (attached or detached header) is parsed here, uncompressed TIFF needs the optional tifffile package.
+    """
+    suffix = image_path.suffix.lower()
+    try:
+        if suffix in (".nrrd", ".nhdr"):
+            return _open_mmap_nrrd(image_path)
+        if suffix in (".tif", ".tiff") and tifffile is not None:
+            return _open_mmap_tiff(image_path)
+    except (ValueError, KeyError, OSError) as e:
+        logger.debug(f"{str(image_path)} is read by zimg, it can not be memory mapped: {e}")
+    return None
+
+
+def read_mmap_region(
+    data: ndarray,
+    x_start: int,
+    x_end: int,
+    y_start: int,
+    y_end: int,
+    z_start: int,
+    z_end: int,
+    x_ratio: int,
+    y_ratio: int,
+    z_ratio: int,
+    channel_start: int = 0,
+    channel_end: int = -1,
+) -> ndarray:
+    """Strided view of the region of memory mapped data, ends of -1 mean the end of the dimension like zimg.
+
+    Big endian data is copied to native byte order, so it is written, hashed and compared like the data read back.
+    """
+    region = data[
+        _region_slice(channel_start, channel_end, 1),
+        _region_slice(z_start, z_end, z_ratio),
+        _region_slice(y_start, y_end, y_ratio),
+        _region_slice(x_start, x_end, x_ratio),
+    ]
+    if not region.dtype.isnative:
+        region = region.astype(region.dtype.newbyteorder("="))
+    return region
+
+
+def _region_slice(start: int, end: int, step: int) -> slice:
+    return slice(start, None if end < 0 else end, step)
+
+
+def _open_mmap_nrrd(image_path: Path) -> ndarray:
+    fields = {}
+    with open(image_path, "rb") as nrrd_file:
+        if not nrrd_file.readline().startswith(b"NRRD"):
+            raise ValueError("missing NRRD magic")
+        while (line := nrrd_file.readline().decode("latin-1").rstrip("\r\n")) != "":
+            key, separator, value = line.partition(": ")
+            if not line.startswith("#") and separator:
+                fields[key.strip().lower()] = value.strip()
+        header_size = nrrd_file.tell()
+
+    if fields.get("encoding") != "raw":
+        raise ValueError(f"encoding {fields.get('encoding')} is not raw")
+    if int(fields.get("line skip", 0)) != 0 or int(fields.get("byte skip", 0)) < 0:
+        raise ValueError("line skip and negative byte skip are not supported")
+    if fields.get("type") not in NRRD_TYPES:
+        raise ValueError(f"unknown type {fields.get('type')}")
+    dtype = np.dtype(NRRD_TYPES[fields["type"]])
+    if dtype.itemsize > 1:
+        dtype = dtype.newbyteorder(">" if fields.get("endian") == "big" else "<")
+
+    data_file = fields.get("data file", fields.get("datafile"))
+    if data_file is None:
+        data_path, offset = image_path, header_size
+    else:
+        data_path, offset = image_path.parent / data_file, 0
+    offset += int(fields.get("byte skip", 0))
+
+    # nrrd lists the fastest axis first, the first axis is channel if its kind is not spatial
+    sizes = [int(size) for size in fields["sizes"].split()]
+    kinds = fields.get("kinds", "").split()
+    data = np.memmap(data_path, dtype=dtype, mode="r", offset=offset, shape=tuple(reversed(sizes)))
+    data = np.moveaxis(data, -1, 0) if kinds and kinds[0] not in NRRD_SPATIAL_KINDS else data[np.newaxis]
+    if data.ndim == 3:
+        data = data[:, np.newaxis]
+    if data.ndim != 4:
+        raise ValueError(f"unsupported sizes {sizes} and kinds {kinds}")
+    return data
+
+
+def _open_mmap_tiff(image_path: Path) -> ndarray:
+    with tifffile.TiffFile(image_path) as tiff_file:
+        series_axes = tiff_file.series[0].axes
+    # raises ValueError for compressed or non contiguous images
+    data = tifffile.memmap(image_path, mode="r")
+
+    # samples are channels, image sequences and unknown page axes are z
+    axes = series_axes.replace("S", "C").replace("I", "Z").replace("Q", "Z")
+    if set(axes) - set("CZYX") or len(set(axes)) != len(axes):
+        raise ValueError(f"unsupported axes {series_axes}")
+    for axis in "ZC":
+        if axis not in axes:
+            data = data[np.newaxis]
+            axes = axis + axes
+    return data.transpose([axes.index(axis) for axis in "CZYX"])
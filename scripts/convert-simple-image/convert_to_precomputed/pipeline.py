@@ -0,0 +1,49 @@
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Iterable, Iterator, Sequence
+
+Stage = Callable[[Any], Any]
+
+_END = object()
+
+
+def iter_pipelined(items: Iterable[Any], stages: Sequence[Stage], max_queued: int) -> Iterator[Any]:
+    """Apply stages to items in order, each stage runs on its own thread with at most max_queued items ahead.
+
+    The consumer of the returned iterator acts as the last stage: while it handles item k, the stage threads already
+    work on the following items, and finished items wait in the queue until they are consumed. max_queued 0 runs all
+    stages inline in the consumer thread.
+    """
+    if max_queued <= 0:
+        for item in items:
+            for stage in stages:
+                item = stage(item)
+            yield item
+        return
+
+    executors = [
+        ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"pipeline_stage_{index}") for index in range(len(stages))
+    ]
+    queued: deque[Future] = deque()
+    items = iter(items)
+    try:
+        while True:
+            while len(queued) < max_queued and (item := next(items, _END)) is not _END:
+                queued.append(_submit_stages(executors, stages, item))
+            if not queued:
+                return
+            yield queued.popleft().result()
+    finally:
+        for executor in executors:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+
+def _submit_stages(executors: list[ThreadPoolExecutor], stages: Sequence[Stage], item: Any) -> Future:
+    future = executors[0].submit(stages[0], item)
+    for executor, stage in zip(executors[1:], stages[1:]):
+        future = executor.submit(_run_after, future, stage)
+    return future
+
+
+def _run_after(previous: Future, stage: Stage) -> Any:
+    return stage(previous.result())
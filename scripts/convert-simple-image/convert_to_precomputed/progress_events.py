@@ -0,0 +1,88 @@
+import json
+import sys
+import time
+
+from convert_to_precomputed.chained_progress import ChainedProgress
+from convert_to_precomputed.types import JsonObject
+
+PROGRESS_EVENT_PREFIX = "@progress "
+
+
+class ProgressReporter:
+    """Print a progress event to stdout at most every every_seconds seconds, a line of PROGRESS_EVENT_PREFIX and JSON.
+
+    Events carry the position in the progress tree, the fraction done, the write throughput since the previous event
+    and the ETA, so the web server follows a conversion without parsing the log. With scale_voxels, the scales at the
+    root of the tree are weighted by their voxels, otherwise every item of a level counts the same.
+    """
+
+    def __init__(self, every_seconds: float, scale_voxels: list[int] | None = None):
+        self.every_seconds: float = every_seconds
+        self.scale_voxels: list[int] | None = scale_voxels
+        self.start_time: float = time.monotonic()
+        self.start_done: float | None = None
+        self.done: float = 0.0
+        self.last_time: float = self.start_time
+        self.voxels: int = 0
+        self.nbytes: int = 0
+
+    def add_block(self, voxels: int, nbytes: int) -> None:
+        self.voxels += voxels
+        self.nbytes += nbytes
+
+    def maybe_report(self, progress: ChainedProgress) -> None:
+        """Called after every finished block write, prints an event when one is due."""
+        now = time.monotonic()
+        if self.start_done is None:
+            # resumed work is done already, ETA only counts the progress made by this run
+            self.start_done, self.start_time, self.last_time = calc_done_fraction(progress, self.scale_voxels), now, now
+            self.voxels, self.nbytes = 0, 0
+        elif now - self.last_time >= self.every_seconds:
+            self.report(progress)
+
+    def report(self, progress: ChainedProgress, done: float | None = None) -> None:
+        now = time.monotonic()
+        if done is None:
+            # slabs of lower scales written by a sweep restart their own levels, done never goes back
+            done = max(calc_done_fraction(progress, self.scale_voxels), self.done)
+        self.done = done
+        elapsed = now - self.start_time
+        start_done = self.start_done or 0.0
+        window = max(now - self.last_time, 1e-6)
+        event = {
+            "levels": calc_levels(progress),
+            "done": round(done, 6),
+            "voxels_per_second": round(self.voxels / window),
+            "mib_per_second": round(self.nbytes / window / 2**20, 2),
+            "elapsed_seconds": round(elapsed, 1),
+            "eta_seconds": round((1.0 - done) * elapsed / (done - start_done), 1) if done > start_done else None,
+        }
+        sys.stdout.write(f"{PROGRESS_EVENT_PREFIX}{json.dumps(event)}\n")
+        sys.stdout.flush()
+        self.last_time, self.voxels, self.nbytes = now, 0, 0
+
+
+def calc_levels(progress: ChainedProgress) -> list[JsonObject]:
+    """Current item of every level from the root down to progress, index counts from 1."""
+    levels = []
+    node = progress
+    while node is not None:
+        levels.append({"name": node.name, "index": node.index, "count": node.count, "description": node.description})
+        node = node.parent
+    levels.reverse()
+    return levels
+
+
+def calc_done_fraction(progress: ChainedProgress, scale_voxels: list[int] | None) -> float:
+    """Fraction of the whole tree done, items of progress still pending count as not done."""
+    fraction = (progress.index - progress.pending) / max(progress.count, 1)
+    node = progress
+    while node.parent is not None:
+        parent = node.parent
+        current = max(parent.index, 1) - 1
+        if parent.parent is None and scale_voxels is not None and len(scale_voxels) == parent.count:
+            fraction = (sum(scale_voxels[:current]) + scale_voxels[current] * fraction) / sum(scale_voxels)
+        else:
+            fraction = (current + fraction) / max(parent.count, 1)
+        node = parent
+    return min(max(fraction, 0.0), 1.0)
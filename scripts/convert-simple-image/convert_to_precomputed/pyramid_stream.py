@@ -0,0 +1,102 @@
+from typing import Callable, Optional
+
+import numpy as np
+from numpy import ndarray
+
+from convert_to_precomputed.downsample import downsample
+from convert_to_precomputed.types import DownsampleMethod, ResolutionRatio, TsScaleMetadata
+
+WriteSlab = Callable[[TsScaleMetadata, ndarray, int, int], None]
+
+
+class ScaleAccumulator:
+    """Downsample z planes coming from the previous scale and flush them as chunk-aligned slabs of one scale.
+
+    Every flushed slab is written through write_slab and then pushed to the next accumulator, so each scale only keeps
+    less than one slab of its own chunk depth (plus fewer than factor.z input planes) in memory.
+    """
+
+    def __init__(
+        self,
+        scale: TsScaleMetadata,
+        factor: ResolutionRatio,
+        z_start: int,
+        write_slab: WriteSlab,
+        method: DownsampleMethod,
+        next_accumulator: Optional["ScaleAccumulator"],
+    ):
+        self.scale: TsScaleMetadata = scale
+        self.factor: ResolutionRatio = factor
+        self.z_start: int = z_start
+        self.write_slab: WriteSlab = write_slab
+        self.method: DownsampleMethod = method
+        self.next_accumulator: Optional[ScaleAccumulator] = next_accumulator
+        self.slab_depth: int = scale["chunk_sizes"][2]
+        self.pending: ndarray | None = None
+        self.buffer: list[ndarray] = []
+        self.buffered_depth: int = 0
+
+    def push(self, data: ndarray) -> None:
+        """Push (channel, z, y, x) planes of the previous scale, flushing every complete slab."""
+        if self.pending is not None:
+            data = np.concatenate([self.pending, data], axis=1)
+        usable_depth = data.shape[1] - data.shape[1] % self.factor.z
+        self.pending = data[:, usable_depth:].copy() if usable_depth < data.shape[1] else None
+        if usable_depth > 0:
+            self._append(self._downsample(data[:, :usable_depth]))
+
+    def finish(self) -> None:
+        """Flush the incomplete trailing slab of this scale and all following scales."""
+        if self.pending is not None:
+            self._append(self._downsample(self.pending))
+            self.pending = None
+        if self.buffered_depth > 0:
+            self._flush(self.buffered_depth)
+        if self.next_accumulator is not None:
+            self.next_accumulator.finish()
+
+    def _downsample(self, data: ndarray) -> ndarray:
+        return downsample(data, (self.factor.z, self.factor.y, self.factor.x), self.method)
+
+    def _append(self, planes: ndarray) -> None:
+        self.buffer.append(planes)
+        self.buffered_depth += planes.shape[1]
+        while self.buffered_depth >= (slab_depth := self._next_slab_depth()):
+            self._flush(slab_depth)
+
+    def _next_slab_depth(self) -> int:
+        return (self.z_start // self.slab_depth + 1) * self.slab_depth - self.z_start
+
+    def _flush(self, depth: int) -> None:
+        buffered = self.buffer[0] if len(self.buffer) == 1 else np.concatenate(self.buffer, axis=1)
+        slab = buffered[:, :depth]
+        self.buffer = [buffered[:, depth:].copy()] if depth < buffered.shape[1] else []
+        self.buffered_depth -= depth
+
+        z_end = self.z_start + depth
+        self.write_slab(self.scale, slab, self.z_start, z_end)
+        self.z_start = z_end
+        if self.next_accumulator is not None:
+            self.next_accumulator.push(slab)
+
+
+def build_accumulator_chain(
+    scales: list[TsScaleMetadata],
+    ratios: list[ResolutionRatio],
+    z_start: int,
+    write_slab: WriteSlab,
+    method: DownsampleMethod,
+) -> ScaleAccumulator:
+    """Chain accumulators of all scales, ratios are relative to the full resolution and z_start is in its voxels."""
+    accumulator = None
+    for index in reversed(range(len(scales))):
+        previous_ratio = ratios[index - 1] if index > 0 else ResolutionRatio(1, 1, 1)
+        factor = ResolutionRatio(
+            x=ratios[index].x // previous_ratio.x,
+            y=ratios[index].y // previous_ratio.y,
+            z=ratios[index].z // previous_ratio.z,
+        )
+        accumulator = ScaleAccumulator(
+            scales[index], factor, z_start // ratios[index].z, write_slab, method, accumulator
+        )
+    return accumulator
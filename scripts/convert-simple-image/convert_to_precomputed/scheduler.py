@@ -0,0 +1,275 @@
+import functools
+import json
+import multiprocessing
+import sys
+from collections import defaultdict
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import asdict
+from pathlib import Path
+from typing import Callable
+
+from loguru import logger
+
+from convert_to_precomputed.completion_log import COMPLETION_LOG_DIRECTORY, CompletionLog, open_completion_log
+from convert_to_precomputed.convert import LOG_FORMAT, convert_single_scale, log_time_usage
+from convert_to_precomputed.intensity import load_spec_intensity_windows
+from convert_to_precomputed.io_utils import dump_json_atomic
+from convert_to_precomputed.sharding import calc_shard_layout
+from convert_to_precomputed.tensorstore_utils import (
+    configure_tensorstore_context,
+    open_tensorstore_to_write,
+    scale_resolution_ratio,
+)
+from convert_to_precomputed.types import (
+    ConvertSpec,
+    DimensionRange,
+    TensorstoreContextOptions,
+    TsScaleMetadata,
+    WorkUnit,
+)
+from convert_to_precomputed.zimg_utils import open_image_source
+
+# completion logs of a worker process by directory and verify, kept across the units it converts
+_completion_logs: dict[tuple[Path, bool], CompletionLog] = {}
+
+
+def run_work_units(
+    spec_path: Path,
+    workers: int,
+    max_retries: int,
+    resume: bool,
+    verify_resume: bool = True,
+    context_options: TensorstoreContextOptions | None = None,
+) -> None:
+    """Convert all units of spec on a process pool, retrying failed units up to max_retries times.
+
+    A unit only starts after the units it downsamples from are done, finished units are recorded in
+    schedule_status.json so a resumed run skips them. Within a retried or resumed unit, blocks in the completion log
+    are skipped, every worker process appends to its own log file. Every process opens its stores in one tensorstore
+    context with context_options.
+    """
+    if context_options is None:
+        context_options = TensorstoreContextOptions()
+    configure_tensorstore_context(context_options)
+    spec = ConvertSpec.model_validate_json(spec_path.read_text())
+    status_path = Path(spec.output_directory) / "schedule_status.json"
+    units = split_work_units(spec)
+    dependencies = find_dependencies(spec, units)
+    done = load_done_units(status_path) if resume else set()
+    pending_count = sum(unit not in done for unit in units)
+    logger.info(f"{len(units)} work units, {len(done)} done, {pending_count} to run with {workers} workers")
+    open_completion_log(Path(spec.output_directory), resume, verify_resume).close()
+
+    if Path(spec.image_path).is_dir():
+        # index the files once here, workers load image_index.json instead of scanning all headers
+        open_image_source(Path(spec.image_path), Path(spec.output_directory))
+    prepare_tensorstores(spec)
+    # computed once here, workers load the cached statistics
+    load_spec_intensity_windows(spec)
+    convert_unit = functools.partial(
+        convert_work_unit, spec.model_dump_json(by_alias=True), verify_resume=verify_resume
+    )
+    failed = run_unit_graph(
+        units,
+        dependencies,
+        done,
+        convert_unit,
+        functools.partial(create_process_pool, workers, context_options),
+        workers,
+        max_retries,
+        status_path,
+    )
+    if failed:
+        raise RuntimeError(f"{len(failed)} of {len(units)} work units failed")
+
+
+def run_unit_graph(
+    units: list[WorkUnit],
+    dependencies: dict[WorkUnit, list[WorkUnit]],
+    done: set[WorkUnit],
+    convert_unit: Callable[[WorkUnit], None],
+    create_pool: Callable[[], ProcessPoolExecutor],
+    workers: int,
+    max_retries: int,
+    status_path: Path,
+) -> set[WorkUnit]:
+    """Run convert_unit for the units not in done on pools of create_pool, the failed units are returned.
+
+    done is updated and saved to status_path as units finish. A pool broken by a dying worker is replaced, the units
+    it was running count as failed attempts.
+    """
+    pending = [unit for unit in units if unit not in done]
+    attempts: dict[WorkUnit, int] = defaultdict(int)
+    failed: set[WorkUnit] = set()
+    running: dict[Future, WorkUnit] = {}
+    executor = create_pool()
+    try:
+        while pending or running:
+            for unit in list(pending):
+                if len(running) >= workers:
+                    break
+                if any(dependency in failed for dependency in dependencies[unit]):
+                    pending.remove(unit)
+                    failed.add(unit)
+                    logger.error(f"{unit} skipped, its dependencies failed")
+                elif all(dependency in done for dependency in dependencies[unit]):
+                    pending.remove(unit)
+                    running[executor.submit(convert_unit, unit)] = unit
+            if not running:
+                break
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            pool_broken = False
+            for future in finished:
+                unit = running.pop(future)
+                try:
+                    future.result()
+                except Exception as e:
+                    pool_broken |= isinstance(e, BrokenProcessPool)
+                    attempts[unit] += 1
+                    if attempts[unit] > max_retries:
+                        failed.add(unit)
+                        logger.error(f"{unit} failed after {attempts[unit]} attempts: {e!r}")
+                    else:
+                        pending.insert(0, unit)
+                        logger.warning(f"{unit} failed, retry {attempts[unit]}/{max_retries}: {e!r}")
+                else:
+                    done.add(unit)
+                    dump_json_atomic([asdict(done_unit) for done_unit in done], status_path)
+                    logger.info(f"{unit} done, {len(done)}/{len(units)}")
+            if pool_broken:
+                logger.warning("worker process died, restart process pool")
+                executor.shutdown(wait=False, cancel_futures=True)
+                executor = create_pool()
+    finally:
+        executor.shutdown(cancel_futures=True)
+    return failed
+
+
+def create_process_pool(workers: int, context_options: TensorstoreContextOptions) -> ProcessPoolExecutor:
+    # tensorstore aborts in forked children of a process that already started its threads
+    return ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=init_worker,
+        initargs=(context_options,),
+    )
+
+
+def init_worker(context_options: TensorstoreContextOptions) -> None:
+    logger.remove()
+    logger.add(sys.stderr, format=LOG_FORMAT)
+    configure_tensorstore_context(context_options)
+
+
+def split_work_units(spec: ConvertSpec) -> list[WorkUnit]:
+    """Split spec into (scale, z slab, channel) units, units never write to the same shard file."""
+    units = []
+    for scale_index, scale in enumerate(spec.scales):
+        scale_dict = scale.model_dump(by_alias=True)
+        z_size = calc_unit_z_size(scale_dict)
+        for z_start in range(0, scale.size[2], z_size):
+            z_end = min(z_start + z_size, scale.size[2])
+            for channel_index in range(spec.multiscale.num_channels):
+                units.append(WorkUnit(scale_index, z_start, z_end, channel_index))
+    return units
+
+
+def calc_unit_z_size(scale: TsScaleMetadata) -> int:
+    layout = calc_shard_layout(scale)
+    if layout is None or layout.wraps:
+        # shard files are shared by far apart chunks, only one process can write the scale
+        return scale["size"][2]
+    return layout.shard_shape.z
+
+
+def find_dependencies(spec: ConvertSpec, units: list[WorkUnit]) -> dict[WorkUnit, list[WorkUnit]]:
+    """Units of the previous scale covering the z range a cascaded unit downsamples from."""
+    if not spec.cascade:
+        return {unit: [] for unit in units}
+    units_by_scale_channel: dict[tuple[int, int], list[WorkUnit]] = defaultdict(list)
+    for unit in units:
+        units_by_scale_channel[(unit.scale_index, unit.channel_index)].append(unit)
+
+    dependencies = {}
+    for unit in units:
+        if unit.scale_index == 0:
+            dependencies[unit] = []
+            continue
+        scale, source_scale = spec.scales[unit.scale_index], spec.scales[unit.scale_index - 1]
+        factor_z = round(scale.resolution[2] / source_scale.resolution[2])
+        source_z_start, source_z_end = unit.z_start * factor_z, min(unit.z_end * factor_z, source_scale.size[2])
+        dependencies[unit] = [
+            source_unit
+            for source_unit in units_by_scale_channel[(unit.scale_index - 1, unit.channel_index)]
+            if source_unit.z_start < source_z_end and source_unit.z_end > source_z_start
+        ]
+    return dependencies
+
+
+def prepare_tensorstores(spec: ConvertSpec) -> None:
+    """Create every scale in the info files up front, concurrent workers would otherwise race on updating them."""
+    multi_scale_metadata = spec.multiscale.model_dump()
+    for channel_index in range(spec.multiscale.num_channels):
+        for scale in spec.scales:
+            open_tensorstore_to_write(
+                f"channel_{channel_index}",
+                Path(spec.output_directory),
+                scale.model_dump(by_alias=True),
+                multi_scale_metadata,
+            )
+
+
+def load_done_units(status_path: Path) -> set[WorkUnit]:
+    if not status_path.exists():
+        return set()
+    try:
+        return {WorkUnit(**unit_dict) for unit_dict in json.loads(status_path.read_text())}
+    except (ValueError, TypeError) as e:
+        # e.g. truncated by a crash of a version writing it in place, the completion log still skips written blocks
+        logger.warning(f"ignore invalid {str(status_path)}: {e!r}")
+        return set()
+
+
+def convert_work_unit(spec_json: str, unit: WorkUnit, verify_resume: bool) -> None:
+    spec = ConvertSpec.model_validate_json(spec_json)
+    if Path(spec.image_path).is_dir():
+        open_image_source(Path(spec.image_path), Path(spec.output_directory))
+    scale = spec.scales[unit.scale_index].model_dump(by_alias=True)
+    ratio = scale_resolution_ratio(scale, spec.resolution)
+    if spec.cascade and unit.scale_index > 0:
+        source_scale = spec.scales[unit.scale_index - 1].model_dump(by_alias=True)
+    else:
+        source_scale = None
+    completion_log = open_worker_completion_log(Path(spec.output_directory) / COMPLETION_LOG_DIRECTORY, verify_resume)
+    with log_time_usage(f"{unit} convert"):
+        convert_single_scale(
+            image_path=Path(spec.image_path),
+            output_directory=Path(spec.output_directory),
+            resolution=spec.resolution,
+            z_range=DimensionRange(unit.z_start * ratio.z, min(unit.z_end * ratio.z, spec.size.z)),
+            write_block_size=spec.write_block_size,
+            scale=scale,
+            multi_scale_metadata=spec.multiscale.model_dump(),
+            scale_progress=None,
+            checkpointer=None,
+            source_scale=source_scale,
+            downsample_method=spec.downsample_method,
+            tile_size=spec.tile_size,
+            channel_index=unit.channel_index,
+            intensity_windows=load_spec_intensity_windows(spec),
+            read_workers=spec.read_workers,
+            completion_log=completion_log,
+        )
+
+
+def open_worker_completion_log(directory: Path, verify: bool) -> CompletionLog:
+    """Completion log shared by the units of this process, loaded once and refreshed with the blocks other workers
+    logged since. Every append is flushed, so the log file is left to be closed when the process exits."""
+    if (completion_log := _completion_logs.get((directory, verify))) is None:
+        completion_log = CompletionLog(directory, verify)
+        _completion_logs[(directory, verify)] = completion_log
+    else:
+        completion_log.refresh()
+    return completion_log
@@ -0,0 +1,99 @@
+import itertools
+import math
+
+from convert_to_precomputed.types import (
+    DimensionRange,
+    ImageSize,
+    JsonObject,
+    ShardingOptions,
+    ShardLayout,
+    TsScaleMetadata,
+)
+
+MINISHARD_INDEX_ENTRY_BYTES = 24
+
+
+def calc_sharding_bits(scale: TsScaleMetadata, voxel_bytes: int, sharding_options: ShardingOptions) -> JsonObject:
+    """preshift_bits, minishard_bits and shard_bits of scale aiming at the target shard and minishard index sizes.
+
+    A shard holds 2 ** (preshift_bits + minishard_bits) chunks, as many as fit in target_shard_bytes uncompressed, and
+    a minishard index lists 2 ** preshift_bits chunks of 24 bytes each. shard_bits covers the rest of the chunk grid,
+    so shards never wrap and small scales get a single shard instead of thousands of near-empty ones.
+    """
+    grid_shape = [(size + chunk - 1) // chunk for size, chunk in zip(scale["size"], scale["chunk_sizes"])]
+    grid_bits = sum((grid - 1).bit_length() for grid in grid_shape)
+    chunk_bytes = math.prod(scale["chunk_sizes"]) * voxel_bytes
+    shard_chunk_bits = min(grid_bits, _floor_log2(sharding_options.target_shard_bytes // chunk_bytes))
+    preshift_bits = min(
+        shard_chunk_bits, _floor_log2(sharding_options.target_minishard_index_bytes // MINISHARD_INDEX_ENTRY_BYTES)
+    )
+    return {
+        "preshift_bits": preshift_bits,
+        "minishard_bits": shard_chunk_bits - preshift_bits,
+        "shard_bits": grid_bits - shard_chunk_bits,
+    }
+
+
+def _floor_log2(value: int) -> int:
+    return max(value, 1).bit_length() - 1
+
+
+def calc_shard_layout(scale: TsScaleMetadata) -> ShardLayout | None:
+    """Voxel shape of the chunk box sharing one shard, None if the shards are not spatially contiguous.
+
+    With the identity hash, the shard of a chunk is its compressed morton code shifted right by preshift_bits and
+    minishard_bits, so every shard holds a box of chunks whose axes get those low morton bits. If shard_bits is too
+    small for the whole grid, several such boxes wrap into the same shard file.
+    """
+    sharding = scale.get("sharding")
+    if not sharding or sharding["hash"] != "identity":
+        return None
+
+    chunk_shape = ImageSize(*scale["chunk_sizes"])
+    grid_shape = [(size + chunk - 1) // chunk for size, chunk in zip(scale["size"], scale["chunk_sizes"])]
+    axis_bits = [(grid - 1).bit_length() for grid in grid_shape]
+    box_bits = [0, 0, 0]
+    remaining_bits = sharding["preshift_bits"] + sharding["minishard_bits"]
+    for level in range(max(axis_bits)):
+        for axis in range(3):
+            if level < axis_bits[axis] and remaining_bits > 0:
+                box_bits[axis] += 1
+                remaining_bits -= 1
+
+    shard_shape = ImageSize(*(chunk << bits for chunk, bits in zip(scale["chunk_sizes"], box_bits)))
+    wraps = sum(axis_bits) > sharding["preshift_bits"] + sharding["minishard_bits"] + sharding["shard_bits"]
+    return ShardLayout(chunk_shape=chunk_shape, shard_shape=shard_shape, wraps=wraps)
+
+
+def calc_shard_block_ranges(
+    x_range: DimensionRange, y_range: DimensionRange, block_size: int, layout: ShardLayout | None
+) -> list[tuple[DimensionRange, DimensionRange]]:
+    """XY blocks aligned to block_size covering the ranges, grouped shard by shard without crossing shard borders."""
+    if layout is None:
+        return list(
+            itertools.product(_calc_aligned_ranges(x_range, block_size), _calc_aligned_ranges(y_range, block_size))
+        )
+    blocks = []
+    for shard_x_range, shard_y_range in itertools.product(
+        _calc_aligned_ranges(x_range, layout.shard_shape.x), _calc_aligned_ranges(y_range, layout.shard_shape.y)
+    ):
+        blocks.extend(calc_shard_block_ranges(shard_x_range, shard_y_range, block_size, None))
+    return blocks
+
+
+def calc_shard_tiles(scale: TsScaleMetadata, layout: ShardLayout) -> list[tuple[DimensionRange, DimensionRange]]:
+    """XY footprints of all shard boxes of scale."""
+    x_range, y_range = DimensionRange(0, scale["size"][0]), DimensionRange(0, scale["size"][1])
+    return list(
+        itertools.product(
+            _calc_aligned_ranges(x_range, layout.shard_shape.x), _calc_aligned_ranges(y_range, layout.shard_shape.y)
+        )
+    )
+
+
+def _calc_aligned_ranges(dimension_range: DimensionRange, step: int) -> list[DimensionRange]:
+    aligned_starts = range(dimension_range.start // step * step, dimension_range.end, step)
+    return [
+        DimensionRange(max(start, dimension_range.start), min(start + step, dimension_range.end))
+        for start in aligned_starts
+    ]
@@ -1,4 +1,5 @@
 import math
+import threading
 from dataclasses import astuple
 from pathlib import Path
 
@@ -6,13 +7,18 @@ import numpy as np
 import tensorstore as ts
 from deprecation import deprecated
 
+from convert_to_precomputed.sharding import calc_sharding_bits
 from convert_to_precomputed.types import (
+    ChunkEncoding,
+    EncodingOptions,
     ImageResolution,
     ImageSize,
     JsonObject,
     MultiscaleMetadata,
     ResolutionPM,
     ResolutionRatio,
+    ShardingOptions,
+    TensorstoreContextOptions,
     TsScaleMetadata,
 )
 from vendor.neuroglancer_scripts_dyadic_pyramid import fill_scales_for_dyadic_pyramid
@@ -27,13 +33,33 @@ DEFAULT_SHARDING_ARG: JsonObject = {
     "shard_bits": 15,
 }
 
+_context = ts.Context()
+_stores: dict[tuple[str, str, str, tuple[float, ...]], ts.TensorStore] = {}
+_stores_lock = threading.Lock()
 
-def build_scales_dyadic_pyramid(resolution: ImageResolution | ResolutionPM, size: ImageSize) -> list[TsScaleMetadata]:
+
+def build_scales_dyadic_pyramid(
+    resolution: ImageResolution | ResolutionPM,
+    size: ImageSize,
+    encoding_options: EncodingOptions | None = None,
+    voxel_bytes: int = 1,
+    sharding_options: ShardingOptions | None = None,
+) -> list[TsScaleMetadata]:
+    """Scales of a dyadic pyramid, sharding bits of each scale are tuned for voxel_bytes (all channels) per voxel."""
+    if encoding_options is None:
+        encoding_options = EncodingOptions()
+    if sharding_options is None:
+        sharding_options = ShardingOptions()
     init_scale_info = {
-        "encoding": "raw",
-        "sharding": DEFAULT_SHARDING_ARG,
+        "encoding": encoding_options.encoding.value,
+        "sharding": {
+            **DEFAULT_SHARDING_ARG,
+            "data_encoding": encoding_options.data_encoding.value,
+            "minishard_index_encoding": encoding_options.minishard_index_encoding.value,
+        },
         "resolution": [resolution.x, resolution.y, resolution.z],
         "size": list(astuple(size)),
+        **build_encoding_metadata(encoding_options),
     }
     info_dict = {"scales": [init_scale_info]}
 
@@ -41,9 +67,36 @@ def build_scales_dyadic_pyramid(resolution: ImageResolution | ResolutionPM, size
     assert math.log2(target_chunk_size).is_integer()
     max_scales = round(math.log2(target_chunk_size)) + 1
     fill_scales_for_dyadic_pyramid(info_dict, target_chunk_size=target_chunk_size, max_scales=max_scales)
+    for scale in info_dict["scales"]:
+        scale["sharding"] = {**scale["sharding"], **calc_sharding_bits(scale, voxel_bytes, sharding_options)}
     return info_dict["scales"]
 
 
+def build_encoding_metadata(encoding_options: EncodingOptions) -> JsonObject:
+    """Scale metadata members of the chunk encoding, gzip levels are not configurable in tensorstore."""
+    match encoding_options.encoding:
+        case ChunkEncoding.JPEG:
+            return {"jpeg_quality": encoding_options.jpeg_quality}
+        case ChunkEncoding.PNG:
+            return {"png_level": encoding_options.png_level}
+        case ChunkEncoding.COMPRESSED_SEGMENTATION:
+            return {"compressed_segmentation_block_size": [8, 8, 8]}
+        case _:
+            return {}
+
+
+def check_encoding(encoding: ChunkEncoding, data_type: str | np.dtype, num_channels: int) -> None:
+    """Raise ValueError before converting if the chunk encoding can not store data_type and num_channels."""
+    data_type = np.dtype(data_type)
+    match encoding:
+        case ChunkEncoding.JPEG if data_type != np.uint8 or num_channels not in (1, 3):
+            raise ValueError(f"jpeg encoding needs uint8 data of 1 or 3 channels, not {data_type} of {num_channels}")
+        case ChunkEncoding.PNG if data_type not in (np.uint8, np.uint16) or num_channels > 4:
+            raise ValueError(f"png encoding needs uint8 or uint16 data of 1 to 4 channels, not {data_type}")
+        case ChunkEncoding.COMPRESSED_SEGMENTATION if data_type not in (np.uint32, np.uint64):
+            raise ValueError(f"compressed_segmentation encoding needs uint32 or uint64 data, not {data_type}")
+
+
 @deprecated(details="use build_multiscale_metadata_v2")
 def build_multiscale_metadata(dtype: np.dtype, num_channels: int) -> JsonObject:
     return {"data_type": str(dtype), "num_channels": num_channels, "type": "image"}
@@ -64,10 +117,40 @@ def scale_resolution_ratio(
     )
 
 
+def configure_tensorstore_context(options: TensorstoreContextOptions) -> None:
+    """Open all following stores in one context with the cache and concurrency limits of options.
+
+    Stores opened before are dropped from the cache, so a new conversion never uses stores of deleted outputs.
+    """
+    global _context
+    context_spec = {"cache_pool": {"total_bytes_limit": options.cache_pool_bytes}}
+    if options.data_copy_concurrency > 0:
+        context_spec["data_copy_concurrency"] = {"limit": options.data_copy_concurrency}
+    if options.file_io_concurrency > 0:
+        context_spec["file_io_concurrency"] = {"limit": options.file_io_concurrency}
+    with _stores_lock:
+        _context = ts.Context(context_spec)
+        _stores.clear()
+
+
 def open_tensorstore_to_write(
     channel_name: str, output_directory: Path, scale: TsScaleMetadata, multi_scale_metadata: JsonObject
 ) -> ts.TensorStore:
-    scale_metadata = {k: v for k, v in scale.items() if k != "chunk_sizes"}
+    """Cached store of the scale, opened once per (channel, scale) so the info file is only read once."""
+    store_key = ("write", str(output_directory), channel_name, tuple(scale["resolution"]))
+    with _stores_lock:
+        if (store := _stores.get(store_key)) is None:
+            store = _open_tensorstore_to_write(channel_name, output_directory, scale, multi_scale_metadata)
+            _stores[store_key] = store
+    return store
+
+
+def _open_tensorstore_to_write(
+    channel_name: str, output_directory: Path, scale: TsScaleMetadata, multi_scale_metadata: JsonObject
+) -> ts.TensorStore:
+    scale_metadata = {k: v for k, v in scale.items() if k != "chunk_sizes" and v is not None}
+    # writes are scheduled on the chunk and shard grid of chunk_sizes, so the store must use the same chunks
+    scale_metadata["chunk_size"] = scale["chunk_sizes"]
     spec = {
         "driver": "neuroglancer_precomputed",
         "kvstore": {"driver": "file", "path": str(output_directory)},
@@ -77,4 +160,30 @@ def open_tensorstore_to_write(
         "open": True,
         "create": True,
     }
-    return ts.open(spec).result()
+    return ts.open(spec, context=_context).result()
+
+
+def open_tensorstore_to_read(channel_name: str, output_directory: Path, scale: TsScaleMetadata) -> ts.TensorStore:
+    """Cached read only store of the scale, like open_tensorstore_to_write."""
+    store_key = ("read", str(output_directory), channel_name, tuple(scale["resolution"]))
+    with _stores_lock:
+        if (store := _stores.get(store_key)) is None:
+            store = _open_tensorstore_to_read(channel_name, output_directory, scale)
+            _stores[store_key] = store
+    return store
+
+
+def _open_tensorstore_to_read(channel_name: str, output_directory: Path, scale: TsScaleMetadata) -> ts.TensorStore:
+    spec = {
+        "driver": "neuroglancer_precomputed",
+        "kvstore": {"driver": "file", "path": str(output_directory)},
+        "path": channel_name,
+        "scale_metadata": {"resolution": scale["resolution"]},
+        "open": True,
+    }
+    return ts.open(spec, read=True, context=_context).result()
+
+
+def select_channel_zyx(store: ts.TensorStore, channel_index: int) -> ts.TensorStore:
+    """View of one channel with dimensions in z, y, x order, matching C-order (z, y, x) arrays without transposing."""
+    return store[ts.d["channel"][channel_index]][ts.d["z", "y", "x"].transpose[:]]
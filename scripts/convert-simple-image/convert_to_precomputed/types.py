@@ -1,4 +1,5 @@
 from dataclasses import dataclass
+from enum import Enum
 from pathlib import Path
 from typing import TypeAlias, TypeVar
 
@@ -41,6 +42,37 @@ class ImageRegion:
     z: DimensionRange
 
 
+@dataclass
+class ShardLayout:
+    chunk_shape: ImageSize
+    shard_shape: ImageSize
+    wraps: bool
+
+
+class DownsampleMethod(str, Enum):
+    MEAN = "mean"
+    MODE = "mode"
+
+
+class ChunkEncoding(str, Enum):
+    RAW = "raw"
+    JPEG = "jpeg"
+    PNG = "png"
+    COMPRESSED_SEGMENTATION = "compressed_segmentation"
+
+
+class ShardEncoding(str, Enum):
+    RAW = "raw"
+    GZIP = "gzip"
+
+
+class OutputDataType(str, Enum):
+    AUTO = "auto"
+    FLOAT32 = "float32"
+    UINT8 = "uint8"
+    UINT16 = "uint16"
+
+
 JsonString: TypeAlias = str
 JsonNumber: TypeAlias = int | float
 JsonNull: TypeAlias = type(None)
@@ -84,6 +116,29 @@ class ScaleMetadata(BaseModel):
     resolution: list[float]
     size: list[int]
     chunk_sizes: list[int]
+    jpeg_quality: int | None = None
+    png_level: int | None = None
+    compressed_segmentation_block_size: list[int] | None = None
+
+
+class ShardingOptions(BaseModel):
+    target_shard_bytes: int = 2 << 30
+    target_minishard_index_bytes: int = 12 << 10
+
+
+class TensorstoreContextOptions(BaseModel):
+    # 0 keeps the tensorstore default of the resource
+    cache_pool_bytes: int = 256 << 20
+    data_copy_concurrency: int = 0
+    file_io_concurrency: int = 0
+
+
+class EncodingOptions(BaseModel):
+    encoding: ChunkEncoding = ChunkEncoding.RAW
+    jpeg_quality: int = 75
+    png_level: int = 6
+    data_encoding: ShardEncoding = ShardEncoding.GZIP
+    minishard_index_encoding: ShardEncoding = ShardEncoding.GZIP
 
 
 class MultiscaleMetadata(BaseModel):
@@ -92,6 +147,34 @@ class MultiscaleMetadata(BaseModel):
     type: str
 
 
+class IntensityWindow(BaseModel):
+    min: float
+    max: float
+
+
+class IntensityStats(BaseModel):
+    image_path: str
+    percentiles: tuple[float, float]
+    channels: list[IntensityWindow]
+    size: tuple[int, int, int] = (0, 0, 0)
+    image_files: list[tuple[str, int, int]] = []
+
+
+class ImageFileEntry(BaseModel):
+    name: str
+    z_start: int
+    z_count: int
+    data_type: str
+    shape: tuple[int, int, int]
+    mtime_ns: int
+    size: int
+
+
+class ImageIndex(BaseModel):
+    image_directory: str
+    files: list[ImageFileEntry]
+
+
 class ConvertSpec(BaseModel):
     image_path: str
     output_directory: str
@@ -100,3 +183,28 @@ class ConvertSpec(BaseModel):
     size: SizePM
     multiscale: MultiscaleMetadata
     scales: list[ScaleMetadata]
+    cascade: bool = False
+    downsample_method: DownsampleMethod = DownsampleMethod.MEAN
+    tile_size: int = 0
+    intensity_percentiles: tuple[float, float] = (0.0, 100.0)
+    output_data_type: OutputDataType = OutputDataType.AUTO
+    read_workers: int = 1
+    encoding_options: EncodingOptions = EncodingOptions()
+    sharding_options: ShardingOptions = ShardingOptions()
+
+
+@dataclass(frozen=True)
+class WorkUnit:
+    scale_index: int
+    z_start: int
+    z_end: int
+    channel_index: int
+
+
+@dataclass
+class EncodingBenchmark:
+    name: str
+    input_bytes: int
+    output_bytes: int
+    write_seconds: float
+    read_seconds: float
@@ -1,12 +1,22 @@
+import bisect
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
 from pathlib import Path
 from typing import Iterable
 
 import numpy as np
 from deprecation import deprecated
+from loguru import logger
 from numpy import ndarray
 from zimg import Dimension, VoxelSizeUnit, ZImg, ZImgInfo, ZImgRegion, ZVoxelCoordinate
 
+from convert_to_precomputed.io_utils import dump_json_atomic, list_dir
+from convert_to_precomputed.mmap_reader import open_mmap_image, read_mmap_region
 from convert_to_precomputed.types import (
+    ImageFileEntry,
+    ImageIndex,
     ImageRegion,
     ImageResolution,
     ImageSize,
@@ -29,12 +39,138 @@ def read_image_info(image_path: OsPath | Iterable[OsPath]) -> ZImgInfo:
     return result
 
 
+IMAGE_INDEX_FILE = "image_index.json"
+
+_image_sources: dict[Path, "ImageSource"] = {}
+_image_sources_lock = threading.Lock()
+
+
+class ImageDirectoryInfo:
+    """ZImgInfo of the first file of an image directory with the depth of all its files.
+
+    ZImgInfo is a pybind object whose attributes are not known to be writable, so the depth is kept here and every
+    other attribute is read from the first file's info.
+    """
+
+    def __init__(self, first_info: ZImgInfo, depth: int):
+        self.first_info: ZImgInfo = first_info
+        self.depth: int = depth
+
+    def __getattr__(self, name: str):
+        return getattr(self.first_info, name)
+
+    def __repr__(self) -> str:
+        return f"ImageDirectoryInfo(depth={self.depth}, first_info={self.first_info!r})"
+
+
+@dataclass
+class ImageSource:
+    """Files of an image directory sorted by name, the z range each of them covers and the info of the whole image."""
+
+    file_paths: list[str]
+    file_z_starts: list[int]
+    depth: int
+    first_info: ZImgInfo
+
+    @property
+    def info(self) -> ImageDirectoryInfo:
+        return ImageDirectoryInfo(self.first_info, self.depth)
+
+    def overlapping_files(self, z_start: int, z_end: int) -> tuple[list[str], int]:
+        """Files covering [z_start, z_end) and the z offset of the first one, z_end -1 means the end of image."""
+        if z_end < 0:
+            z_end = self.depth
+        first_index = bisect.bisect_right(self.file_z_starts, z_start) - 1
+        end_index = bisect.bisect_left(self.file_z_starts, z_end)
+        return self.file_paths[first_index:end_index], self.file_z_starts[first_index]
+
+
+def open_image_source(image_directory: Path, output_directory: Path | None = None) -> ImageSource:
+    """Cached source of image_directory, built from output_directory/image_index.json if it is given.
+
+    The first open in a process decides the source, later opens with or without output_directory return it.
+    """
+    with _image_sources_lock:
+        if (source := _image_sources.get(image_directory)) is None:
+            if output_directory is None:
+                image_index = build_image_index(image_directory, None)
+            else:
+                image_index = load_or_build_image_index(image_directory, output_directory / IMAGE_INDEX_FILE)
+            source = _image_index_2_source(image_directory, image_index)
+            _image_sources[image_directory] = source
+    return source
+
+
+def load_or_build_image_index(image_directory: Path, index_path: Path) -> ImageIndex:
+    """Load index_path, re-reading headers only of the files whose name, mtime or size changed, and save it."""
+    previous_index = None
+    if index_path.exists():
+        try:
+            previous_index = ImageIndex.model_validate_json(index_path.read_text())
+        except ValueError as e:
+            logger.warning(f"ignore invalid {str(index_path)}: {e!r}")
+        if previous_index is not None and previous_index.image_directory != str(image_directory):
+            previous_index = None
+    image_index = build_image_index(image_directory, previous_index)
+    if image_index != previous_index:
+        index_path.parent.mkdir(parents=True, exist_ok=True)
+        dump_json_atomic(image_index.model_dump(mode="json"), index_path)
+        logger.info(f"dump index of {len(image_index.files)} files to {str(index_path)}")
+    return image_index
+
+
+# noinspection PyTypeChecker
+def build_image_index(image_directory: Path, previous_index: ImageIndex | None) -> ImageIndex:
+    """Index the files of image_directory, reusing entries of previous_index whose file is unchanged."""
+    previous_entries = {} if previous_index is None else {entry.name: entry for entry in previous_index.files}
+    entries = []
+    z_start = 0
+    parsed_count = 0
+    for path in list_dir(image_directory):
+        stat = path.stat()
+        entry = previous_entries.get(path.name)
+        if entry is None or entry.mtime_ns != stat.st_mtime_ns or entry.size != stat.st_size:
+            file_info = ZImg.readImgInfos(str(path), catDim=Dimension.Z, catScenes=True)[0]
+            entry = ImageFileEntry(
+                name=path.name,
+                z_start=0,
+                z_count=file_info.depth,
+                data_type=file_info.dataTypeString(),
+                shape=(file_info.width, file_info.height, file_info.numChannels),
+                mtime_ns=stat.st_mtime_ns,
+                size=stat.st_size,
+            )
+            parsed_count += 1
+        entries.append(entry.model_copy(update={"z_start": z_start}))
+        z_start += entry.z_count
+    if not entries:
+        raise ValueError(f"no image file in {image_directory}")
+    for entry in entries:
+        if (entry.data_type, entry.shape) != (entries[0].data_type, entries[0].shape):
+            raise ValueError(f"{entry.name} differs from {entries[0].name} in data type or xy size and channels")
+    logger.info(f"indexed {len(entries)} files of {str(image_directory)}, read {parsed_count} headers")
+    return ImageIndex(image_directory=str(image_directory), files=entries)
+
+
+# noinspection PyTypeChecker
+def _image_index_2_source(image_directory: Path, image_index: ImageIndex) -> ImageSource:
+    # all files share xy size, channels and data type, only the depth differs from the first file's info
+    first_info = ZImg.readImgInfos(
+        str(image_directory / image_index.files[0].name), catDim=Dimension.Z, catScenes=True
+    )[0]
+    return ImageSource(
+        file_paths=[str(image_directory / entry.name) for entry in image_index.files],
+        file_z_starts=[entry.z_start for entry in image_index.files],
+        depth=sum(entry.z_count for entry in image_index.files),
+        first_info=first_info,
+    )
+
+
 # noinspection PyTypeChecker
-def read_image_info_v2(image_path: OsPath) -> ZImgInfo:
+def read_image_info_v2(image_path: OsPath, output_directory: Path | None = None) -> ZImgInfo | ImageDirectoryInfo:
     image_path = Path(image_path)
     if image_path.is_dir():
-        image_paths = [str(path) for path in image_path.iterdir() if path.is_file()]
-        image_infos = ZImg.readImgInfos(image_paths, catDim=Dimension.Z, catScenes=True)
+        return open_image_source(image_path, output_directory).info
     elif image_path.is_file():
         image_infos = ZImg.readImgInfos(str(image_path))
     else:
@@ -108,15 +244,117 @@ def read_image_data_v2(
     x_ratio: int,
     y_ratio: int,
     z_ratio: int,
+    channel_start: int = 0,
+    channel_end: int = -1,
+    workers: int = 1,
 ) -> ndarray:
+    """Read (channel, z, y, x) data, with workers > 1 the files of a directory are decoded concurrently.
+
+    Uncompressed files are memory mapped instead of decoded by zimg, a single file returns a read-only strided view.
+    """
     image_path = Path(image_path)
+    if image_path.is_dir():
+        source = open_image_source(image_path)
+        mmap_data = _read_files_mmap(
+            source,
+            x_start,
+            x_end,
+            y_start,
+            y_end,
+            z_start,
+            z_end,
+            x_ratio,
+            y_ratio,
+            z_ratio,
+            channel_start,
+            channel_end,
+        )
+        if mmap_data is not None:
+            return mmap_data
+        if workers > 1:
+            return _read_files_parallel(
+                source,
+                x_start,
+                x_end,
+                y_start,
+                y_end,
+                z_start,
+                z_end,
+                x_ratio,
+                y_ratio,
+                z_ratio,
+                channel_start,
+                channel_end,
+                workers,
+            )
+        # only the files overlapping the z range are opened, the region is shifted to the first of them
+        zimg_paths, z_offset = source.overlapping_files(z_start, z_end)
+        zimg_options = {"catDim": Dimension.Z, "catScenes": True}
+    elif (mmap_data := open_mmap_image(image_path)) is not None:
+        return read_mmap_region(
+            mmap_data,
+            x_start,
+            x_end,
+            y_start,
+            y_end,
+            z_start,
+            z_end,
+            x_ratio,
+            y_ratio,
+            z_ratio,
+            channel_start,
+            channel_end,
+        )
+    else:
+        zimg_paths, z_offset, zimg_options = str(image_path), 0, {}
     zimg_region = ZImgRegion(
-        ZVoxelCoordinate(x_start, y_start, z_start, 0, 0), ZVoxelCoordinate(x_end, y_end, z_end, -1, -1)
+        ZVoxelCoordinate(x_start, y_start, z_start - z_offset, channel_start, 0),
+        ZVoxelCoordinate(x_end, y_end, z_end - z_offset if z_end >= 0 else -1, channel_end, -1),
     )
-    if image_path.is_dir():
-        image_paths = [str(path) for path in image_path.iterdir() if path.is_file()]
+    zimg = ZImg(zimg_paths, region=zimg_region, xRatio=x_ratio, yRatio=y_ratio, zRatio=z_ratio, **zimg_options)
+    # zimg data is already C-order (channel, z, y, x), keep its buffer instead of copying the whole slab
+    return np.ascontiguousarray(zimg.data[0])
+
+
+def _read_files_parallel(
+    source: ImageSource,
+    x_start: int,
+    x_end: int,
+    y_start: int,
+    y_end: int,
+    z_start: int,
+    z_end: int,
+    x_ratio: int,
+    y_ratio: int,
+    z_ratio: int,
+    channel_start: int,
+    channel_end: int,
+    workers: int,
+) -> ndarray:
+    """Decode the file groups of a slab on a thread pool and copy them into one preallocated slab."""
+    if z_end < 0:
+        z_end = source.depth
+    # output planes are grouped by the files their z_ratio input planes come from, so every group is decoded
+    # by one ZImg call exactly as reading the whole slab would, and one plane per file stacks get a group per file
+    groups: list[tuple[list[str], int, int, int]] = []
+    for out_index in range((z_end - z_start + z_ratio - 1) // z_ratio):
+        plane_start = z_start + out_index * z_ratio
+        files, z_offset = source.overlapping_files(plane_start, min(plane_start + z_ratio, z_end))
+        if groups and groups[-1][0] == files:
+            groups[-1] = (files, z_offset, groups[-1][2], out_index + 1)
+        else:
+            groups.append((files, z_offset, out_index, out_index + 1))
+
+    def read_group(group: tuple[list[str], int, int, int]) -> ndarray:
+        files, z_offset, out_start, out_end = group
+        group_z_start = z_start + out_start * z_ratio
+        group_z_end = min(z_start + out_end * z_ratio, z_end)
+        zimg_region = ZImgRegion(
+            ZVoxelCoordinate(x_start, y_start, group_z_start - z_offset, channel_start, 0),
+            ZVoxelCoordinate(x_end, y_end, group_z_end - z_offset, channel_end, -1),
+        )
         zimg = ZImg(
-            image_paths,
+            files,
             catDim=Dimension.Z,
             catScenes=True,
             region=zimg_region,
@@ -124,9 +362,73 @@ def read_image_data_v2(
             yRatio=y_ratio,
             zRatio=z_ratio,
         )
-    else:
-        zimg = ZImg(str(image_path), region=zimg_region, xRatio=x_ratio, yRatio=y_ratio, zRatio=z_ratio)
-    return zimg.data[0].copy(order="C")
+        return zimg.data[0]
+
+    futures = [_decode_executor(workers).submit(read_group, group) for group in groups]
+    slab = None
+    try:
+        for (_, _, out_start, out_end), future in zip(groups, futures):
+            group_data = future.result()
+            if slab is None:
+                slab = np.empty((group_data.shape[0], groups[-1][3], *group_data.shape[2:]), dtype=group_data.dtype)
+            slab[:, out_start:out_end] = group_data
+    finally:
+        for future in futures:
+            future.cancel()
+    return slab
+
+
+def _read_files_mmap(
+    source: ImageSource,
+    x_start: int,
+    x_end: int,
+    y_start: int,
+    y_end: int,
+    z_start: int,
+    z_end: int,
+    x_ratio: int,
+    y_ratio: int,
+    z_ratio: int,
+    channel_start: int,
+    channel_end: int,
+) -> ndarray | None:
+    """Stack the strided views of the files overlapping the slab, None if any of them can not be memory mapped."""
+    if z_end < 0:
+        z_end = source.depth
+    file_paths, _ = source.overlapping_files(z_start, z_end)
+    first_index = bisect.bisect_right(source.file_z_starts, z_start) - 1
+    file_z_starts = source.file_z_starts[first_index : first_index + len(file_paths)]
+    file_z_ends = source.file_z_starts[first_index + 1 : first_index + len(file_paths)] + [source.depth]
+    views = []
+    for file_path, file_z_start, file_z_end in zip(file_paths, file_z_starts, file_z_ends):
+        if (mmap_data := open_mmap_image(Path(file_path))) is None:
+            return None
+        # first plane on the z_ratio grid of the slab inside this file
+        plane_start = z_start + -(-max(file_z_start - z_start, 0) // z_ratio) * z_ratio
+        if plane_start >= min(z_end, file_z_end):
+            continue
+        views.append(
+            read_mmap_region(
+                mmap_data,
+                x_start,
+                x_end,
+                y_start,
+                y_end,
+                plane_start - file_z_start,
+                min(z_end, file_z_end) - file_z_start,
+                x_ratio,
+                y_ratio,
+                z_ratio,
+                channel_start,
+                channel_end,
+            )
+        )
+    return views[0] if len(views) == 1 else np.concatenate(views, axis=1)
+
+
+@functools.cache
+def _decode_executor(workers: int) -> ThreadPoolExecutor:
+    return ThreadPoolExecutor(max_workers=workers, thread_name_prefix="decode")
 
 
 def _region_2_zimg(region: ImageRegion) -> ZImgRegion:
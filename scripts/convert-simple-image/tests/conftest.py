@@ -0,0 +1,43 @@
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+NRRD_TYPE_NAMES = {"u1": "uint8", "u2": "uint16", "i2": "int16", "u4": "uint32", "f4": "float", "f8": "double"}
+
+
+def write_nrrd(
+    path: Path, data: np.ndarray, detached: bool = False, fields: dict[str, str | None] | None = None
+) -> Path:
+    """Write (channel, z, y, x) data as raw NRRD in its byte order, fields replace header fields, None removes one."""
+    if data.shape[0] == 1:
+        file_data, sizes, kinds = data[0], data.shape[:0:-1], None
+    else:
+        # the channel axis is the fastest, it comes first in sizes
+        file_data, sizes, kinds = (
+            np.moveaxis(data, 0, -1),
+            (data.shape[0], *data.shape[:0:-1]),
+            "list domain domain domain",
+        )
+    file_bytes = np.ascontiguousarray(file_data).tobytes()
+    header = {
+        "type": NRRD_TYPE_NAMES[data.dtype.str[1:]],
+        "dimension": str(len(sizes)),
+        "sizes": " ".join(map(str, sizes)),
+        "kinds": kinds,
+        "encoding": "raw",
+        "endian": "big" if data.dtype.byteorder == ">" else "little",
+    }
+    if detached:
+        data_path = path.with_suffix(".raw")
+        data_path.write_bytes(file_bytes)
+        header["data file"] = data_path.name
+    header.update(fields or {})
+    lines = "".join(f"{key}: {value}\n" for key, value in header.items() if value is not None)
+    path.write_bytes(f"NRRD0004\n{lines}\n".encode("latin-1") + (b"" if detached else file_bytes))
+    return path
+
+
+@pytest.fixture
+def nrrd_writer():
+    return write_nrrd
@@ -0,0 +1,46 @@
+import numpy as np
+
+from convert_to_precomputed.buffer_pool import BufferPool
+
+
+def test_released_buffer_is_reused_for_the_same_shape_and_dtype():
+    pool = BufferPool(1 << 20)
+    buffer = pool.acquire((2, 16, 16), np.uint16)
+    pool.release(buffer)
+
+    assert pool.acquire((2, 16, 16), np.uint16) is buffer
+    assert pool.acquire((2, 16, 16), np.uint16) is not buffer
+    assert pool.acquire((2, 16, 16), np.uint8) is not buffer
+
+
+def test_arrays_not_from_the_pool_are_ignored():
+    pool = BufferPool(1 << 20)
+    foreign = np.empty((2, 16, 16), dtype=np.uint16)
+    pool.release(foreign)
+
+    assert pool.acquire((2, 16, 16), np.uint16) is not foreign
+    assert pool.free_bytes == 0
+
+
+def test_buffers_released_beyond_max_free_bytes_leave_the_pool():
+    pool = BufferPool(2 * 1024)
+    buffers = [pool.acquire((1024,), np.uint8) for _ in range(4)]
+    for buffer in buffers:
+        pool.release(buffer)
+
+    assert pool.free_bytes == 2 * 1024
+    assert set(pool.owned) == {id(buffer) for buffer in buffers[:2]}
+    # a dropped buffer released again is foreign to the pool
+    pool.release(buffers[3])
+    assert pool.free_bytes == 2 * 1024
+
+
+def test_pool_does_not_grow_over_tiles_of_different_shapes():
+    tile_bytes = 64 * 64 * 2
+    pool = BufferPool(2 * tile_bytes)
+    for shape in [(64, 64), (64, 17), (33, 64), (33, 17)] * 10:
+        held = [pool.acquire(shape, np.uint16) for _ in range(2)]
+        for buffer in held:
+            pool.release(buffer)
+        assert pool.free_bytes <= 2 * tile_bytes
+        assert sum(buffer.nbytes for buffer in pool.owned.values()) <= 2 * tile_bytes
@@ -0,0 +1,85 @@
+import json
+
+import numpy as np
+
+from convert_to_precomputed.completion_log import CompletionLog, hash_block, open_completion_log
+
+
+def append_entry(log_path, key, data, newline=True):
+    line = json.dumps({"key": key, "bytes": data.nbytes, "hash": hash_block(data)})
+    with open(log_path, "a") as log_file:
+        log_file.write(line + ("\n" if newline else ""))
+
+
+def read_nothing():
+    raise AssertionError("block is read without verify")
+
+
+def test_refresh_reads_only_lines_appended_since_the_last_read(tmp_path):
+    data = np.arange(16, dtype=np.uint8)
+    other_path = tmp_path / "other-1.jsonl"
+    append_entry(other_path, "a", data)
+    completion_log = CompletionLog(tmp_path, verify=False)
+    assert set(completion_log.entries) == {"a"}
+
+    append_entry(other_path, "b", data)
+    # a line still being appended is read once it is complete
+    append_entry(other_path, "c", data, newline=False)
+    completion_log.refresh()
+    assert set(completion_log.entries) == {"a", "b"}
+    assert completion_log.read_offsets[other_path] < other_path.stat().st_size
+
+    with open(other_path, "a") as log_file:
+        log_file.write("\n")
+    # entries already read are not read again, a forgotten one stays forgotten
+    del completion_log.entries["a"]
+    completion_log.refresh()
+    assert set(completion_log.entries) == {"b", "c"}
+    assert completion_log.is_done("c", read_nothing)
+
+
+def test_files_of_all_processes_are_merged_and_own_appends_are_not_read_back(tmp_path):
+    first, second = np.zeros(8, dtype=np.uint8), np.ones(8, dtype=np.uint8)
+    append_entry(tmp_path / "host-1.jsonl", "a", first)
+    append_entry(tmp_path / "host-2.jsonl", "b", first)
+    append_entry(tmp_path / "host-2.jsonl", "b", second)
+    with open(tmp_path / "host-2.jsonl", "a") as log_file:
+        log_file.write("{crashed\n")
+
+    completion_log = CompletionLog(tmp_path, verify=False)
+    completion_log.record("c", second)
+    completion_log.refresh()
+    completion_log.close()
+
+    assert completion_log.entries == {
+        "a": (8, hash_block(first)),
+        # a later entry of a block replaces the earlier one
+        "b": (8, hash_block(second)),
+        "c": (8, hash_block(second)),
+    }
+    own_paths = set(tmp_path.glob("*.jsonl")) - {tmp_path / "host-1.jsonl", tmp_path / "host-2.jsonl"}
+    assert len(own_paths) == 1 and own_paths.pop() not in completion_log.read_offsets
+    assert CompletionLog(tmp_path, verify=False).entries == completion_log.entries
+
+
+def test_verify_accepts_only_blocks_stored_with_the_logged_hash(tmp_path):
+    logged, stored = np.arange(8, dtype=np.uint16), np.arange(8, dtype=np.uint16)
+    append_entry(tmp_path / "host-1.jsonl", "a", logged)
+    append_entry(tmp_path / "host-1.jsonl", "b", logged)
+    completion_log = CompletionLog(tmp_path, verify=True)
+
+    stored[3] = 0
+    assert not completion_log.is_done("a", lambda: stored)
+    assert completion_log.is_done("b", lambda: logged)
+    # a verified block is not read again
+    assert completion_log.is_done("b", read_nothing)
+    assert not completion_log.is_done("c", read_nothing)
+
+
+def test_log_that_does_not_resume_starts_empty(tmp_path):
+    completion_log = open_completion_log(tmp_path, resume=True, verify=False)
+    completion_log.record("a", np.zeros(4, dtype=np.uint8))
+    completion_log.close()
+
+    assert set(open_completion_log(tmp_path, resume=True, verify=False).entries) == {"a"}
+    assert open_completion_log(tmp_path, resume=False, verify=False).entries == {}
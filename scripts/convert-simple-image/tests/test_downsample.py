@@ -0,0 +1,86 @@
+import itertools
+
+import numpy as np
+import pytest
+
+from convert_to_precomputed.downsample import downsample
+from convert_to_precomputed.types import DownsampleMethod
+
+
+def reference_downsample(data, factors, reduce):
+    """Downsample the trailing axes block by block, repeating the last plane of each axis in incomplete blocks."""
+    lead = data.ndim - len(factors)
+    output_shape = data.shape[:lead] + tuple(-(-size // factor) for size, factor in zip(data.shape[lead:], factors))
+    output = np.empty(output_shape, dtype=data.dtype)
+    for index in itertools.product(*(range(size) for size in output_shape[lead:])):
+        indices = [
+            np.minimum(np.arange(i * factor, (i + 1) * factor), size - 1)
+            for i, factor, size in zip(index, factors, data.shape[lead:])
+        ]
+        block = data[(...,) + np.ix_(*indices)]
+        output[(...,) + index] = reduce(block.reshape(*data.shape[:lead], -1))
+    return output
+
+
+def test_mean_of_odd_sizes_pads_with_edge_values():
+    data = np.array([[0, 2, 4], [6, 8, 10], [12, 14, 16]], dtype=np.float32)
+
+    result = downsample(data, (2, 2), DownsampleMethod.MEAN)
+
+    np.testing.assert_array_equal(result, [[4, 7], [13, 16]])
+
+
+@pytest.mark.parametrize("shape", [(5, 7, 9), (2, 3, 1, 5), (1, 1, 1)])
+@pytest.mark.parametrize("factors", [(2, 2, 2), (1, 2, 2), (3, 2, 1)])
+def test_mean_matches_block_reference(shape, factors):
+    data = np.random.default_rng(0).integers(0, 256, shape).astype(np.uint8)
+
+    result = downsample(data, factors, DownsampleMethod.MEAN)
+
+    expected = reference_downsample(data, factors, lambda block: np.rint(block.mean(axis=-1)))
+    assert result.dtype == np.uint8
+    np.testing.assert_array_equal(result, expected)
+
+
+def test_mode_of_odd_sizes_pads_with_edge_values():
+    data = np.array([[1, 1, 5], [2, 1, 5], [7, 7, 3]], dtype=np.uint32)
+
+    result = downsample(data, (2, 2), DownsampleMethod.MODE)
+
+    # padded blocks repeat the last column and row: [5, 5, 5, 5], [7, 7, 7, 7] and [3, 3, 3, 3]
+    np.testing.assert_array_equal(result, [[1, 5], [7, 3]])
+
+
+@pytest.mark.parametrize("shape", [(5, 7, 9), (2, 3, 5, 4)])
+def test_mode_matches_block_reference(shape):
+    # two labels make every block of 8 voxels either have a majority or a tie broken by the first voxel
+    data = np.random.default_rng(1).integers(0, 2, shape).astype(np.uint64) * 1000
+
+    result = downsample(data, (2, 2, 2), DownsampleMethod.MODE)
+
+    def block_mode(blocks):
+        counts = (blocks[..., :, np.newaxis] == blocks[..., np.newaxis, :]).sum(axis=-1)
+        return np.take_along_axis(blocks, counts.argmax(axis=-1)[..., np.newaxis], axis=-1)[..., 0]
+
+    assert result.dtype == np.uint64
+    np.testing.assert_array_equal(result, reference_downsample(data, (2, 2, 2), block_mode))
+
+
+@pytest.mark.parametrize("dtype", [np.uint8, np.uint16, np.int16, np.float32, np.float64])
+@pytest.mark.parametrize("method", list(DownsampleMethod))
+def test_downsample_keeps_dtype(dtype, method):
+    data = np.arange(3 * 5 * 6).reshape(3, 5, 6).astype(dtype)
+
+    assert downsample(data, (2, 2, 2), method).dtype == dtype
+
+
+def test_mean_rounds_integers_to_nearest():
+    data = np.array([[0, 1], [1, 1]], dtype=np.uint16)
+
+    assert downsample(data, (2, 2), DownsampleMethod.MEAN)[0, 0] == 1
+
+
+def test_factors_of_one_return_data_unchanged():
+    data = np.arange(6, dtype=np.uint8).reshape(2, 3)
+
+    assert downsample(data, (1, 1), DownsampleMethod.MODE) is data
@@ -0,0 +1,110 @@
+import json
+import os
+
+import numpy as np
+import pytest
+
+pytest.importorskip("zimg")
+
+from convert_to_precomputed import intensity  # noqa: E402
+from convert_to_precomputed.intensity import (  # noqa: E402
+    HISTOGRAM_BINS,
+    HISTOGRAM_VOXEL_BYTES,
+    INTENSITY_STATS_FILE,
+    STATS_Z_SIZE,
+    compute_intensity_stats,
+    load_or_compute_intensity_stats,
+)
+from convert_to_precomputed.types import ImageSize  # noqa: E402
+
+
+@pytest.fixture
+def image(tmp_path, nrrd_writer):
+    data = np.random.default_rng(0).normal(100, 20, (2, 20, 30, 17)).astype(np.float32)
+    return nrrd_writer(tmp_path / "image.nrrd", data), data
+
+
+@pytest.fixture
+def compute_calls(monkeypatch):
+    calls = []
+
+    def spy(*args, **kwargs):
+        calls.append(args)
+        return compute_intensity_stats(*args, **kwargs)
+
+    monkeypatch.setattr(intensity, "compute_intensity_stats", spy)
+    return calls
+
+
+def test_slabs_within_memory_budget_give_the_stats_of_whole_planes(image, monkeypatch):
+    image_path, data = image
+    size = ImageSize(x=17, y=30, z=20)
+    read_shapes = []
+    read_image_data_v2 = intensity.read_image_data_v2
+
+    def read_spy(*args, **kwargs):
+        region_data = read_image_data_v2(*args, **kwargs)
+        read_shapes.append(region_data.shape)
+        return region_data
+
+    monkeypatch.setattr(intensity, "read_image_data_v2", read_spy)
+    voxel_bytes = 2 * 4
+    memory_budget = (voxel_bytes + HISTOGRAM_VOXEL_BYTES) * size.x * STATS_Z_SIZE * 7
+
+    sliced = compute_intensity_stats(image_path, size, (1.0, 99.0), 0, voxel_bytes, memory_budget=memory_budget)
+    assert {shape[2] for shape in read_shapes} == {7, 30 % 7}
+    read_shapes.clear()
+    whole = compute_intensity_stats(image_path, size, (1.0, 99.0), 0, voxel_bytes)
+
+    assert {shape[2] for shape in read_shapes} == {30}
+    assert sliced == whole
+    for channel_data, window in zip(data, whole.channels):
+        bin_width = (channel_data.max() - channel_data.min()) / HISTOGRAM_BINS
+        # the histogram bin of the percentile voxel, its lower edge for min and upper edge for max
+        assert window.min == pytest.approx(np.percentile(channel_data, 1.0, method="inverted_cdf"), abs=bin_width)
+        assert window.max == pytest.approx(np.percentile(channel_data, 99.0, method="inverted_cdf"), abs=bin_width)
+
+
+def test_cached_stats_are_reused_for_the_same_input(image, tmp_path, compute_calls):
+    image_path, data = image
+    size = ImageSize(x=17, y=30, z=20)
+
+    first = load_or_compute_intensity_stats(image_path, tmp_path, size, (0.0, 100.0), 0)
+    second = load_or_compute_intensity_stats(image_path, tmp_path, size, (0.0, 100.0), 0)
+
+    assert len(compute_calls) == 1
+    assert first == second
+    assert [(window.min, window.max) for window in first.channels] == [
+        (float(channel_data.min()), float(channel_data.max())) for channel_data in data
+    ]
+    assert first.image_files == [(str(image_path), image_path.stat().st_size, image_path.stat().st_mtime_ns)]
+
+
+@pytest.mark.parametrize(
+    "change",
+    [
+        pytest.param(lambda path: os.utime(path, ns=(0, path.stat().st_mtime_ns + 10**9)), id="modified"),
+        pytest.param(lambda path: path.write_bytes(path.read_bytes() + b"\0"), id="resized"),
+        pytest.param(lambda path: (path.parent / INTENSITY_STATS_FILE).write_text("{truncated"), id="invalid cache"),
+    ],
+)
+def test_cached_stats_are_computed_again_when_the_input_changes(image, tmp_path, compute_calls, change):
+    image_path, _ = image
+    size = ImageSize(x=17, y=30, z=20)
+    load_or_compute_intensity_stats(image_path, tmp_path, size, (0.0, 100.0), 0)
+
+    change(image_path)
+    stats = load_or_compute_intensity_stats(image_path, tmp_path, size, (0.0, 100.0), 0)
+
+    assert len(compute_calls) == 2
+    assert json.loads((tmp_path / INTENSITY_STATS_FILE).read_text())["image_files"] == [list(stats.image_files[0])]
+
+
+def test_cached_stats_are_computed_again_for_other_percentiles_or_size(image, tmp_path, compute_calls):
+    image_path, _ = image
+    load_or_compute_intensity_stats(image_path, tmp_path, ImageSize(x=17, y=30, z=20), (0.0, 100.0), 0)
+
+    load_or_compute_intensity_stats(image_path, tmp_path, ImageSize(x=17, y=30, z=20), (1.0, 99.0), 0)
+    load_or_compute_intensity_stats(image_path, tmp_path, ImageSize(x=17, y=30, z=16), (1.0, 99.0), 0)
+
+    assert len(compute_calls) == 3
@@ -0,0 +1,63 @@
+import numpy as np
+import pytest
+
+from convert_to_precomputed.mmap_reader import open_mmap_image, read_mmap_region
+
+
+@pytest.fixture
+def data():
+    return np.arange(3 * 5 * 7 * 9, dtype=np.uint16).reshape(3, 5, 7, 9)
+
+
+@pytest.mark.parametrize("detached", [False, True], ids=["attached", "detached"])
+@pytest.mark.parametrize("num_channels", [1, 3])
+def test_raw_nrrd_is_mapped_as_channel_z_y_x(tmp_path, nrrd_writer, data, detached, num_channels):
+    image_path = nrrd_writer(tmp_path / "image.nrrd", data[:num_channels], detached=detached)
+
+    mapped = open_mmap_image(image_path)
+
+    assert isinstance(mapped, np.memmap) or isinstance(mapped.base, np.memmap)
+    np.testing.assert_array_equal(mapped, data[:num_channels])
+
+
+def test_detached_header_with_nhdr_suffix(tmp_path, nrrd_writer, data):
+    image_path = nrrd_writer(tmp_path / "image.nhdr", data, detached=True)
+
+    np.testing.assert_array_equal(open_mmap_image(image_path), data)
+
+
+@pytest.mark.parametrize(
+    "fields",
+    [
+        pytest.param({"encoding": "gzip"}, id="gzip"),
+        pytest.param({"type": "complex"}, id="unknown type"),
+        pytest.param({"line skip": "1"}, id="line skip"),
+        pytest.param({"sizes": None}, id="no sizes"),
+    ],
+)
+def test_nrrd_that_can_not_be_mapped_is_left_to_zimg(tmp_path, nrrd_writer, data, fields):
+    image_path = nrrd_writer(tmp_path / "image.nrrd", data, fields=fields)
+
+    assert open_mmap_image(image_path) is None
+
+
+def test_big_endian_data_is_read_in_native_byte_order(tmp_path, nrrd_writer, data):
+    image_path = nrrd_writer(tmp_path / "image.nrrd", data.astype(">u2"))
+
+    mapped = open_mmap_image(image_path)
+    region = read_mmap_region(mapped, 0, -1, 0, -1, 0, -1, 1, 1, 1)
+
+    assert mapped.dtype == np.dtype(">u2")
+    assert region.dtype.isnative and region.dtype == np.uint16
+    np.testing.assert_array_equal(region, data)
+
+
+def test_region_is_a_strided_view(tmp_path, nrrd_writer, data):
+    image_path = nrrd_writer(tmp_path / "image.nrrd", data)
+    mapped = open_mmap_image(image_path)
+
+    region = read_mmap_region(mapped, 1, -1, 2, 7, 0, 4, 2, 3, 2, channel_start=1)
+
+    assert np.shares_memory(region, mapped)
+    np.testing.assert_array_equal(region, data[1:, 0:4:2, 2:7:3, 1::2])
+    np.testing.assert_array_equal(read_mmap_region(mapped, 0, 9, 0, 7, 0, 5, 1, 1, 1, 0, 1), data[:1])
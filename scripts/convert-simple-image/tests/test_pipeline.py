@@ -0,0 +1,75 @@
+import random
+import threading
+import time
+from contextlib import closing
+
+import pytest
+
+from convert_to_precomputed.pipeline import iter_pipelined
+
+
+def stage_threads() -> list[threading.Thread]:
+    return [thread for thread in threading.enumerate() if thread.name.startswith("pipeline_stage_")]
+
+
+def sleep_randomly(item):
+    time.sleep(random.uniform(0, 0.002))
+    return item
+
+
+@pytest.mark.parametrize("max_queued", [0, 1, 4])
+def test_items_come_out_in_order_through_all_stages(max_queued):
+    stages = [lambda item: sleep_randomly(item * 2), lambda item: sleep_randomly(item + 1)]
+
+    assert list(iter_pipelined(range(50), stages, max_queued)) == [item * 2 + 1 for item in range(50)]
+    assert not stage_threads()
+
+
+def test_stages_run_ahead_of_consumer_up_to_max_queued():
+    started = []
+
+    def record(item):
+        started.append(item)
+        return item
+
+    with closing(iter_pipelined(range(100), [record], max_queued=3)) as items:
+        assert next(items) == 0
+        time.sleep(0.05)
+        # item 0 left the queue, the two items behind it are ahead of the consumer
+        assert started == [0, 1, 2]
+        assert next(items) == 1
+        time.sleep(0.05)
+        assert started == [0, 1, 2, 3]
+
+
+def test_stage_exception_reaches_consumer_after_earlier_items():
+    def fail_on_three(item):
+        if item == 3:
+            raise ValueError(f"bad item {item}")
+        return item
+
+    consumed = []
+    with pytest.raises(ValueError, match="bad item 3"):
+        for item in iter_pipelined(range(10), [fail_on_three, sleep_randomly], max_queued=2):
+            consumed.append(item)
+    assert consumed == [0, 1, 2]
+    assert not stage_threads()
+
+
+def test_consumer_stopping_early_shuts_down_stages():
+    processed = []
+
+    def slow_stage(item):
+        time.sleep(0.01)
+        processed.append(item)
+        return item
+
+    with closing(iter_pipelined(range(1000), [slow_stage, sleep_randomly], max_queued=4)) as items:
+        assert [next(items), next(items)] == [0, 1]
+
+    assert not stage_threads()
+    # queued items that did not start are cancelled, at most the queue after the consumed items was processed
+    assert len(processed) <= 2 + 4
+    count = len(processed)
+    time.sleep(0.05)
+    assert len(processed) == count
@@ -0,0 +1,96 @@
+import math
+
+import numpy as np
+import pytest
+
+from convert_to_precomputed.downsample import downsample
+from convert_to_precomputed.pyramid_stream import build_accumulator_chain
+from convert_to_precomputed.types import DimensionRange, DownsampleMethod, ImageRegion, ResolutionRatio
+
+PYRAMIDS = [
+    # isotropic, the last slab of every scale is partial
+    ((20, 18, 21), 4, [ResolutionRatio(1, 1, 1), ResolutionRatio(2, 2, 2), ResolutionRatio(4, 4, 4)]),
+    # z factor 1 between all scales
+    ((17, 16, 13), 4, [ResolutionRatio(1, 1, 1), ResolutionRatio(2, 2, 1), ResolutionRatio(4, 4, 1)]),
+    # z factor 1 followed by 2, with chunks deeper than the input of the last scale
+    ((12, 11, 23), 8, [ResolutionRatio(1, 1, 1), ResolutionRatio(2, 2, 1), ResolutionRatio(4, 4, 2)]),
+]
+
+
+def build_scales(size, chunk_z, ratios):
+    return [
+        {
+            "size": [
+                math.ceil(axis_size / axis_ratio) for axis_size, axis_ratio in zip(size, (ratio.x, ratio.y, ratio.z))
+            ],
+            "chunk_sizes": [8, 8, chunk_z],
+            "resolution": [float(ratio.x), float(ratio.y), float(ratio.z)],
+            "encoding": "raw",
+        }
+        for ratio in ratios
+    ]
+
+
+def stream_pyramid(data, scales, ratios, method):
+    """Push (channel, z, y, x) data in slabs of the first scale and collect the slabs written to every scale."""
+    written = [[] for _ in scales]
+
+    def write_slab(scale, slab, z_start, z_end):
+        assert slab.shape[1] == z_end - z_start
+        written[scales.index(scale)].append((z_start, z_end, slab.copy()))
+
+    accumulator = build_accumulator_chain(scales, ratios, 0, write_slab, method)
+    read_z_size = scales[0]["chunk_sizes"][2]
+    for z_start in range(0, data.shape[1], read_z_size):
+        accumulator.push(data[:, z_start : z_start + read_z_size])
+    accumulator.finish()
+    return written
+
+
+def join_slabs(scale, slabs):
+    """Data of a scale from its slabs, which must tile z in order on chunk boundaries."""
+    chunk_z, size_z = scale["chunk_sizes"][2], scale["size"][2]
+    assert [z_start for z_start, _, _ in slabs] == list(range(0, size_z, chunk_z))
+    assert [z_end for _, z_end, _ in slabs] == [min(z_start + chunk_z, size_z) for z_start, _, _ in slabs]
+    return np.concatenate([slab for _, _, slab in slabs], axis=1)
+
+
+@pytest.mark.parametrize("size, chunk_z, ratios", PYRAMIDS)
+@pytest.mark.parametrize("method", list(DownsampleMethod))
+def test_streamed_pyramid_matches_cascaded_downsample(size, chunk_z, ratios, method):
+    scales = build_scales(size, chunk_z, ratios)
+    data = np.random.default_rng(0).integers(0, 4, (2, size[2], size[1], size[0])).astype(np.uint16)
+
+    written = stream_pyramid(data, scales, ratios, method)
+
+    expected = data
+    for index, scale in enumerate(scales):
+        if index > 0:
+            ratio, previous_ratio = ratios[index], ratios[index - 1]
+            factors = (ratio.z // previous_ratio.z, ratio.y // previous_ratio.y, ratio.x // previous_ratio.x)
+            expected = downsample(expected, factors, method)
+        assert expected.shape[1:] == tuple(reversed(scale["size"]))
+        np.testing.assert_array_equal(join_slabs(scale, written[index]), expected)
+
+
+@pytest.mark.parametrize("size, chunk_z, ratios", PYRAMIDS)
+def test_streamed_pyramid_matches_downsample_scale_data(tmp_path, size, chunk_z, ratios):
+    pytest.importorskip("zimg")
+    from convert_to_precomputed.convert import downsample_scale_data
+    from convert_to_precomputed.tensorstore_utils import open_tensorstore_to_write, select_channel_zyx
+
+    scales = build_scales(size, chunk_z, ratios)
+    multi_scale_metadata = {"data_type": "uint16", "num_channels": 1, "type": "image"}
+    data = np.random.default_rng(1).integers(0, 1000, (1, size[2], size[1], size[0])).astype(np.uint16)
+
+    written = stream_pyramid(data, scales, ratios, DownsampleMethod.MEAN)
+    streamed = [join_slabs(scale, slabs) for scale, slabs in zip(scales, written)]
+    for scale, scale_data in zip(scales, streamed):
+        store = open_tensorstore_to_write("channel_0", tmp_path, scale, multi_scale_metadata)
+        select_channel_zyx(store, 0).write(scale_data[0]).result()
+
+    for index in range(1, len(scales)):
+        size_x, size_y, size_z = scales[index]["size"]
+        region = ImageRegion(DimensionRange(0, size_x), DimensionRange(0, size_y), DimensionRange(0, size_z))
+        expected = downsample_scale_data(tmp_path, scales[index - 1], scales[index], [0], region, DownsampleMethod.MEAN)
+        np.testing.assert_array_equal(streamed[index], expected)
@@ -0,0 +1,185 @@
+import functools
+import json
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import asdict
+from pathlib import Path
+
+import pytest
+
+pytest.importorskip("zimg")
+
+from convert_to_precomputed.scheduler import (  # noqa: E402
+    find_dependencies,
+    load_done_units,
+    run_unit_graph,
+    split_work_units,
+)
+from convert_to_precomputed.tensorstore_utils import build_scales_dyadic_pyramid  # noqa: E402
+from convert_to_precomputed.types import (  # noqa: E402
+    ConvertSpec,
+    ImageSize,
+    MultiscaleMetadata,
+    ResolutionPM,
+    ScaleMetadata,
+    ShardingOptions,
+    SizePM,
+    WorkUnit,
+)
+
+
+def build_spec(resolution: ResolutionPM, size: ImageSize, cascade: bool) -> ConvertSpec:
+    # small shards split every scale into several z slabs
+    scales = build_scales_dyadic_pyramid(resolution, size, sharding_options=ShardingOptions(target_shard_bytes=1 << 20))
+    return ConvertSpec(
+        image_path="image.nrrd",
+        output_directory="output",
+        resolution=resolution,
+        write_block_size=512,
+        size=SizePM(x=size.x, y=size.y, z=size.z),
+        multiscale=MultiscaleMetadata(data_type="uint8", num_channels=2, type="image"),
+        scales=[ScaleMetadata.model_validate(scale) for scale in scales],
+        cascade=cascade,
+    )
+
+
+@pytest.mark.parametrize("resolution", [ResolutionPM(x=1, y=1, z=1), ResolutionPM(x=1, y=1, z=4)])
+def test_cascaded_units_depend_on_exactly_the_source_z_range(resolution):
+    spec = build_spec(resolution, ImageSize(1024, 1024, 700), cascade=True)
+    units = split_work_units(spec)
+
+    dependencies = find_dependencies(spec, units)
+
+    assert max(unit.scale_index for unit in units) > 1
+    for unit in units:
+        if unit.scale_index == 0:
+            assert dependencies[unit] == []
+            continue
+        scale, source_scale = spec.scales[unit.scale_index], spec.scales[unit.scale_index - 1]
+        factor_z = round(scale.resolution[2] / source_scale.resolution[2])
+        source_z_start, source_z_end = unit.z_start * factor_z, min(unit.z_end * factor_z, source_scale.size[2])
+        source_units = sorted(dependencies[unit], key=lambda source_unit: source_unit.z_start)
+        assert {(source_unit.scale_index, source_unit.channel_index) for source_unit in source_units} == {
+            (unit.scale_index - 1, unit.channel_index)
+        }
+        # the dependencies are contiguous, cover the source range and each of them overlaps it
+        assert source_units[0].z_start <= source_z_start and source_units[-1].z_end >= source_z_end
+        assert all(before.z_end == after.z_start for before, after in zip(source_units, source_units[1:]))
+        assert all(source_unit.z_end > source_z_start for source_unit in source_units)
+        assert all(source_unit.z_start < source_z_end for source_unit in source_units)
+
+
+def test_units_without_cascade_have_no_dependencies():
+    spec = build_spec(ResolutionPM(x=1, y=1, z=1), ImageSize(512, 512, 300), cascade=False)
+    units = split_work_units(spec)
+
+    assert set(map(len, find_dependencies(spec, units).values())) == {0}
+
+
+def create_pool(workers: int) -> ProcessPoolExecutor:
+    return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+
+
+def marker_path(directory: Path, unit: WorkUnit) -> Path:
+    return directory / f"{unit.scale_index}-{unit.z_start}-{unit.channel_index}"
+
+
+def crash_once(directory: Path, unit: WorkUnit) -> None:
+    """Kill the worker process on the first attempt of unit."""
+    if not marker_path(directory, unit).exists():
+        marker_path(directory, unit).touch()
+        os._exit(1)
+
+
+def convert_after_dependencies(
+    directory: Path, dependencies: dict[WorkUnit, list[WorkUnit]], failing: WorkUnit | None, unit: WorkUnit
+) -> None:
+    if unit == failing:
+        raise ValueError(f"{unit} fails")
+    if missing := [dependency for dependency in dependencies[unit] if not marker_path(directory, dependency).exists()]:
+        raise AssertionError(f"{unit} started before {missing}")
+    marker_path(directory, unit).touch()
+
+
+def build_units() -> tuple[list[WorkUnit], dict[WorkUnit, list[WorkUnit]]]:
+    first_units = [WorkUnit(0, z_start, z_start + 64, 0) for z_start in range(0, 256, 64)]
+    second_units = [WorkUnit(1, 0, 64, 0), WorkUnit(1, 64, 128, 0)]
+    dependencies = {unit: [] for unit in first_units}
+    dependencies[second_units[0]] = first_units[:2]
+    dependencies[second_units[1]] = first_units[2:]
+    dependencies[WorkUnit(2, 0, 64, 0)] = second_units
+    return list(dependencies), dependencies
+
+
+def test_units_run_after_dependencies_and_done_units_are_saved(tmp_path):
+    units, dependencies = build_units()
+    status_path = tmp_path / "schedule_status.json"
+    convert_unit = functools.partial(convert_after_dependencies, tmp_path, dependencies, None)
+
+    failed = run_unit_graph(units, dependencies, set(), convert_unit, lambda: create_pool(2), 2, 0, status_path)
+
+    assert failed == set()
+    assert load_done_units(status_path) == set(units)
+    assert all(marker_path(tmp_path, unit).exists() for unit in units)
+    assert not list(tmp_path.glob("*.tmp"))
+
+
+def test_done_units_are_skipped(tmp_path):
+    units, dependencies = build_units()
+    done = set(units[:4])
+    for unit in done:
+        marker_path(tmp_path, unit).touch()
+    convert_unit = functools.partial(convert_after_dependencies, tmp_path, dependencies, units[0])
+
+    failed = run_unit_graph(
+        units, dependencies, done, convert_unit, lambda: create_pool(2), 2, 0, tmp_path / "schedule_status.json"
+    )
+
+    assert failed == set()
+    assert done == set(units)
+
+
+def test_failed_unit_is_retried_then_skips_its_dependents(tmp_path):
+    units, dependencies = build_units()
+    convert_unit = functools.partial(convert_after_dependencies, tmp_path, dependencies, units[0])
+
+    failed = run_unit_graph(
+        units, dependencies, set(), convert_unit, lambda: create_pool(2), 2, 1, tmp_path / "schedule_status.json"
+    )
+
+    assert failed == {units[0], WorkUnit(1, 0, 64, 0), WorkUnit(2, 0, 64, 0)}
+    assert load_done_units(tmp_path / "schedule_status.json") == set(units) - failed
+
+
+def test_broken_pool_is_replaced_and_its_units_retried(tmp_path):
+    units = [WorkUnit(0, z_start, z_start + 64, 0) for z_start in range(0, 256, 64)]
+    dependencies = {unit: [] for unit in units}
+    pools = []
+
+    def create_counted_pool() -> ProcessPoolExecutor:
+        pools.append(create_pool(1))
+        return pools[-1]
+
+    failed = run_unit_graph(
+        units,
+        dependencies,
+        set(),
+        functools.partial(crash_once, tmp_path),
+        create_counted_pool,
+        1,
+        1,
+        tmp_path / "schedule_status.json",
+    )
+
+    assert failed == set()
+    # the first pool and one replacement for the crash of every unit
+    assert len(pools) == len(units) + 1
+    assert load_done_units(tmp_path / "schedule_status.json") == set(units)
+
+
+def test_invalid_status_is_ignored(tmp_path):
+    status_path = tmp_path / "schedule_status.json"
+    status_path.write_text(json.dumps([asdict(WorkUnit(0, 0, 64, 0))])[:-5])
+
+    assert load_done_units(status_path) == set()
@@ -0,0 +1,119 @@
+import itertools
+import math
+
+import numpy as np
+import pytest
+
+from convert_to_precomputed.sharding import (
+    MINISHARD_INDEX_ENTRY_BYTES,
+    calc_shard_block_ranges,
+    calc_shard_layout,
+    calc_sharding_bits,
+)
+from convert_to_precomputed.types import DimensionRange, ShardingOptions
+
+
+def compressed_morton_code(position: tuple[int, int, int], axis_bits: list[int]) -> int:
+    """Compressed morton code of a chunk position as neuroglancer_precomputed defines it."""
+    code, output_bit = 0, 0
+    for level in range(max(axis_bits)):
+        for axis in range(3):
+            if level < axis_bits[axis]:
+                code |= ((position[axis] >> level) & 1) << output_bit
+                output_bit += 1
+    return code
+
+
+def build_scale(size, chunk_sizes, preshift_bits, minishard_bits, shard_bits):
+    return {
+        "size": list(size),
+        "chunk_sizes": list(chunk_sizes),
+        "sharding": {
+            "@type": "neuroglancer_uint64_sharded_v1",
+            "hash": "identity",
+            "preshift_bits": preshift_bits,
+            "minishard_bits": minishard_bits,
+            "shard_bits": shard_bits,
+        },
+    }
+
+
+@pytest.mark.parametrize(
+    "size, chunk_sizes, preshift_bits, minishard_bits",
+    [
+        ((1000, 1000, 1000), (64, 64, 64), 3, 3),
+        ((1000, 300, 70), (64, 64, 64), 2, 3),
+        ((4096, 4096, 64), (128, 128, 32), 4, 2),
+        ((100, 100, 100), (32, 32, 32), 0, 0),
+    ],
+)
+def test_shard_layout_matches_morton_shards(size, chunk_sizes, preshift_bits, minishard_bits):
+    grid_shape = [(s + c - 1) // c for s, c in zip(size, chunk_sizes)]
+    axis_bits = [(grid - 1).bit_length() for grid in grid_shape]
+    shard_bits = max(0, sum(axis_bits) - preshift_bits - minishard_bits)
+    layout = calc_shard_layout(build_scale(size, chunk_sizes, preshift_bits, minishard_bits, shard_bits))
+    assert layout is not None and not layout.wraps
+
+    box_chunks = [layout.shard_shape.x // chunk_sizes[0], layout.shard_shape.y // chunk_sizes[1]]
+    box_chunks.append(layout.shard_shape.z // chunk_sizes[2])
+    box_shards = {}
+    for position in itertools.product(*(range(grid) for grid in grid_shape)):
+        shard = compressed_morton_code(position, axis_bits) >> (preshift_bits + minishard_bits)
+        box = tuple(p // b for p, b in zip(position, box_chunks))
+        # every chunk of a shard box is in the same shard
+        assert box_shards.setdefault(box, shard) == shard
+    # and no two boxes share a shard
+    assert len(set(box_shards.values())) == len(box_shards)
+
+
+def test_shard_layout_wraps_with_too_few_shard_bits():
+    layout = calc_shard_layout(build_scale((1000, 1000, 1000), (64, 64, 64), 3, 3, 1))
+    assert layout.wraps
+
+
+def test_shard_layout_needs_identity_hash():
+    scale = build_scale((1000, 1000, 1000), (64, 64, 64), 3, 3, 6)
+    scale["sharding"]["hash"] = "murmurhash3_x86_128"
+    assert calc_shard_layout(scale) is None
+    assert calc_shard_layout({"size": [10, 10, 10], "chunk_sizes": [8, 8, 8]}) is None
+
+
+def test_shard_block_ranges_cover_range_without_crossing_shards():
+    layout = calc_shard_layout(build_scale((1000, 1000, 64), (64, 64, 64), 2, 2, 2))
+    x_range, y_range = DimensionRange(30, 900), DimensionRange(0, 1000)
+    blocks = calc_shard_block_ranges(x_range, y_range, 100, layout)
+
+    coverage = np.zeros((1000, 1000), dtype=np.int32)
+    for block_x, block_y in blocks:
+        assert block_x.start // layout.shard_shape.x == (block_x.end - 1) // layout.shard_shape.x
+        assert block_y.start // layout.shard_shape.y == (block_y.end - 1) // layout.shard_shape.y
+        assert block_x.end - block_x.start <= 100 and block_y.end - block_y.start <= 100
+        coverage[block_x.start : block_x.end, block_y.start : block_y.end] += 1
+    assert (coverage[30:900, :] == 1).all()
+    assert coverage.sum() == 870 * 1000
+
+
+@pytest.mark.parametrize(
+    "size, chunk_sizes, voxel_bytes",
+    [((40000, 30000, 2000), (64, 64, 64), 2), ((1000, 1000, 100), (64, 64, 64), 1), ((64, 64, 64), (64, 64, 64), 4)],
+)
+def test_sharding_bits_cover_grid_within_targets(size, chunk_sizes, voxel_bytes):
+    options = ShardingOptions(target_shard_bytes=1 << 30, target_minishard_index_bytes=12 << 10)
+    bits = calc_sharding_bits({"size": list(size), "chunk_sizes": list(chunk_sizes)}, voxel_bytes, options)
+
+    grid_shape = [(s + c - 1) // c for s, c in zip(size, chunk_sizes)]
+    grid_bits = sum((grid - 1).bit_length() for grid in grid_shape)
+    chunk_bytes = math.prod(chunk_sizes) * voxel_bytes
+    shard_chunk_bits = bits["preshift_bits"] + bits["minishard_bits"]
+    # shards never wrap, and hold as many chunks as fit in the target
+    assert shard_chunk_bits + bits["shard_bits"] == grid_bits
+    assert chunk_bytes << shard_chunk_bits <= options.target_shard_bytes or shard_chunk_bits == 0
+    assert shard_chunk_bits == grid_bits or chunk_bytes << (shard_chunk_bits + 1) > options.target_shard_bytes
+    assert MINISHARD_INDEX_ENTRY_BYTES << bits["preshift_bits"] <= options.target_minishard_index_bytes
+    assert min(bits.values()) >= 0
+
+
+def test_sharding_bits_give_small_scales_one_shard():
+    options = ShardingOptions()
+    bits = calc_sharding_bits({"size": [300, 200, 100], "chunk_sizes": [64, 64, 64]}, 1, options)
+    assert bits["shard_bits"] == 0
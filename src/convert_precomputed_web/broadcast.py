@@ -0,0 +1,186 @@
+import asyncio
+from collections.abc import Callable
+
+from loguru import logger
+
+from convert_precomputed_web.jobs import JobLog
+
+RenderLines = Callable[[list[tuple[int, str]]], str]
+RenderProgress = Callable[[str], str]
+
+
+class LogSubscriber:
+    """Messages of one viewer, each is the id of its last line, None for progress, and the rendered message. Lines are
+    only sent with raw_log. None ends the messages, then dropped tells if the viewer fell max_pending messages behind
+    and has to subscribe again from its last id."""
+
+    def __init__(self, last_id: int, max_pending: int, skipped: int, raw_log: bool):
+        self.last_id = last_id
+        # one extra slot so the closing None always fits
+        self.queue: asyncio.Queue[tuple[int | None, str] | None] = asyncio.Queue(max_pending + 1)
+        self.max_pending = max_pending
+        self.skipped = skipped
+        self.raw_log = raw_log
+        self.dropped = False
+
+    async def get(self, timeout: float) -> tuple[int | None, str] | None:
+        """Next message, raises asyncio.TimeoutError if none arrives in timeout seconds."""
+        return await asyncio.wait_for(self.queue.get(), timeout)
+
+    def put(self, message: tuple[int | None, str]) -> bool:
+        """Queue message, or drop the subscriber and return False if it is too far behind."""
+        if self.queue.qsize() >= self.max_pending:
+            self.dropped = True
+            self.close()
+            return False
+        self.queue.put_nowait(message)
+        if message[0] is not None:
+            self.last_id = message[0]
+        return True
+
+    def close(self) -> None:
+        self.queue.put_nowait(None)
+
+
+class LogBroadcast:
+    """One task renders the new lines and the latest progress of a JobLog and puts the same message in the queue of
+    every subscriber, so the cost of a job does not grow with the number of viewers and a slow viewer never stalls it.
+
+    Lines are sent every interval seconds, progress at most every progress_interval seconds, skipping the progress
+    replaced in between.
+    """
+
+    def __init__(
+        self,
+        job_log: JobLog,
+        render_lines: RenderLines,
+        render_progress: RenderProgress,
+        interval: float,
+        progress_interval: float,
+        max_pending: int,
+    ):
+        self.job_log = job_log
+        self.render_lines = render_lines
+        self.render_progress = render_progress
+        self.interval = interval
+        self.progress_interval = progress_interval
+        self.max_pending = max_pending
+        # lines that left the ring before the broadcast started were never its to send, they are not missed
+        self.sent_id = job_log.ring[0][0] - 1 if job_log.ring else 0
+        # subscribers get the progress so far when they subscribe
+        self.sent_progress_count = job_log.progress_count
+        self.next_progress_time = 0.0
+        self.closed = False
+        self.subscribers: set[LogSubscriber] = set()
+        self.task: asyncio.Task | None = None
+
+    def subscribe(self, last_id: int, raw_log: bool) -> LogSubscriber:
+        """Subscriber starting with the latest progress, and with raw_log the lines after last_id that were already
+        broadcast, coalesced in one message."""
+        subscriber = LogSubscriber(last_id, self.max_pending, 0, raw_log)
+        if self.job_log.progress is not None:
+            subscriber.put((None, self.render_progress(self.job_log.progress)))
+        if raw_log:
+            lines, subscriber.skipped = self.job_log.since(last_id)
+            lines = [(line_id, line) for line_id, line in lines if line_id <= self.sent_id]
+            if lines:
+                subscriber.put((lines[-1][0], self.render_lines(lines)))
+        if self.closed:
+            subscriber.close()
+            return subscriber
+        self.subscribers.add(subscriber)
+        if self.task is None:
+            self.task = asyncio.create_task(self._run(), name=f"broadcast-{self.job_log.path.name}")
+        return subscriber
+
+    def unsubscribe(self, subscriber: LogSubscriber) -> None:
+        self.subscribers.discard(subscriber)
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            sent = self._send_lines()
+            progress_due = self.job_log.progress_count != self.sent_progress_count
+            if progress_due and (loop.time() >= self.next_progress_time or self.job_log.finished):
+                message = (None, self.render_progress(self.job_log.progress))
+                self.sent_progress_count = self.job_log.progress_count
+                self.next_progress_time = loop.time() + self.progress_interval
+                self._put_all(message)
+                sent = True
+            if sent:
+                await asyncio.sleep(self.interval)
+            elif self.job_log.finished:
+                break
+            else:
+                timeout = self.next_progress_time - loop.time() if progress_due else None
+                try:
+                    await asyncio.wait_for(self.job_log.changed.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+        self.closed = True
+        for subscriber in self.subscribers:
+            subscriber.close()
+        self.subscribers.clear()
+
+    def _send_lines(self) -> bool:
+        lines, skipped = self.job_log.since(self.sent_id)
+        if skipped:
+            logger.warning(f"broadcast of {self.job_log.path.name} fell {skipped} lines behind")
+        if not lines:
+            return False
+        self.sent_id = lines[-1][0]
+        raw_subscribers = [subscriber for subscriber in self.subscribers if subscriber.raw_log]
+        if not raw_subscribers:
+            return True
+        message = (self.sent_id, self.render_lines(lines))
+        for subscriber in raw_subscribers:
+            if subscriber.last_id >= lines[0][0]:
+                # joined with a last id ahead of the broadcast, only rendered for the first message
+                if subscriber.last_id >= self.sent_id:
+                    continue
+                late_lines = [(line_id, line) for line_id, line in lines if line_id > subscriber.last_id]
+                if not subscriber.put((self.sent_id, self.render_lines(late_lines))):
+                    self.subscribers.remove(subscriber)
+            elif not subscriber.put(message):
+                self.subscribers.remove(subscriber)
+        return True
+
+    def _put_all(self, message: tuple[int | None, str]) -> None:
+        for subscriber in list(self.subscribers):
+            if not subscriber.put(message):
+                self.subscribers.remove(subscriber)
+
+
+class LogHub:
+    """Broadcasts of the job logs being watched, a broadcast is forgotten once its job finished and all lines are
+    sent."""
+
+    def __init__(
+        self,
+        render_lines: RenderLines,
+        render_progress: RenderProgress,
+        interval: float,
+        progress_interval: float,
+        max_pending: int,
+    ):
+        self.render_lines = render_lines
+        self.render_progress = render_progress
+        self.interval = interval
+        self.progress_interval = progress_interval
+        self.max_pending = max_pending
+        self.broadcasts: dict[JobLog, LogBroadcast] = {}
+
+    def broadcast(self, job_log: JobLog) -> LogBroadcast:
+        for closed_log in [closed_log for closed_log, broadcast in self.broadcasts.items() if broadcast.closed]:
+            del self.broadcasts[closed_log]
+        if (broadcast := self.broadcasts.get(job_log)) is None:
+            broadcast = LogBroadcast(
+                job_log,
+                self.render_lines,
+                self.render_progress,
+                self.interval,
+                self.progress_interval,
+                self.max_pending,
+            )
+            self.broadcasts[job_log] = broadcast
+        return broadcast
@@ -0,0 +1,365 @@
+import asyncio
+import itertools
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict, deque
+from enum import Enum
+from pathlib import Path
+
+from loguru import logger
+from pydantic import BaseModel
+
+# lines printed by convert_to_precomputed --progress-interval
+PROGRESS_LINE_PREFIX = "@progress "
+
+
+class JobStatus(str, Enum):
+    QUEUED = "queued"
+    RUNNING = "running"
+    SUCCEEDED = "succeeded"
+    FAILED = "failed"
+    CANCELLED = "cancelled"
+
+
+class Job(BaseModel):
+    id: int = 0
+    kind: str
+    cmd: list[str]
+    cwd: str | None = None
+    env: dict[str, str] | None = None
+    priority: int = 0
+    memory_bytes: int = 0
+    cpus: int = 1
+    status: JobStatus = JobStatus.QUEUED
+    return_code: int | None = None
+    created_at: float = 0.0
+    started_at: float | None = None
+    finished_at: float | None = None
+
+
+class JobStore:
+    """Jobs persisted in a SQLite file, safe to use from several threads."""
+
+    def __init__(self, db_path: Path):
+        db_path.parent.mkdir(parents=True, exist_ok=True)
+        self.connection = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self.lock = threading.Lock()
+        with self.lock:
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, kind TEXT NOT NULL, cmd TEXT NOT NULL, cwd TEXT, env TEXT, "
+                "priority INTEGER NOT NULL, memory_bytes INTEGER NOT NULL, cpus INTEGER NOT NULL, "
+                "status TEXT NOT NULL, return_code INTEGER, "
+                "created_at REAL NOT NULL, started_at REAL, finished_at REAL)"
+            )
+
+    def insert(self, job: Job) -> Job:
+        with self.lock:
+            cursor = self.connection.execute(
+                "INSERT INTO jobs (kind, cmd, cwd, env, priority, memory_bytes, cpus, status, created_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    job.kind,
+                    json.dumps(job.cmd),
+                    job.cwd,
+                    None if job.env is None else json.dumps(job.env),
+                    job.priority,
+                    job.memory_bytes,
+                    job.cpus,
+                    job.status.value,
+                    job.created_at,
+                ),
+            )
+        return job.model_copy(update={"id": cursor.lastrowid})
+
+    def update(self, job: Job) -> None:
+        with self.lock:
+            self.connection.execute(
+                "UPDATE jobs SET status = ?, return_code = ?, started_at = ?, finished_at = ? WHERE id = ?",
+                (job.status.value, job.return_code, job.started_at, job.finished_at, job.id),
+            )
+
+    def get(self, job_id: int) -> Job | None:
+        with self.lock:
+            row = self.connection.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return None if row is None else self._row_2_job(row)
+
+    def list(self, status: JobStatus | None = None, limit: int = 100) -> list[Job]:
+        """Latest jobs first."""
+        with self.lock:
+            if status is None:
+                rows = self.connection.execute("SELECT * FROM jobs ORDER BY id DESC LIMIT ?", (limit,)).fetchall()
+            else:
+                rows = self.connection.execute(
+                    "SELECT * FROM jobs WHERE status = ? ORDER BY id DESC LIMIT ?", (status.value, limit)
+                ).fetchall()
+        return [self._row_2_job(row) for row in rows]
+
+    @staticmethod
+    def _row_2_job(row: tuple) -> Job:
+        job_id, kind, cmd, cwd, env, priority, memory_bytes, cpus, status, return_code, created, started, finished = row
+        return Job(
+            id=job_id,
+            kind=kind,
+            cmd=json.loads(cmd),
+            cwd=cwd,
+            env=None if env is None else json.loads(env),
+            priority=priority,
+            memory_bytes=memory_bytes,
+            cpus=cpus,
+            status=JobStatus(status),
+            return_code=return_code,
+            created_at=created,
+            started_at=started,
+            finished_at=finished,
+        )
+
+
+class JobLog:
+    """Output lines of a job numbered from 1, every line is appended to a log file and the latest ring_size lines are
+    kept in memory, so viewers replay them without reading the file. Progress lines are not logged, only the JSON of the
+    latest one is kept in progress, progress_count counts them."""
+
+    def __init__(self, path: Path, ring_size: int):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.path = path
+        # appended to while the job runs, closed by finish
+        self.file = open(path, "a")  # noqa: SIM115
+        self.ring: deque[tuple[int, str]] = deque(maxlen=ring_size)
+        self.last_id = 0
+        self.finished = False
+        self.progress: str | None = None
+        self.progress_count = 0
+        self.changed = asyncio.Event()
+
+    def append(self, line: str) -> None:
+        if line.startswith(PROGRESS_LINE_PREFIX):
+            self.progress = line.removeprefix(PROGRESS_LINE_PREFIX).strip()
+            self.progress_count += 1
+            self._notify()
+            return
+        self.last_id += 1
+        self.ring.append((self.last_id, line))
+        self.file.write(line)
+        self.file.flush()
+        self._notify()
+
+    def finish(self) -> None:
+        self.finished = True
+        self.file.close()
+        self._notify()
+
+    def since(self, last_id: int) -> tuple[list[tuple[int, str]], int]:
+        """Lines after last_id still in memory, and the number of lines after last_id that are only in the file."""
+        if not self.ring or last_id >= self.last_id:
+            return [], 0
+        first_id = self.ring[0][0]
+        start = max(0, last_id + 1 - first_id)
+        return list(itertools.islice(self.ring, start, None)), max(0, first_id - last_id - 1)
+
+    async def wait(self, timeout: float) -> None:
+        """Wait until a line is appended or the job finished, raises asyncio.TimeoutError after timeout seconds."""
+        await asyncio.wait_for(self.changed.wait(), timeout)
+
+    def _notify(self) -> None:
+        # waiters hold the previous event, a new one is armed for the next change
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+
+class JobQueue:
+    """Run jobs on at most max_running processes, highest priority first and FIFO within a priority.
+
+    A job is only started while the estimated memory and CPUs of the running jobs leave room for it. The head of the
+    queue is never overtaken, so big jobs do not starve, and a job bigger than the capacity runs alone. Processes are
+    run and read on the event loop independent of any request, their output goes to a JobLog in log_directory. Logs of
+    the latest keep_finished_logs finished jobs stay in memory for replay.
+    """
+
+    MAX_LINE_BYTES = 16 << 20
+
+    def __init__(
+        self,
+        store: JobStore,
+        max_running: int,
+        memory_capacity: int,
+        cpu_capacity: int,
+        log_directory: Path,
+        ring_size: int = 10000,
+        keep_finished_logs: int = 32,
+    ):
+        self.store = store
+        self.max_running = max_running
+        self.memory_capacity = memory_capacity
+        self.cpu_capacity = cpu_capacity
+        self.log_directory = log_directory
+        self.ring_size = ring_size
+        self.keep_finished_logs = keep_finished_logs
+        self.queued: list[Job] = []
+        self.running: dict[int, asyncio.subprocess.Process] = {}
+        self.running_jobs: dict[int, Job] = {}
+        self.logs: dict[int, JobLog] = {}
+        self.finished_logs: OrderedDict[int, JobLog] = OrderedDict()
+        self.cancelled: set[int] = set()
+        self.tasks: set[asyncio.Task] = set()
+        self.stopping = False
+
+    async def start(self) -> None:
+        """Requeue jobs left queued by the previous server, jobs it was running are lost and marked failed."""
+        for job in self.store.list(JobStatus.RUNNING, limit=-1):
+            self._finish(job, JobStatus.FAILED, None)
+            logger.warning(f"job {job.id} was interrupted by a server restart")
+        for job in reversed(self.store.list(JobStatus.QUEUED, limit=-1)):
+            self.queued.append(job)
+            self.logs[job.id] = JobLog(self.log_path(job.id), self.ring_size)
+        await self._dispatch()
+
+    async def stop(self, timeout: float = 10.0) -> None:
+        """Terminate the running processes and wait until their jobs are recorded as cancelled, processes still running
+        after timeout seconds are killed. Queued jobs stay queued for the next start."""
+        self.stopping = True
+        for job_id, process in self.running.items():
+            if process.returncode is None:
+                self.cancelled.add(job_id)
+                process.terminate()
+        if not self.tasks:
+            return
+        _, pending = await asyncio.wait(self.tasks, timeout=timeout)
+        for process in self.running.values():
+            if process.returncode is None:
+                process.kill()
+        if pending:
+            await asyncio.wait(pending)
+
+    async def submit(self, job: Job) -> Job:
+        job = self.store.insert(job.model_copy(update={"status": JobStatus.QUEUED, "created_at": time.time()}))
+        logger.info(f"submit job {job.id}: {' '.join(job.cmd)}")
+        self.queued.append(job)
+        self.logs[job.id] = JobLog(self.log_path(job.id), self.ring_size)
+        await self._dispatch()
+        return job
+
+    async def cancel(self, job_id: int) -> None:
+        for job in self.queued:
+            if job.id == job_id:
+                self.queued.remove(job)
+                self._finish(job, JobStatus.CANCELLED, None)
+                # the cancelled job may have been the head of the queue holding back smaller jobs
+                await self._dispatch()
+                return
+        process = self.running.get(job_id)
+        if process is None and job_id in self.running_jobs:
+            # its process is starting, _start terminates it once started
+            self.cancelled.add(job_id)
+        elif process is not None and process.returncode is None:
+            self.cancelled.add(job_id)
+            process.terminate()
+
+    def log(self, job_id: int) -> JobLog | None:
+        """Log of a queued, running or recently finished job."""
+        return self.logs.get(job_id) or self.finished_logs.get(job_id)
+
+    def log_path(self, job_id: int) -> Path:
+        return self.log_directory / f"{job_id}.log"
+
+    def position(self, job_id: int) -> int:
+        """Jobs ahead of job_id in the queue, -1 if it is not queued."""
+        for index, job in enumerate(self._ordered_queue()):
+            if job.id == job_id:
+                return index
+        return -1
+
+    def _ordered_queue(self) -> list[Job]:
+        return sorted(self.queued, key=lambda job: (-job.priority, job.id))
+
+    async def _dispatch(self) -> None:
+        while not self.stopping and self.queued:
+            job = self._ordered_queue()[0]
+            if not self._admits(job):
+                return
+            # reserved before its process starts, so dispatches running meanwhile see the capacity it takes
+            self.queued.remove(job)
+            self.running_jobs[job.id] = job
+            await self._start(job)
+
+    def _admits(self, job: Job) -> bool:
+        if not self.running_jobs:
+            return True
+        if len(self.running_jobs) >= self.max_running:
+            return False
+        used_memory = sum(running_job.memory_bytes for running_job in self.running_jobs.values())
+        used_cpus = sum(running_job.cpus for running_job in self.running_jobs.values())
+        return used_memory + job.memory_bytes <= self.memory_capacity and used_cpus + job.cpus <= self.cpu_capacity
+
+    async def _start(self, job: Job) -> None:
+        """Start the process of job, reserved in running_jobs by the caller."""
+        job = job.model_copy(update={"status": JobStatus.RUNNING, "started_at": time.time()})
+        env = None if job.env is None else {**os.environ, **job.env}
+        try:
+            process = await asyncio.create_subprocess_exec(
+                *job.cmd,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.STDOUT,
+                cwd=job.cwd,
+                env=env,
+                limit=self.MAX_LINE_BYTES,
+            )
+        except OSError as e:
+            logger.error(f"job {job.id} failed to start: {e!r}")
+            self.logs[job.id].append(f"Failed to start: {e!r}\n")
+            self.running_jobs.pop(job.id, None)
+            self.cancelled.discard(job.id)
+            self._finish(job, JobStatus.FAILED, None)
+            return
+        self.store.update(job)
+        self.running[job.id] = process
+        self.running_jobs[job.id] = job
+        logger.info(f"start job {job.id}, {len(self.running)} running, {len(self.queued)} queued")
+        if self.stopping or job.id in self.cancelled:
+            # cancelled or stopped while the process was starting
+            self.cancelled.add(job.id)
+            process.terminate()
+        # the loop only keeps weak references to tasks
+        task = asyncio.create_task(self._run(job, process), name=f"job-{job.id}")
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def _run(self, job: Job, process: asyncio.subprocess.Process) -> None:
+        """Read the output of job until its process exits, a process whose output can not be read is killed and the job
+        fails, so it never stays running."""
+        job_log = self.logs[job.id]
+        return_code = None
+        try:
+            async for line in process.stdout:
+                job_log.append(line.decode(errors="replace"))
+            return_code = await process.wait()
+        except (ValueError, OSError) as e:
+            # e.g. a line longer than MAX_LINE_BYTES
+            logger.error(f"job {job.id} output can not be read: {e!r}")
+            job_log.append(f"Failed to read output: {e!r}\n")
+        finally:
+            if process.returncode is None:
+                process.kill()
+                await process.wait()
+            self.running.pop(job.id, None)
+            self.running_jobs.pop(job.id, None)
+            if job.id in self.cancelled:
+                self.cancelled.remove(job.id)
+                status = JobStatus.CANCELLED
+            else:
+                status = JobStatus.SUCCEEDED if return_code == 0 else JobStatus.FAILED
+            self._finish(job, status, return_code)
+            await self._dispatch()
+
+    def _finish(self, job: Job, status: JobStatus, return_code: int | None) -> None:
+        job = job.model_copy(update={"status": status, "return_code": return_code, "finished_at": time.time()})
+        self.store.update(job)
+        if (job_log := self.logs.pop(job.id, None)) is not None:
+            job_log.finish()
+            self.finished_logs[job.id] = job_log
+            while len(self.finished_logs) > self.keep_finished_logs:
+                self.finished_logs.popitem(last=False)
+        logger.info(f"job {job.id} {status.value}, {return_code=}")
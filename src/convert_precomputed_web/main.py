@@ -1,17 +1,65 @@
-import subprocess
+import asyncio
+import os
 import sys
+from collections.abc import AsyncIterator
+from contextlib import asynccontextmanager
 from pathlib import Path, PurePosixPath
-from typing import Iterator, Annotated
+from typing import Annotated
 
-from fastapi import FastAPI, Query
-from fastapi.responses import StreamingResponse, RedirectResponse
+from fastapi import Depends, FastAPI, Header, HTTPException, Query
+from fastapi.responses import RedirectResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
-from loguru import logger
+
+from convert_precomputed_web.broadcast import LogHub
+from convert_precomputed_web.jobs import Job, JobLog, JobQueue, JobStatus, JobStore
 
 CWD = Path(__file__).parent.parent.parent
 SCRIPT_DIR = CWD / "scripts"
 
-app = FastAPI()
+JOB_DB_PATH = Path(os.environ.get("JOB_DB_PATH", CWD / ".data" / "jobs.sqlite3"))
+MAX_RUNNING_JOBS = int(os.environ.get("MAX_RUNNING_JOBS", "2"))
+JOB_MEMORY_CAPACITY = int(
+    os.environ.get("JOB_MEMORY_CAPACITY", str(os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") * 3 // 4))
+)
+JOB_CPU_CAPACITY = int(os.environ.get("JOB_CPU_CAPACITY", str(os.cpu_count())))
+JOB_LOG_DIRECTORY = Path(os.environ.get("JOB_LOG_DIRECTORY", JOB_DB_PATH.parent / "job_logs"))
+JOB_LOG_RING_LINES = int(os.environ.get("JOB_LOG_RING_LINES", "10000"))
+
+SSE_BATCH_INTERVAL = 0.1
+SSE_PROGRESS_INTERVAL = 1.0
+SSE_MAX_PENDING = 64
+
+
+def render_lines(lines: list[tuple[int, str]]) -> str:
+    """One SSE message of lines, with the id of the last line so a reconnecting EventSource resumes after it."""
+    data = "".join(f"data: {line}\n" for line in (line.rstrip("\r\n") for _, line in lines))
+    return f"id: {lines[-1][0]}\n{data}\n"
+
+
+def render_progress(progress: str) -> str:
+    """Progress event of convert_to_precomputed, the JSON printed after the progress line prefix."""
+    return f"event: progress\ndata: {progress}\n\n"
+
+
+job_queue = JobQueue(
+    JobStore(JOB_DB_PATH),
+    MAX_RUNNING_JOBS,
+    JOB_MEMORY_CAPACITY,
+    JOB_CPU_CAPACITY,
+    JOB_LOG_DIRECTORY,
+    ring_size=JOB_LOG_RING_LINES,
+)
+log_hub = LogHub(render_lines, render_progress, SSE_BATCH_INTERVAL, SSE_PROGRESS_INTERVAL, SSE_MAX_PENDING)
+
+
+@asynccontextmanager
+async def lifespan(_: FastAPI):
+    await job_queue.start()
+    yield
+    await job_queue.stop()
+
+
+app = FastAPI(lifespan=lifespan)
 
 app.mount("/web", StaticFiles(directory=CWD / "web"), name="web")
 
@@ -24,8 +72,8 @@ def index():
 BASE_PATH = PurePosixPath("/zjbs-data/share")
 
 
-@app.get("/api/convert-simple-image")
-def convert_simple_image(
+@app.post("/api/convert-simple-image")
+async def convert_simple_image(
     image_path: Annotated[str, Query()],
     output_directory: Annotated[str, Query()],
     resolution_x: Annotated[int, Query()],
@@ -33,7 +81,8 @@ def convert_simple_image(
     resolution_z: Annotated[int, Query()],
     resume: Annotated[bool, Query()],
     write_block_size: Annotated[int, Query()] = 1024,
-) -> StreamingResponse:
+    priority: Annotated[int, Query()] = 0,
+) -> Job:
     cmd = [
         sys.executable,
         "-m",
@@ -43,6 +92,8 @@ def convert_simple_image(
         "http://10.11.140.35:2000",
         "--base-path",
         str(BASE_PATH),
+        "--progress-interval",
+        "1",
     ]
     if write_block_size is not None:
         cmd.append("--write-block-size")
@@ -59,11 +110,26 @@ def convert_simple_image(
     )
 
     python_path = SCRIPT_DIR / "convert-simple-image"
-    return response_stream(cmd, env={"PYTHONPATH": str(python_path)})
+    # whole planes of a 64 plane z slab are read, converted and written at a time
+    memory_bytes = (1 << 30) + min(await path_bytes(BASE_PATH / image_path.lstrip("/")) // 4, 32 << 30)
+    job = Job(
+        kind="simple-image",
+        cmd=cmd,
+        env={"PYTHONPATH": str(python_path)},
+        priority=priority,
+        memory_bytes=memory_bytes,
+        cpus=4,
+    )
+    return await job_queue.submit(job)
 
 
-@app.get("/api/convert-labeled-image")
-def convert_labeled_image(
+@app.get("/api/convert-simple-image")
+def convert_simple_image_stream(job: Annotated[Job, Depends(convert_simple_image)]) -> StreamingResponse:
+    return stream_submitted_job(job)
+
+
+@app.post("/api/convert-labeled-image")
+async def convert_labeled_image(
     image: Annotated[str, Query()],
     output_directory: Annotated[str, Query()],
     resolution_x: Annotated[int, Query()] = 1,
@@ -71,7 +137,8 @@ def convert_labeled_image(
     resolution_z: Annotated[int, Query()] = 1,
     width: Annotated[int | None, Query()] = None,
     height: Annotated[int | None, Query()] = None,
-) -> StreamingResponse:
+    priority: Annotated[int, Query()] = 0,
+) -> Job:
     script_dir = SCRIPT_DIR / "convert-to-neuroglancer" / "python"
     cmd = [
         sys.executable,
@@ -89,7 +156,22 @@ def convert_labeled_image(
         cmd.append(str(height))
     cmd.append(str(BASE_PATH / image.lstrip("/")))
 
-    return response_stream(cmd, env={"PYTHONPATH": str(script_dir)})
+    # the labeled image is loaded whole, together with its downsampled scales
+    memory_bytes = (1 << 30) + 2 * await path_bytes(BASE_PATH / image.lstrip("/"))
+    job = Job(
+        kind="labeled-image",
+        cmd=cmd,
+        env={"PYTHONPATH": str(script_dir)},
+        priority=priority,
+        memory_bytes=memory_bytes,
+        cpus=1,
+    )
+    return await job_queue.submit(job)
+
+
+@app.get("/api/convert-labeled-image")
+def convert_labeled_image_stream(job: Annotated[Job, Depends(convert_labeled_image)]) -> StreamingResponse:
+    return stream_submitted_job(job)
 
 
 SCRIPTS = {
@@ -103,8 +185,8 @@ SCRIPTS = {
 }
 
 
-@app.get("/api/convert-annotation")
-def convert_annotation(
+@app.post("/api/convert-annotation")
+async def convert_annotation(
     annotation_type: Annotated[str, Query()],
     input_file: Annotated[str, Query()],
     output_directory: Annotated[str, Query()],
@@ -112,7 +194,8 @@ def convert_annotation(
     lower_bound: Annotated[str, Query()],
     upper_bound: Annotated[str, Query()],
     generate_index: Annotated[str, Query()],
-) -> StreamingResponse:
+    priority: Annotated[int, Query()] = 0,
+) -> Job:
     script_dir = SCRIPT_DIR / "convert-to-neuroglancer" / "node"
     script = script_dir / SCRIPTS[annotation_type]
     cmd = [
@@ -125,18 +208,92 @@ def convert_annotation(
         f"--targetDir={BASE_PATH/output_directory.lstrip('/')}",
         f"--generateIndex={generate_index}",
     ]
-    return response_stream(cmd, cwd=script_dir)
+    # annotations are parsed into node objects, several times the size of the input file
+    memory_bytes = (512 << 20) + 4 * await path_bytes(BASE_PATH / input_file.lstrip("/"))
+    job = Job(kind="annotation", cmd=cmd, cwd=str(script_dir), priority=priority, memory_bytes=memory_bytes, cpus=1)
+    return await job_queue.submit(job)
+
+
+@app.get("/api/convert-annotation")
+def convert_annotation_stream(job: Annotated[Job, Depends(convert_annotation)]) -> StreamingResponse:
+    return stream_submitted_job(job)
+
+
+def stream_submitted_job(job: Job) -> StreamingResponse:
+    """Output of a job submitted by a GET convert endpoint, streamed like before jobs were queued."""
+    return StreamingResponse(stream_job_events(job, job_queue.log(job.id), 0, True), media_type="text/event-stream")
+
+
+@app.get("/api/jobs")
+def list_jobs(status: Annotated[JobStatus | None, Query()] = None, limit: Annotated[int, Query()] = 100) -> list[Job]:
+    return job_queue.store.list(status, limit)
+
+
+@app.get("/api/jobs/{job_id}")
+def get_job(job_id: int) -> Job:
+    if (job := job_queue.store.get(job_id)) is None:
+        raise HTTPException(status_code=404, detail=f"job {job_id} not found")
+    return job
+
+
+@app.get("/api/jobs/{job_id}/events")
+async def job_events(
+    job_id: int, log: Annotated[bool, Query()] = False, last_event_id: Annotated[int, Header(alias="Last-Event-ID")] = 0
+) -> StreamingResponse:
+    job = get_job(job_id)
+    return StreamingResponse(
+        stream_job_events(job, job_queue.log(job_id), last_event_id, log), media_type="text/event-stream"
+    )
+
+
+@app.delete("/api/jobs/{job_id}")
+async def cancel_job(job_id: int) -> Job:
+    await job_queue.cancel(job_id)
+    return get_job(job_id)
+
+
+async def path_bytes(path: PurePosixPath) -> int:
+    """Size of a file or of all files in a directory, 0 if it does not exist, listed on a worker thread."""
+
+    def sum_bytes() -> int:
+        if (local_path := Path(path)).is_dir():
+            return sum(item.stat().st_size for item in local_path.rglob("*") if item.is_file())
+        return local_path.stat().st_size if local_path.exists() else 0
 
+    return await asyncio.to_thread(sum_bytes)
 
-def response_stream(cmd: list[str], **kwargs) -> StreamingResponse:
-    return StreamingResponse(execute_script(cmd, **kwargs), media_type="text/event-stream")
 
+async def stream_job_events(job: Job, job_log: JobLog | None, last_event_id: int, raw_log: bool) -> AsyncIterator[str]:
+    """Stream the progress events of job as SSE, and with raw_log its output lines after last_event_id, rendered once
+    for all viewers by log_hub.
 
-def execute_script(cmd: list[str], **kwargs) -> Iterator[str]:
-    logger.info(f"cmd={' '.join(cmd)}")
-    process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, **kwargs)
-    for line in process.stdout:
-        yield f"data: {line}\n"
+    A viewer that falls SSE_MAX_PENDING messages behind is dropped by the broadcast and subscribes again from its last
+    id, so the lines it missed are coalesced into one message replayed from memory.
+    """
+    if (position := job_queue.position(job.id)) >= 0:
+        yield f"data: Job {job.id} queued, {position} jobs ahead\n\n"
+    while job_log is not None:
+        broadcast = log_hub.broadcast(job_log)
+        subscriber = broadcast.subscribe(last_event_id, raw_log)
+        try:
+            if subscriber.skipped:
+                yield f"data: {subscriber.skipped} lines skipped, see {job_log.path.name} for the full log\n\n"
+            while True:
+                try:
+                    message = await subscriber.get(timeout=15)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+                if message is None:
+                    break
+                line_id, data = message
+                if line_id is not None:
+                    last_event_id = line_id
+                yield data
+        finally:
+            broadcast.unsubscribe(subscriber)
+        if not subscriber.dropped:
+            break
 
-    code = process.wait()
-    yield f"event: done\ndata: Finished with return code: {code}\n\n"
+    job = job_queue.store.get(job.id)
+    yield f"event: done\ndata: Finished with return code: {job.return_code} ({job.status.value})\n\n"
@@ -0,0 +1,70 @@
+import asyncio
+
+from convert_precomputed_web.broadcast import LogBroadcast
+from convert_precomputed_web.jobs import JobLog
+
+
+def render_lines(lines: list[tuple[int, str]]) -> str:
+    return "".join(line for _, line in lines)
+
+
+def render_progress(progress: str) -> str:
+    return f"progress {progress}"
+
+
+def append_lines(job_log: JobLog, count: int) -> None:
+    for _ in range(count):
+        job_log.append(f"line {job_log.last_id + 1}\n")
+
+
+def test_since_replays_ring_and_counts_lines_only_in_file(tmp_path):
+    job_log = JobLog(tmp_path / "1.log", ring_size=4)
+    assert job_log.since(0) == ([], 0)
+    append_lines(job_log, 10)
+    job_log.append("@progress {}\n")
+
+    assert job_log.since(0) == ([(7, "line 7\n"), (8, "line 8\n"), (9, "line 9\n"), (10, "line 10\n")], 6)
+    assert job_log.since(8) == ([(9, "line 9\n"), (10, "line 10\n")], 0)
+    assert job_log.since(10) == ([], 0)
+    job_log.finish()
+    assert (tmp_path / "1.log").read_text() == "".join(f"line {line_id}\n" for line_id in range(1, 11))
+
+
+def test_broadcast_starts_at_ring_without_falling_behind(tmp_path):
+    job_log = JobLog(tmp_path / "1.log", ring_size=4)
+    append_lines(job_log, 10)
+    broadcast = LogBroadcast(job_log, render_lines, render_progress, 0.0, 0.0, max_pending=8)
+
+    assert job_log.since(broadcast.sent_id) == (job_log.since(0)[0], 0)
+    assert broadcast._send_lines()
+    assert broadcast.sent_id == 10
+
+
+async def drain(subscriber) -> list:
+    messages = []
+    while (message := await subscriber.get(1.0)) is not None:
+        messages.append(message)
+    return messages
+
+
+def test_slow_subscriber_is_dropped_and_resumes_from_last_id(tmp_path):
+    async def run():
+        job_log = JobLog(tmp_path / "1.log", ring_size=100)
+        broadcast = LogBroadcast(job_log, render_lines, render_progress, 0.0, 0.0, max_pending=2)
+        subscriber = broadcast.subscribe(0, raw_log=True)
+        for _ in range(4):
+            append_lines(job_log, 1)
+            await asyncio.sleep(0.01)
+        assert subscriber.dropped
+        assert subscriber not in broadcast.subscribers
+        messages = await drain(subscriber)
+        assert [line_id for line_id, _ in messages] == [1, 2]
+
+        resubscriber = broadcast.subscribe(subscriber.last_id, raw_log=True)
+        job_log.finish()
+        messages = await drain(resubscriber)
+        assert not resubscriber.dropped
+        assert "".join(text for _, text in messages) == "line 3\nline 4\n"
+        assert messages[-1][0] == 4
+
+    asyncio.run(run())
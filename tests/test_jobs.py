@@ -0,0 +1,123 @@
+import asyncio
+import sys
+
+from convert_precomputed_web.jobs import Job, JobQueue, JobStatus, JobStore
+
+
+def sleep_job(seconds: float = 60.0, **fields) -> Job:
+    return Job(kind="test", cmd=[sys.executable, "-c", f"import time; time.sleep({seconds})"], **fields)
+
+
+def create_queue(tmp_path, max_running: int = 4, memory_capacity: int = 100, cpu_capacity: int = 100) -> JobQueue:
+    return JobQueue(JobStore(tmp_path / "jobs.sqlite3"), max_running, memory_capacity, cpu_capacity, tmp_path / "logs")
+
+
+async def wait_finished(queue: JobQueue) -> None:
+    while queue.tasks:
+        await asyncio.wait(set(queue.tasks))
+
+
+def statuses(queue: JobQueue) -> dict[int, JobStatus]:
+    return {job.id: job.status for job in queue.store.list(limit=-1)}
+
+
+def test_concurrent_submits_respect_max_running(tmp_path):
+    async def run():
+        queue = create_queue(tmp_path, max_running=1)
+        jobs = await asyncio.gather(*(queue.submit(sleep_job()) for _ in range(4)))
+
+        assert list(queue.running_jobs) == [jobs[0].id]
+        assert [job.id for job in queue._ordered_queue()] == [job.id for job in jobs[1:]]
+        await queue.stop()
+        return statuses(queue)
+
+    assert list(asyncio.run(run()).values()) == [JobStatus.QUEUED] * 3 + [JobStatus.CANCELLED]
+
+
+def test_head_of_queue_waits_for_memory_and_is_not_overtaken(tmp_path):
+    async def run():
+        queue = create_queue(tmp_path, memory_capacity=10)
+        first = await queue.submit(sleep_job(memory_bytes=6))
+        second = await queue.submit(sleep_job(memory_bytes=6))
+        third = await queue.submit(sleep_job(memory_bytes=4))
+        assert list(queue.running_jobs) == [first.id]
+        assert queue.position(second.id) == 0 and queue.position(third.id) == 1
+
+        # cancelling the head dispatches the smaller job behind it
+        await queue.cancel(second.id)
+        assert list(queue.running_jobs) == [first.id, third.id]
+        assert queue.store.get(second.id).status == JobStatus.CANCELLED
+        assert queue.log(second.id).finished
+        await queue.stop()
+
+    asyncio.run(run())
+
+
+def test_job_bigger_than_capacity_runs_alone(tmp_path):
+    async def run():
+        queue = create_queue(tmp_path, memory_capacity=10)
+        big = await queue.submit(sleep_job(memory_bytes=20))
+        small = await queue.submit(sleep_job(memory_bytes=1))
+        assert list(queue.running_jobs) == [big.id]
+        assert queue.position(small.id) == 0
+        await queue.stop()
+
+    asyncio.run(run())
+
+
+def test_finished_job_dispatches_next_by_priority(tmp_path):
+    async def run():
+        queue = create_queue(tmp_path, max_running=1)
+        first = await queue.submit(sleep_job(0.1))
+        low = await queue.submit(sleep_job(0.0, priority=0))
+        high = await queue.submit(sleep_job(0.0, priority=1))
+        await wait_finished(queue)
+
+        jobs = {job_id: queue.store.get(job_id) for job_id in (first.id, low.id, high.id)}
+        assert {job.status for job in jobs.values()} == {JobStatus.SUCCEEDED}
+        assert jobs[first.id].finished_at <= jobs[high.id].started_at
+        assert jobs[high.id].finished_at <= jobs[low.id].started_at
+        assert not queue.running and not queue.running_jobs
+
+    asyncio.run(run())
+
+
+def test_job_cancelled_while_its_process_starts_is_terminated(tmp_path):
+    async def run():
+        queue = create_queue(tmp_path)
+        # the cancel runs while submit waits for the process to start
+        job, _ = await asyncio.gather(queue.submit(sleep_job()), queue.cancel(1))
+        await wait_finished(queue)
+        return queue.store.get(job.id)
+
+    job = asyncio.run(run())
+    assert job.status == JobStatus.CANCELLED and job.return_code != 0
+
+
+def test_job_that_can_not_start_fails_and_frees_its_slot(tmp_path):
+    async def run():
+        queue = create_queue(tmp_path, max_running=1)
+        missing = await queue.submit(Job(kind="test", cmd=[str(tmp_path / "missing")]))
+        job = await queue.submit(sleep_job(0.0))
+        await wait_finished(queue)
+        return queue.store.get(missing.id), queue.store.get(job.id), queue.log(missing.id)
+
+    missing, job, missing_log = asyncio.run(run())
+    assert missing.status == JobStatus.FAILED
+    assert job.status == JobStatus.SUCCEEDED
+    assert missing_log.since(0)[0][0][1].startswith("Failed to start")
+
+
+def test_queued_jobs_survive_a_restart(tmp_path):
+    async def run():
+        queue = create_queue(tmp_path, max_running=1)
+        await queue.submit(sleep_job())
+        queued = await queue.submit(sleep_job(0.0))
+        await queue.stop()
+
+        restarted = create_queue(tmp_path, max_running=1)
+        await restarted.start()
+        await wait_finished(restarted)
+        return restarted.store.get(queued.id)
+
+    assert asyncio.run(run()).status == JobStatus.SUCCEEDED
@@ -0,0 +1,77 @@
+import importlib
+import sys
+
+import pytest
+from fastapi.testclient import TestClient
+
+from convert_precomputed_web.jobs import Job, JobStatus
+
+LABELED_IMAGE_PARAMS = {"image": "missing/image.tif", "output_directory": "missing/output"}
+
+
+@pytest.fixture
+def main(tmp_path, monkeypatch):
+    # the job queue of main is created at import from the environment
+    monkeypatch.setenv("JOB_DB_PATH", str(tmp_path / "jobs.sqlite3"))
+    monkeypatch.setenv("MAX_RUNNING_JOBS", "1")
+    from convert_precomputed_web import main
+
+    return importlib.reload(main)
+
+
+@pytest.fixture
+def client(main):
+    # the lifespan starts the job queue, and stops its running jobs at exit
+    with TestClient(main.app) as client:
+        yield client
+
+
+def test_post_convert_submits_a_job(client, main):
+    response = client.post("/api/convert-labeled-image", params={**LABELED_IMAGE_PARAMS, "priority": 2})
+
+    assert response.status_code == 200
+    job = Job.model_validate(response.json())
+    assert job.kind == "labeled-image" and job.priority == 2 and job.memory_bytes == 1 << 30
+    assert job.cmd[-1] == "/zjbs-data/share/missing/image.tif"
+    assert Job.model_validate(client.get(f"/api/jobs/{job.id}").json()).id == job.id
+    assert [listed["id"] for listed in client.get("/api/jobs").json()] == [job.id]
+
+
+def test_get_convert_submits_a_job_and_streams_its_output(client, main):
+    response = client.get("/api/convert-labeled-image", params=LABELED_IMAGE_PARAMS)
+
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/event-stream")
+    # the output lines of the job, then its end
+    assert response.text.startswith("id: 1\ndata: ") and "can't open file" in response.text
+    assert response.text.endswith("event: done\ndata: Finished with return code: 2 (failed)\n\n")
+    assert [job["status"] for job in client.get("/api/jobs").json()] == [JobStatus.FAILED.value]
+
+
+def test_jobs_are_listed_latest_first_and_filtered_by_status(client, main):
+    sleep_cmd = [sys.executable, "-c", "import time; time.sleep(60)"]
+    running = client.portal.call(main.job_queue.submit, Job(kind="test", cmd=sleep_cmd))
+    queued = client.portal.call(main.job_queue.submit, Job(kind="test", cmd=sleep_cmd))
+
+    assert [job["id"] for job in client.get("/api/jobs").json()] == [queued.id, running.id]
+    assert [job["id"] for job in client.get("/api/jobs", params={"status": "queued"}).json()] == [queued.id]
+    assert client.get("/api/jobs", params={"limit": 1}).json()[0]["id"] == queued.id
+    assert client.get("/api/jobs", params={"status": "unknown"}).status_code == 422
+
+
+def test_delete_cancels_a_queued_job_and_events_report_it(client, main):
+    sleep_cmd = [sys.executable, "-c", "import time; time.sleep(60)"]
+    client.portal.call(main.job_queue.submit, Job(kind="test", cmd=sleep_cmd))
+    queued = client.portal.call(main.job_queue.submit, Job(kind="test", cmd=sleep_cmd))
+
+    response = client.delete(f"/api/jobs/{queued.id}")
+
+    assert response.json()["status"] == JobStatus.CANCELLED.value
+    events = client.get(f"/api/jobs/{queued.id}/events").text
+    assert events == "event: done\ndata: Finished with return code: None (cancelled)\n\n"
+
+
+def test_missing_job_is_not_found(client):
+    assert client.get("/api/jobs/42").status_code == 404
+    assert client.get("/api/jobs/42/events").status_code == 404
+    assert client.delete("/api/jobs/42").status_code == 404
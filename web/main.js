@@ -1,6 +1,18 @@
+// older lines are removed, the full log of a job is kept in a file on the server
+const MAX_TERMINAL_LINES = 2000;
+
+const PROGRESS_LEVEL_NAMES = {
+    scale: 'Scale',
+    z_range: 'Slab',
+    xy_tile: 'Tile',
+    channel: 'Channel',
+    xy_range: 'Block',
+};
+
 function clearTerminal(terminalId) {
     const terminalDiv = document.getElementById(terminalId);
     terminalDiv.innerHTML = '';
+    terminalDiv.dataset.lineCount = '0';
 }
 
 function addTerminalLine(terminalId, line) {
@@ -8,7 +20,8 @@ function addTerminalLine(terminalId, line) {
     const lineElement = document.createElement('div');
     lineElement.className = 'line';
 
-    const lineNumber = terminal.childNodes.length + 1;
+    const lineNumber = Number(terminal.dataset.lineCount || 0) + 1;
+    terminal.dataset.lineCount = String(lineNumber);
     const lineNoSpan = document.createElement('span');
     lineNoSpan.className = 'line-no';
     lineNoSpan.textContent = lineNumber + ':';
@@ -20,9 +33,37 @@ function addTerminalLine(terminalId, line) {
     lineElement.appendChild(lineContentSpan);
 
     terminal.appendChild(lineElement);
+    while (terminal.childNodes.length > MAX_TERMINAL_LINES) {
+        terminal.removeChild(terminal.firstChild);
+    }
     terminal.scrollTop = terminal.scrollHeight;
 }
 
+function formatSeconds(seconds) {
+    if (seconds === null || seconds === undefined) {
+        return '-';
+    }
+    seconds = Math.round(seconds);
+    const hours = Math.floor(seconds / 3600);
+    const minutes = Math.floor(seconds % 3600 / 60);
+    return hours > 0 ? `${hours}h ${minutes}m` : `${minutes}m ${seconds % 60}s`;
+}
+
+function renderProgress(progressId, progress) {
+    const panel = document.getElementById(progressId);
+    const percent = `${(progress.done * 100).toFixed(1)}%`;
+    const bar = panel.querySelector('.progress-bar');
+    bar.style.width = percent;
+    bar.textContent = percent;
+    panel.querySelector('.progress-position').textContent = progress.levels
+        .filter((level) => level.name in PROGRESS_LEVEL_NAMES)
+        .map((level) => `${PROGRESS_LEVEL_NAMES[level.name]} ${level.index}/${level.count} ${level.description}`.trim())
+        .join(', ');
+    panel.querySelector('.progress-speed').textContent =
+        `${(progress.voxels_per_second / 1e6).toFixed(1)} Mvoxel/s, ${progress.mib_per_second.toFixed(1)} MiB/s, ` +
+        `elapsed ${formatSeconds(progress.elapsed_seconds)}, ETA ${formatSeconds(progress.eta_seconds)}`;
+}
+
 function getFormData(form) {
     const formData = {};
     for (const input of form.elements) {
@@ -43,33 +84,87 @@ function makeQueryParams(formData) {
         .join('&');
 }
 
-function registerEventSource(formId, terminalId, endpoint) {
+function registerEventSource(formId, terminalId, endpoint, progressId = null) {
     const form = document.getElementById(formId);
-    form.addEventListener('submit', (event) => {
-        event.preventDefault();
-        clearTerminal(terminalId);
+    const progressPanel = progressId === null ? null : document.getElementById(progressId);
+    const showLogButton = progressPanel === null ? null : progressPanel.querySelector('button');
+    let eventSource = null;
+    let jobId = null;
 
-        const formData = getFormData(form);
-        console.log(`formData: ${JSON.stringify(formData)}`);
-        const queryParams = makeQueryParams(formData);
-        console.log(`queryParams: ${queryParams}`);
-
-        const eventSource = new EventSource(`${endpoint}?${queryParams}`);
+    // jobs reporting progress only send progress events unless their log is asked for, a job writes far more log
+    // lines than the page can show
+    function followJob(rawLog) {
+        if (eventSource !== null) {
+            eventSource.close();
+        }
+        // the job runs on the server without this page, a dropped connection reconnects and resumes after the last
+        // received line by Last-Event-ID
+        eventSource = new EventSource(`/api/jobs/${jobId}/events${rawLog ? '?log=true' : ''}`);
         eventSource.addEventListener('message', (event) => {
-            addTerminalLine(terminalId, event.data);
+            // the server batches lines arriving close together into one message
+            for (const line of event.data.split('\n')) {
+                addTerminalLine(terminalId, line);
+            }
+        });
+        eventSource.addEventListener('progress', (event) => {
+            if (progressId !== null) {
+                renderProgress(progressId, JSON.parse(event.data));
+            }
         });
         eventSource.addEventListener('error', (event) => {
-            addTerminalLine(terminalId, 'Error!');
-            eventSource.close();
+            addTerminalLine(terminalId, 'Connection lost, reconnecting...');
         });
         eventSource.addEventListener('done', (event) => {
             addTerminalLine(terminalId, event.data);
             addTerminalLine(terminalId, 'Done!');
             eventSource.close();
         });
-        window.addEventListener('beforeunload', (event) => {
+    }
+
+    form.addEventListener('submit', async (event) => {
+        event.preventDefault();
+        clearTerminal(terminalId);
+        if (eventSource !== null) {
             eventSource.close();
+        }
+        if (progressPanel !== null) {
+            // the log button stays at hand for jobs failing before their first progress event
+            progressPanel.hidden = false;
+            progressPanel.querySelector('.progress-bar').style.width = '0';
+            progressPanel.querySelector('.progress-bar').textContent = '';
+            progressPanel.querySelector('.progress-position').textContent = '';
+            progressPanel.querySelector('.progress-speed').textContent = '';
+            showLogButton.disabled = false;
+        }
+
+        const formData = getFormData(form);
+        console.log(`formData: ${JSON.stringify(formData)}`);
+        const queryParams = makeQueryParams(formData);
+        console.log(`queryParams: ${queryParams}`);
+
+        const response = await fetch(`${endpoint}?${queryParams}`, {method: 'POST'});
+        if (!response.ok) {
+            addTerminalLine(terminalId, `Error! ${response.status} ${await response.text()}`);
+            return;
+        }
+        const job = await response.json();
+        jobId = job.id;
+        addTerminalLine(terminalId, `Job ${job.id} submitted`);
+        followJob(progressId === null);
+    });
+    if (showLogButton !== null) {
+        showLogButton.addEventListener('click', (event) => {
+            if (jobId === null) {
+                return;
+            }
+            showLogButton.disabled = true;
+            clearTerminal(terminalId);
+            followJob(true);
         });
+    }
+    window.addEventListener('beforeunload', (event) => {
+        if (eventSource !== null) {
+            eventSource.close();
+        }
     });
 }
-